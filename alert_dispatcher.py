@@ -0,0 +1,144 @@
+from collections import deque
+import logging
+import queue
+import threading
+import requests
+
+
+class AlertDispatcher:
+    """Background delivery of alert requests to the email server
+
+    Alerts are placed on a bounded queue and posted by a small pool
+    of daemon worker threads, so the request that triggered an alert
+    never waits on the email server. Each attempt is bounded by a
+    timeout. Connection errors, timeouts and 5xx responses are retried
+    with exponential backoff. Alerts that still fail, get a 4xx
+    response or do not fit in the queue are kept in a bounded
+    dead-letter list for inspection.
+
+    Workers are started on the first submitted alert.
+    """
+
+    def __init__(self, url, workers=2, max_queue=1000, timeout=5.0,
+                 max_attempts=4, backoff=0.5, max_dead_letters=1000):
+        """Configures the dispatcher without starting any threads
+
+        Args:
+            url (str): email server endpoint receiving a json POST
+            workers (int): number of delivery threads
+            max_queue (int): alerts that may wait for delivery
+            timeout (float): seconds allowed for each attempt
+            max_attempts (int): attempts before an alert is dead-lettered
+            backoff (float): seconds before the first retry, doubled
+                             for every further retry
+            max_dead_letters (int): failed alerts kept for inspection
+        """
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.dead_letters = deque(maxlen=max_dead_letters)
+        self.sent = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        """Starts the worker threads if they are not already running"""
+        with self._start_lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run,
+                                          name="alert-dispatch-{}".format(i),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stops the worker threads once they finish their current alert
+
+        Alerts still waiting in the queue stay there and are delivered
+        if the dispatcher is started again. An alert waiting for a
+        retry is dead-lettered.
+
+        Args:
+            timeout (float): seconds to wait for each thread, None waits
+        """
+        with self._start_lock:
+            self._stopping.set()
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+
+    def submit(self, payload):
+        """Queues an alert for delivery without blocking
+
+        Args:
+            payload (dict): json body to post to the email server
+
+        Returns:
+            bool: True if queued, False if the queue was full and the
+                  alert was dead-lettered instead
+        """
+        self.start()
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            self._dead_letter(payload, "alert queue full", 0)
+            return False
+        return True
+
+    def join(self):
+        """Blocks until every queued alert has been delivered or
+        dead-lettered"""
+        self._queue.join()
+
+    def _run(self):
+        session = requests.Session()
+        while not self._stopping.is_set():
+            try:
+                payload = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                self._deliver(session, payload)
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, session, payload):
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                r = session.post(self.url, json=payload,
+                                 timeout=self.timeout)
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if r.status_code < 400:
+                    with self._stats_lock:
+                        self.sent += 1
+                    return
+                error = "status {}: {}".format(r.status_code, r.text)
+                if r.status_code < 500:
+                    break
+            if attempt < self.max_attempts:
+                delay = self.backoff * 2 ** (attempt - 1)
+                if self._stopping.wait(delay):
+                    break
+        self._dead_letter(payload, error, attempt)
+
+    def _dead_letter(self, payload, error, attempts):
+        with self._stats_lock:
+            self.failed += 1
+            self.dead_letters.append({"payload": payload,
+                                      "error": error,
+                                      "attempts": attempts})
+        logging.error('Alert to {} could not be delivered after {} '
+                      'attempt(s): {}'.format(payload.get("to_email"),
+                                              attempts, error))
@@ -0,0 +1,140 @@
+import threading
+import time
+
+
+class AlertPolicy:
+    """Decides which tachycardia alerts are emailed to attendings
+
+    Two rules sit between a tachycardic reading and the email server:
+
+    - Repeat suppression: once a patient has alerted, further alerts
+      for that patient are suppressed for `repeat_window` seconds and
+      only counted.
+    - Per-attending rate limit: an attending is emailed immediately at
+      most once every `digest_interval` seconds. Alerts for their other
+      patients arriving within that interval are coalesced into one
+      digest, which is handed to `on_digest` when the interval ends.
+
+    The first alert of a patient's episode is therefore always either
+    emailed immediately or included in the next digest.
+    """
+
+    SEND = "send"
+    COALESCE = "coalesce"
+    SUPPRESS = "suppress"
+
+    def __init__(self, repeat_window=300.0, digest_interval=60.0,
+                 on_digest=None, clock=time.monotonic):
+        """Configures the policy
+
+        Args:
+            repeat_window (float): seconds after a patient's alert during
+                                   which repeats are suppressed
+            digest_interval (float): minimum seconds between emails to
+                                     the same attending
+            on_digest (callable): called as on_digest(attending, entries)
+                                  from a timer thread when a digest is
+                                  due; None leaves digests to flush()
+            clock (callable): returns the current time in seconds
+        """
+        self.repeat_window = repeat_window
+        self.digest_interval = digest_interval
+        self.on_digest = on_digest
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._last_patient_alert = {}
+        self._last_attending_email = {}
+        self._pending = {}
+        self._suppressed_since_alert = {}
+        self._counts = {"sent": 0, "coalesced": 0, "suppressed": 0,
+                        "digests": 0}
+
+    def evaluate(self, patient_id, attending):
+        """Records a tachycardia alert and decides how to deliver it
+
+        Args:
+            patient_id (int): id of the tachycardic patient
+            attending (str): username of the patient's attending
+
+        Returns:
+            str: AlertPolicy.SEND to email now, AlertPolicy.COALESCE if
+                 the alert was added to the attending's next digest, or
+                 AlertPolicy.SUPPRESS if it repeats a recent alert
+        """
+        start_timer = False
+        with self._lock:
+            now = self.clock()
+            last = self._last_patient_alert.get(patient_id)
+            if last is not None and now - last < self.repeat_window:
+                self._suppressed_since_alert[patient_id] = \
+                    self._suppressed_since_alert.get(patient_id, 0) + 1
+                self._counts["suppressed"] += 1
+                return self.SUPPRESS
+            self._last_patient_alert[patient_id] = now
+            self._suppressed_since_alert.pop(patient_id, None)
+            emailed = self._last_attending_email.get(attending)
+            if emailed is None or now - emailed >= self.digest_interval:
+                self._last_attending_email[attending] = now
+                self._counts["sent"] += 1
+                return self.SEND
+            pending = self._pending.setdefault(attending, [])
+            start_timer = len(pending) == 0
+            if patient_id not in pending:
+                pending.append(patient_id)
+            self._counts["coalesced"] += 1
+            delay = emailed + self.digest_interval - now
+        if start_timer and self.on_digest is not None:
+            timer = threading.Timer(delay, self._flush_to_callback,
+                                    [attending])
+            timer.daemon = True
+            timer.start()
+        return self.COALESCE
+
+    def flush(self, attending):
+        """Takes the pending digest for an attending
+
+        Args:
+            attending (str): attending username
+
+        Returns:
+            list: digest entries {"patient_id": int, "suppressed": int}
+                  giving the repeats suppressed since each patient's
+                  alert, empty if nothing is pending
+        """
+        with self._lock:
+            patient_ids = self._pending.pop(attending, [])
+            if not patient_ids:
+                return []
+            self._last_attending_email[attending] = self.clock()
+            self._counts["digests"] += 1
+            return [{"patient_id": patient_id,
+                     "suppressed":
+                         self._suppressed_since_alert.get(patient_id, 0)}
+                    for patient_id in patient_ids]
+
+    def suppressed_count(self, patient_id):
+        """Gives the repeats suppressed since a patient's last alert
+
+        Args:
+            patient_id (int): patient id
+
+        Returns:
+            int: number of suppressed alerts
+        """
+        with self._lock:
+            return self._suppressed_since_alert.get(patient_id, 0)
+
+    def stats(self):
+        """Gives alert counts since the policy was created
+
+        Returns:
+            dict: alerts sent immediately, coalesced into digests,
+                  suppressed as repeats, and digests flushed
+        """
+        with self._lock:
+            return dict(self._counts)
+
+    def _flush_to_callback(self, attending):
+        entries = self.flush(attending)
+        if entries:
+            self.on_digest(attending, entries)
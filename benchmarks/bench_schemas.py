@@ -0,0 +1,98 @@
+"""Measures request body validation overhead per record
+
+Compares the compiled HEART_RATE_SCHEMA against the way /api/heart_rate
+used to validate a body: rebuilding its expected_values dict, walking
+it with the interpreted validate_dict_input loop and then converting
+the ids with str_to_int again in the handler. Both are timed on single
+bodies and on a batch of records, with ids posted as ints and as
+strings.
+
+Usage:
+    python benchmarks/bench_schemas.py [--records 1000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from schemas import HEART_RATE_SCHEMA, parse_timestamp  # noqa: E402
+from sentinel_server import str_to_int  # noqa: E402
+
+
+def legacy_validate_dict_input(in_data, expected_keys):
+    # validate_dict_input as it was before schemas were compiled
+    if type(in_data) is not dict:
+        return "The input was not a dictionary.", 400
+    for key in expected_keys:
+        if key not in in_data:
+            return "The key {} is missing from input".format(key), 400
+        if type(in_data[key]) not in expected_keys[key]:
+            return "The key {} has invalid data type".format(key), 400
+        if set(expected_keys[key]) == set([str, int]):
+            check = str_to_int(in_data[key])
+            if not check[1]:
+                m1 = "The value \"{}\"".format(in_data[key])
+                m2 = " in key {} cannot be cast to int".format(key)
+                return m1+m2, 400
+    return True, 200
+
+
+def legacy_heart_rate(in_data):
+    expected_values = {"patient_id": [str, int],
+                       "heart_rate": [str, int]}
+    error_string, status_code = legacy_validate_dict_input(in_data,
+                                                           expected_values)
+    if error_string is not True:
+        return error_string
+    pat_id = str_to_int(in_data["patient_id"])[0]
+    hr_info = str_to_int(in_data["heart_rate"])[0]
+    timestamp = None
+    if "timestamp" in in_data:
+        timestamp = parse_timestamp(in_data["timestamp"])
+        if isinstance(timestamp, str):
+            return timestamp
+    return pat_id, hr_info, timestamp
+
+
+def compiled_heart_rate(in_data):
+    return HEART_RATE_SCHEMA.validate(in_data)
+
+
+def per_record(func, records, repeat):
+    best = min(timeit.repeat(lambda: func(records), number=1,
+                             repeat=repeat))
+    return best / len(records) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    bodies = {
+        "int ids": [{"patient_id": i, "heart_rate": 60 + i % 40}
+                    for i in range(args.records)],
+        "str ids": [{"patient_id": str(i), "heart_rate": str(60 + i % 40)}
+                    for i in range(args.records)],
+        "timestamp": [{"patient_id": i, "heart_rate": 60 + i % 40,
+                       "timestamp": 1635681600000 + i}
+                      for i in range(args.records)]}
+    for name, records in bodies.items():
+        assert [legacy_heart_rate(x) for x in records] == \
+            HEART_RATE_SCHEMA.validate_many(records)
+        legacy = per_record(lambda r: [legacy_heart_rate(x) for x in r],
+                            records, args.repeat)
+        single = per_record(lambda r: [compiled_heart_rate(x) for x in r],
+                            records, args.repeat)
+        batch = per_record(HEART_RATE_SCHEMA.validate_many, records,
+                           args.repeat)
+        print("{:10s} legacy: {:6.0f} ns  compiled: {:6.0f} ns  "
+              "batch: {:6.0f} ns  ({:.1f}x)".format(
+                  name, legacy, single, batch, legacy / batch))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Measures response encoding throughput on the heart rate history routes
+
+Fills an in-memory database with patients holding long histories, then
+requests the rendered readings page, the plain heart rate list and the
+patient database dump through the Flask test client. The response cache
+is cleared before every request so each one is encoded from scratch.
+Each route is timed with the standard library encoder, with orjson
+(when installed) and with orjson plus the cached blocks of encoded
+readings.
+
+Usage:
+    python benchmarks/bench_serialization.py [--patients 20]
+                                             [--readings 5000]
+                                             [--requests 30]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import serialization  # noqa: E402
+import sentinel_server  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+ROUTES = ["/api/heart_rate/1?fields=readings&limit={}",
+          "/api/heart_rate/1",
+          "/api/heart_rate/1?limit={}"]
+
+
+def fill(patients, readings):
+    sentinel_server.use_storage(MemoryStorage())
+    sentinel_server.tach_alert = lambda *args: None
+    sentinel_server.add_attending_to_database("Smith.J", "smith@x.com",
+                                              "919-555-1212")
+    for pat_id in range(patients):
+        patient = sentinel_server.add_patient_to_database(pat_id, "Smith.J",
+                                                          40)
+        for i in range(readings):
+            sentinel_server.add_heart_rate(patient, 60 + i % 60,
+                                           1635681600000 + i * 1000)
+
+
+def requests_per_second(client, path, count):
+    best = 0
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(count):
+            sentinel_server.response_cache.clear()
+            r = client.get(path)
+            assert r.status_code == 200
+        best = max(best, count / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--readings", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=30)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    fill(args.patients, args.readings)
+    client = sentinel_server.app.test_client()
+    orjson = serialization.orjson
+    modes = [("json", None, 0)]
+    if orjson is not None:
+        modes += [("orjson", orjson, 0),
+                  ("orjson+cache", orjson, serialization.ENCODED_CACHE_BYTES)]
+    for name, module, cache_bytes in modes:
+        serialization.orjson = module
+        serialization.encoded_blocks.max_bytes = cache_bytes
+        serialization.encoded_blocks.clear()
+        print(name)
+        for route in ROUTES:
+            path = route.format(args.readings)
+            print("  {:45s} {:6.0f} req/s".format(
+                path, requests_per_second(client, path, args.requests)))
+        start = time.perf_counter()
+        size = len(client.get("/api/patient_database/").data)
+        print("  {:45s} {:6.1f} ms ({} bytes)".format(
+            "/api/patient_database/", (time.perf_counter() - start) * 1000,
+            size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measures heart rate ingest throughput against worker count
+
+Starts sentinel_workers.py with 1, 2, 4, ... workers on a fresh SQLite
+file, then posts /api/heart_rate from several client processes for a
+fixed time and reports requests per second.
+
+Usage:
+    python benchmarks/bench_workers.py [--workers 1 2 4] [--clients 8]
+                                       [--seconds 5]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import requests
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATIENTS = 100
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+
+def client(url, seconds, offset, counts):
+    session = requests.Session()
+    sent = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        r = session.post(url + "/api/heart_rate",
+                         json={"patient_id": (offset + sent) % PATIENTS,
+                               "heart_rate": 60 + sent % 40})
+        r.raise_for_status()
+        sent += 1
+    counts.put(sent)
+
+
+def run(workers, clients, seconds):
+    port = free_port()
+    url = "http://127.0.0.1:{}".format(port)
+    with tempfile.TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "sentinel_workers.py"),
+             "--workers", str(workers), "--port", str(port),
+             "--sqlite", os.path.join(tmp, "bench.db")], cwd=tmp)
+        try:
+            wait_for_server(url)
+            requests.post(url + "/api/new_attending",
+                          json={"attending_username": "Bench.B",
+                                "attending_email": "bench@duke.edu",
+                                "attending_phone": "000-000-0000"})
+            for pid in range(PATIENTS):
+                requests.post(url + "/api/new_patient",
+                              json={"patient_id": pid,
+                                    "attending_username": "Bench.B",
+                                    "patient_age": 40})
+            counts = multiprocessing.Queue()
+            procs = [multiprocessing.Process(
+                target=client, args=(url, seconds, i * 7, counts))
+                for i in range(clients)]
+            for proc in procs:
+                proc.start()
+            total = sum(counts.get() for proc in procs)
+            for proc in procs:
+                proc.join()
+        finally:
+            server.terminate()
+            server.wait()
+    return total / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    print("cpus: {}".format(os.cpu_count()))
+    base = None
+    for workers in args.workers:
+        rate = run(workers, args.clients, args.seconds)
+        base = base or rate
+        print("workers: {:3d}  ingest: {:8.0f} req/s  scaling: {:.2f}x"
+              .format(workers, rate, rate / base))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+from collections import deque
+import json
+import os
+import threading
+
+
+class Subscription:
+    """Bounded queue of events for one stream consumer
+
+    Events are pushed by the broker as they are published. If the
+    consumer falls behind and the queue fills up, the subscription is
+    dropped instead of blocking publishers or growing without bound:
+    `overflowed` is set, the events already queued can still be taken,
+    and the client is expected to reconnect and resume from the id of
+    the last event it received.
+    """
+
+    def __init__(self, broker, topic, max_queue, notify=None):
+        """Creates a subscription; use EventBroker.subscribe()
+
+        Args:
+            broker (EventBroker): broker publishing the events
+            topic (str): subscribed topic
+            max_queue (int): events that may wait for the consumer
+            notify (callable): called without arguments from the
+                               publishing thread whenever an event is
+                               queued or the subscription ends, e.g. to
+                               wake an event loop
+        """
+        self.broker = broker
+        self.topic = topic
+        self.max_queue = max_queue
+        self.notify = notify
+        self.overflowed = False
+        self.closed = False
+        self._events = deque()
+        self._cond = threading.Condition()
+
+    def get(self, timeout=None):
+        """Takes the next event, waiting for one if needed
+
+        Args:
+            timeout (float): seconds to wait, None waits forever
+
+        Returns:
+            tuple: (event id, event type, json data) or None if nothing
+                   arrived in time or the subscription has ended
+        """
+        with self._cond:
+            if not self._events and not self.ended():
+                self._cond.wait(timeout)
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def get_nowait(self):
+        """Takes the next queued event without waiting
+
+        Returns:
+            tuple: (event id, event type, json data) or None
+        """
+        with self._cond:
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def ended(self):
+        """Tells whether no further events will be queued
+
+        Returns:
+            bool: True once closed or dropped for overflowing
+        """
+        return self.closed or self.overflowed
+
+    def close(self):
+        """Stops delivery and removes the subscription from the broker"""
+        self.broker.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self.notify is not None:
+            self.notify()
+
+    def _push(self, event):
+        with self._cond:
+            if self.ended():
+                return False
+            if len(self._events) >= self.max_queue:
+                self.overflowed = True
+                self._cond.notify_all()
+            else:
+                self._events.append(event)
+                self._cond.notify_all()
+        if self.notify is not None:
+            self.notify()
+        return not self.overflowed
+
+
+class EventBroker:
+    """Publishes live events to per-topic subscribers
+
+    Every published event gets an id of the form "<epoch>-<seq>" where
+    epoch identifies this broker instance and seq increases with every
+    event. Each topic that has ever been subscribed keeps its last
+    `history` events in a ring buffer, so a client reconnecting with
+    the id of the last event it received (the SSE Last-Event-ID) is
+    first sent everything it missed. When the missed events are no
+    longer buffered, or the id comes from another broker instance
+    (e.g. before a restart), the client is sent a "reset" event
+    instead, telling it to reload its state before following the live
+    events.
+
+    Topics nobody has subscribed to keep no buffer, so publishing to
+    them costs a dict lookup; a client resuming a topic from before its
+    buffer existed is sent a reset.
+    """
+
+    RESET = "reset"
+
+    def __init__(self, history=1000, max_queue=256):
+        """Configures the broker
+
+        Args:
+            history (int): events kept per topic for resuming clients
+            max_queue (int): events that may wait for one subscriber
+                             before it is dropped
+        """
+        self.history = history
+        self.max_queue = max_queue
+        self.epoch = os.urandom(4).hex()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._buffers = {}
+        self._evicted = {}
+        self._subscribers = {}
+        self.dropped = 0
+
+    def publish(self, topics, event_type, data):
+        """Publishes one event to several topics
+
+        The data is encoded once and shared by every topic and
+        subscriber.
+
+        Args:
+            topics (list): topic names, e.g. "patient:1"
+            event_type (str): SSE event name
+            data (dict): json-serializable event payload
+
+        Returns:
+            str: id of the published event, None if no topic had ever
+                 been subscribed
+        """
+        with self._lock:
+            topics = [x for x in topics if x in self._buffers]
+            if not topics:
+                return None
+            self._seq += 1
+            event = ("{}-{}".format(self.epoch, self._seq), event_type,
+                     json.dumps(data, separators=(",", ":")))
+            for topic in topics:
+                buffer = self._buffers[topic]
+                if len(buffer) == buffer.maxlen:
+                    self._evicted[topic] = buffer[0][0]
+                buffer.append(event)
+                for subscriber in list(self._subscribers[topic]):
+                    if not subscriber._push(event):
+                        self._subscribers[topic].discard(subscriber)
+                        self.dropped += 1
+        return event[0]
+
+    def subscribe(self, topic, last_event_id=None, notify=None):
+        """Starts following a topic
+
+        Args:
+            topic (str): topic name
+            last_event_id (str): id of the last event the client
+                                 received, to resume after it
+            notify (callable): see Subscription
+
+        Returns:
+            Subscription: subscription already holding any replayed
+                          events
+        """
+        subscription = Subscription(self, topic, self.max_queue, notify)
+        with self._lock:
+            buffer = self._buffers.get(topic)
+            if buffer is None:
+                buffer = self._buffers[topic] = deque(maxlen=self.history)
+                self._subscribers[topic] = set()
+                # Nothing published before now was kept for the topic
+                self._evicted[topic] = self._current_id()
+            if last_event_id is not None:
+                for event in self._replay(topic, buffer, last_event_id):
+                    subscription._events.append(event)
+            self._subscribers[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a subscription, keeping its topic's buffer"""
+        with self._lock:
+            self._subscribers.get(subscription.topic, set()).discard(
+                subscription)
+
+    def subscriber_count(self, topic=None):
+        """Counts current subscribers
+
+        Args:
+            topic (str): only count this topic, None counts all
+
+        Returns:
+            int: number of subscriptions
+        """
+        with self._lock:
+            if topic is not None:
+                return len(self._subscribers.get(topic, ()))
+            return sum(len(x) for x in self._subscribers.values())
+
+    def _replay(self, topic, buffer, last_event_id):
+        seq = self._parse_id(last_event_id)
+        evicted = self._parse_id(self._evicted.get(topic))
+        if seq is None or seq > self._seq or \
+                (evicted is not None and seq < evicted):
+            return [(self._current_id(), self.RESET, "{}")]
+        return [x for x in buffer if self._parse_id(x[0]) > seq]
+
+    def _parse_id(self, event_id):
+        # Gives the sequence number of an id issued by this broker
+        if event_id is None:
+            return None
+        epoch, _, seq = event_id.partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _current_id(self):
+        return "{}-{}".format(self.epoch, self._seq)
+
+
+def format_event(event):
+    """Renders an event in the text/event-stream format
+
+    Args:
+        event (tuple): (event id, event type, json data)
+
+    Returns:
+        str: SSE message ending with a blank line
+    """
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(*event)
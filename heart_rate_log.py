@@ -0,0 +1,510 @@
+from array import array
+import base64
+from bisect import bisect_left, bisect_right
+from datetime import datetime as dt
+from itertools import accumulate, count
+import re
+import sys
+import threading
+import time
+from tachycardia import classify_column, count_changes
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+STATUS_LABELS = ("not tachycardic", "tachycardic")
+STATUS_CODES = {label: code for code, label in enumerate(STATUS_LABELS)}
+# Epoch milliseconds of 9999-12-31 00:00 UTC; later times cannot be
+# rendered in every time zone
+MAX_TIMESTAMP = 253402214400000
+# Local minutes rendered by format_timestamp, kept until this many
+PREFIX_CACHE_SIZE = 4096
+TIMESTAMP_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2} "
+                               r"[0-9]{2}:[0-9]{2}:[0-9]{2}")
+SECONDS = ["{:02d}".format(x) for x in range(60)]
+_minute_prefixes = {}
+_log_tokens = count(1)
+
+
+def now_timestamp():
+    """Gives the current time as stored
+
+    Returns:
+        int: epoch milliseconds
+    """
+    return time.time_ns() // 1000000
+
+
+def format_timestamp(timestamp):
+    """Renders a stored timestamp as "%Y-%m-%d %H:%M:%S" local time
+
+    Readings arrive many to a minute, so the rendered date, hour and
+    minute are kept per minute and only the seconds are appended.
+    Minutes whose local time is not a whole number of minutes away
+    from UTC, or changes offset partway, are rendered in full.
+
+    Args:
+        timestamp (int): epoch milliseconds
+
+    Returns:
+        str: local time, e.g. "2018-03-09 11:00:36"
+    """
+    seconds = timestamp // 1000
+    minute, second = divmod(seconds, 60)
+    prefix = _minute_prefixes.get(minute)
+    if prefix is None:
+        first = time.localtime(minute * 60)
+        last = time.localtime(minute * 60 + 59)
+        if first.tm_sec != 0 or last.tm_sec != 59 or \
+                last.tm_min != first.tm_min:
+            return time.strftime(TIMESTAMP_FORMAT, time.localtime(seconds))
+        prefix = time.strftime("%Y-%m-%d %H:%M:", first)
+        if len(_minute_prefixes) >= PREFIX_CACHE_SIZE:
+            _minute_prefixes.clear()
+        _minute_prefixes[minute] = prefix
+    return prefix + SECONDS[second]
+
+
+def parse_timestamp_string(text):
+    """Parses a "%Y-%m-%d %H:%M:%S" local time into a stored timestamp
+
+    Zero-padded strings, the format every client sends, are parsed
+    with datetime.fromisoformat; anything else goes through strptime
+    so exactly the same strings are accepted as before.
+
+    Args:
+        text (str): local time, e.g. "2018-03-09 11:00:36"
+
+    Returns:
+        int: epoch milliseconds
+
+    Raises:
+        ValueError: if text is not a valid timestamp
+    """
+    if TIMESTAMP_PATTERN.fullmatch(text):
+        local = dt.fromisoformat(text)
+    else:
+        local = dt.strptime(text, TIMESTAMP_FORMAT)
+    return int(local.timestamp()) * 1000
+
+
+def render_reading(heart_rate, status_code, timestamp):
+    """Renders stored reading fields as a legacy reading dict
+
+    Args:
+        heart_rate (int): HR in bpm
+        status_code (int): index into STATUS_LABELS
+        timestamp (int): epoch milliseconds of the reading
+
+    Returns:
+        dict: {"heart_rate": int, "status": str, "timestamp": str}
+    """
+    return {"heart_rate": heart_rate,
+            "status": STATUS_LABELS[status_code],
+            "timestamp": format_timestamp(timestamp)}
+
+
+class HeartRateLog:
+    """Columnar storage for the heart rate readings of one patient
+
+    Readings are kept in three parallel typed arrays instead of a list
+    of dicts: heart rates as unsigned 16-bit integers, timestamps as
+    int64 epoch milliseconds and tachycardic status as one byte per
+    reading. A reading costs 11 bytes of payload rather than a few
+    hundred for a dict holding an int and two strings. Timestamps are
+    only formatted as strings when a reading is rendered.
+
+    Readings are kept sorted by timestamp alongside a running prefix
+    sum of heart rates (hr_prefix[i] is the sum of the first i heart
+    rates), so the sum over any time range is one binary search on
+    the timestamp column plus a subtraction. Minimum, maximum and
+    tachycardic count are maintained as readings arrive so summary
+    queries never walk the columns.
+
+    Indexing and iteration still produce the legacy reading dict
+    {"heart_rate": int, "status": str, "timestamp": str}, so existing
+    routes render the same JSON, and a log compares equal to the list
+    of reading dicts it represents.
+
+    Each log carries its own re-entrant lock, taken by every method
+    that touches the columns, so one patient's readings are stored one
+    at a time and never read half-updated, while the logs of different
+    patients are written in parallel. A caller that must order other
+    work with an append (e.g. the write-ahead log) holds `lock` around
+    both.
+
+    A log's `token` identifies it for the life of the process and its
+    `generation` increases whenever stored readings change other than
+    by an append at the end (an out of order insert or a status change
+    on reclassify). Readings read at one generation therefore stay the
+    same until the next, which lets encoded readings be cached by
+    position, see serialization.encode_page.
+    """
+
+    __slots__ = ("heart_rates", "times", "statuses", "hr_prefix",
+                 "hr_min", "hr_max", "tach_count", "lock", "token",
+                 "generation")
+
+    def __init__(self):
+        self.heart_rates = array("H")
+        self.times = array("q")
+        self.statuses = bytearray()
+        self.hr_prefix = array("q", [0])
+        self.hr_min = None
+        self.hr_max = None
+        self.tach_count = 0
+        self.lock = threading.RLock()
+        self.token = next(_log_tokens)
+        self.generation = 0
+
+    @classmethod
+    def from_records(cls, records):
+        """Builds a log from a list of legacy reading dicts
+
+        Args:
+            records (list): dicts with "heart_rate", "status" and
+                            "timestamp" ("%Y-%m-%d %H:%M:%S") keys
+
+        Returns:
+            HeartRateLog: log holding the same readings
+        """
+        log = cls()
+        for record in records:
+            log.append(record["heart_rate"], record["status"],
+                       parse_timestamp_string(record["timestamp"]))
+        return log
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Builds a log from columns produced by to_columns()
+
+        The aggregates are recomputed from the restored columns.
+        Snapshots written before timestamps were stored as epoch
+        milliseconds hold float64 epoch seconds, which are converted.
+
+        Args:
+            columns (dict): output of to_columns()
+
+        Returns:
+            HeartRateLog: log holding the same readings
+        """
+        log = cls()
+        times = array("q" if columns.get("time_unit") == "ms" else "d")
+        log.heart_rates.frombytes(base64.b64decode(columns["heart_rates"]))
+        times.frombytes(base64.b64decode(columns["times"]))
+        log.statuses.extend(base64.b64decode(columns["statuses"]))
+        if columns["byteorder"] != sys.byteorder:
+            log.heart_rates.byteswap()
+            times.byteswap()
+        if times.typecode == "q":
+            log.times = times
+        else:
+            log.times = array("q", (round(x * 1000) for x in times))
+        log.hr_prefix = array("q", accumulate(log.heart_rates, initial=0))
+        if len(log.heart_rates):
+            log.hr_min = min(log.heart_rates)
+            log.hr_max = max(log.heart_rates)
+        log.tach_count = log.statuses.count(1)
+        return log
+
+    def to_columns(self):
+        """Encodes the raw columns compactly for snapshots
+
+        Returns:
+            dict: base64 strings of the heart rate, timestamp and
+                  status column bytes, the byte order they use and the
+                  timestamp unit ("ms")
+        """
+        return self.encode_columns(self.column_bytes())
+
+    def column_bytes(self):
+        """Copies the raw columns, for encoding later with
+        encode_columns()
+
+        Copying is a memcpy per column, so a snapshot can take the
+        copies while mutations are held off and leave the slower
+        base64 encoding until they resume.
+
+        Returns:
+            tuple: heart rate, timestamp and status column bytes
+        """
+        with self.lock:
+            return (self.heart_rates.tobytes(), self.times.tobytes(),
+                    bytes(self.statuses))
+
+    @staticmethod
+    def encode_columns(column_bytes):
+        """Encodes column bytes copied by column_bytes()
+
+        Args:
+            column_bytes (tuple): output of column_bytes()
+
+        Returns:
+            dict: columns in the format of to_columns()
+        """
+        heart_rates, times, statuses = column_bytes
+        return {"heart_rates": base64.b64encode(heart_rates).decode(),
+                "times": base64.b64encode(times).decode(),
+                "statuses": base64.b64encode(statuses).decode(),
+                "byteorder": sys.byteorder,
+                "time_unit": "ms"}
+
+    def append(self, heart_rate, status, timestamp):
+        """Stores a new reading in timestamp order
+
+        Readings normally arrive in time order and are appended in
+        constant time. A reading older than the latest stored one
+        (e.g. after a clock adjustment) is inserted at its sorted
+        position and the prefix sums after it are rebuilt.
+
+        Args:
+            heart_rate (int): HR in bpm, 0-65535
+            status (str): "tachycardic" or "not tachycardic"
+            timestamp (int): epoch milliseconds of the reading
+        """
+        code = STATUS_CODES[status]
+        with self.lock:
+            # The heart rate column is written first, so an out of
+            # range value is rejected before anything else changes
+            times = self.times
+            if len(times) == 0 or timestamp >= times[-1]:
+                self.heart_rates.append(heart_rate)
+                times.append(timestamp)
+                self.statuses.append(code)
+                self.hr_prefix.append(self.hr_prefix[-1] + heart_rate)
+            else:
+                index = bisect_right(times, timestamp)
+                self.heart_rates.insert(index, heart_rate)
+                times.insert(index, timestamp)
+                self.statuses.insert(index, code)
+                prefix = self.hr_prefix
+                prefix.append(0)
+                for i in range(index, len(times)):
+                    prefix[i + 1] = prefix[i] + self.heart_rates[i]
+                self.generation += 1
+            if self.hr_min is None or heart_rate < self.hr_min:
+                self.hr_min = heart_rate
+            if self.hr_max is None or heart_rate > self.hr_max:
+                self.hr_max = heart_rate
+            self.tach_count += code
+
+    def total(self):
+        """Gives the sum of every stored heart rate
+
+        Returns:
+            int: heart rate total
+        """
+        with self.lock:
+            return self.hr_prefix[-1]
+
+    def average(self):
+        """Gives the integer average of every stored heart rate
+
+        Returns:
+            int: rounded down average, 0 if the log is empty
+        """
+        with self.lock:
+            if len(self.heart_rates) == 0:
+                return 0
+            return int(self.hr_prefix[-1]/len(self.heart_rates))
+
+    def summary(self):
+        """Gives the running aggregates of the log
+
+        Returns:
+            dict: count, average, min, max, tachycardic_count,
+                  tachycardic_fraction and the latest reading (empty
+                  list if no readings, like get_last_heart_rate)
+        """
+        with self.lock:
+            count = len(self.heart_rates)
+            return {"count": count,
+                    "average": self.average(),
+                    "min": self.hr_min,
+                    "max": self.hr_max,
+                    "tachycardic_count": self.tach_count,
+                    "tachycardic_fraction":
+                        self.tach_count/count if count else 0.0,
+                    "last": self.reading(-1) if count else []}
+
+    def index_at(self, timestamp):
+        """Finds the first reading taken at or after a timestamp
+
+        Args:
+            timestamp (int): epoch milliseconds
+
+        Returns:
+            int: index of the first reading with time >= timestamp,
+                 len(self) if there is none
+        """
+        with self.lock:
+            return bisect_left(self.times, timestamp)
+
+    def values(self, since=None):
+        """Gives the stored heart rates in time order
+
+        Args:
+            since (int): if given, only heart rates taken at or after
+                         this epoch millisecond are included
+
+        Returns:
+            list: heart rate values
+        """
+        with self.lock:
+            if since is None:
+                return self.heart_rates.tolist()
+            return self.heart_rates[self.index_at(since):].tolist()
+
+    def page(self, since=None, until=None, after=None, limit=None):
+        """Gives one page of readings in time order
+
+        The bounds are found by binary search on the timestamp column,
+        so a page costs the same however long the log is.
+
+        Args:
+            since (int): epoch millisecond the range starts at, included
+            until (int): epoch millisecond the range ends at, excluded
+            after (tuple): (timestamp, skip) position returned with the
+                           previous page; the page starts at the
+                           skip-th reading taken at timestamp
+            limit (int): most readings returned, None for all
+
+        Returns:
+            tuple: (list of (heart rate, status code, timestamp),
+                    position of the next page or None if this page
+                    ends the range)
+        """
+        return self.indexed_page(since, until, after, limit)[:2]
+
+    def indexed_page(self, since=None, until=None, after=None, limit=None):
+        """Gives one page of readings with where it was read from
+
+        Args:
+            see page()
+
+        Returns:
+            tuple: (rows, next position) as from page(), then the index
+                   of the first row and the log's generation when read
+        """
+        with self.lock:
+            times = self.times
+            start = 0 if since is None else bisect_left(times, since)
+            if after is not None:
+                start = max(start, bisect_left(times, after[0]) + after[1])
+            stop = len(times) if until is None else bisect_left(times, until)
+            end = stop if limit is None else min(stop, start + limit)
+            rows = list(zip(self.heart_rates[start:end],
+                            self.statuses[start:end], times[start:end]))
+            position = None
+            if end < stop:
+                last = times[end - 1]
+                position = (last, end - bisect_left(times, last))
+            return rows, position, start, self.generation
+
+    def reclassify(self, after, size, limit):
+        """Recomputes the status of a run of readings against a new
+        threshold, vectorized when NumPy is available
+
+        Runs are resumed from a (timestamp, skip) key as page() cursors
+        are, not from an index, so readings inserted out of order
+        between runs neither shift a reading into a second run nor out
+        of every run.
+
+        Args:
+            after (tuple): (timestamp, skip) key returned by the previous
+                           run, None to start with the oldest reading
+            size (int): most readings to reclassify
+            limit (int): highest normal heart rate for the patient's age
+
+        Returns:
+            tuple: (key of the next run or None if the run ended the
+                    log, readings reclassified, statuses changed)
+        """
+        with self.lock:
+            times = self.times
+            start = 0 if after is None else \
+                bisect_left(times, after[0]) + after[1]
+            end = min(len(times), start + size)
+            if start >= end:
+                return None, 0, 0
+            codes = classify_column(self.heart_rates[start:end], limit)
+            old = self.statuses[start:end]
+            changed = count_changes(codes, old)
+            self.tach_count += codes.count(1) - old.count(1)
+            self.statuses[start:end] = codes
+            if changed:
+                self.generation += 1
+            position = None
+            if end < len(times):
+                last = times[end - 1]
+                position = (last, end - bisect_left(times, last))
+            return position, end - start, changed
+
+    def sum_since(self, timestamp):
+        """Sums the heart rates taken at or after a timestamp
+
+        Args:
+            timestamp (int): epoch milliseconds
+
+        Returns:
+            tuple (int, int): (number of readings, heart rate total)
+        """
+        with self.lock:
+            index = self.index_at(timestamp)
+            prefix = self.hr_prefix
+            return len(self.times) - index, prefix[-1] - prefix[index]
+
+    def reading(self, index):
+        """Renders one stored reading as a legacy reading dict
+
+        Args:
+            index (int): position of the reading, negative allowed
+
+        Returns:
+            dict: {"heart_rate": int, "status": str, "timestamp": str}
+        """
+        with self.lock:
+            heart_rate = self.heart_rates[index]
+            status_code = self.statuses[index]
+            timestamp = self.times[index]
+        return render_reading(heart_rate, status_code, timestamp)
+
+    def to_list(self):
+        """Renders every stored reading as a list of reading dicts
+
+        Returns:
+            list: reading dicts in storage order
+        """
+        with self.lock:
+            rows = list(zip(self.heart_rates, self.statuses, self.times))
+        return [render_reading(*x) for x in rows]
+
+    def __len__(self):
+        return len(self.heart_rates)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            with self.lock:
+                rows = list(zip(self.heart_rates[index],
+                                self.statuses[index], self.times[index]))
+            return [render_reading(*x) for x in rows]
+        return self.reading(index)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        if isinstance(other, HeartRateLog):
+            return self._columns() == other._columns()
+        if isinstance(other, list):
+            return self.to_list() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+    def _columns(self):
+        # Copies taken under the lock, so two logs are never locked at
+        # once when compared
+        with self.lock:
+            return (self.heart_rates.tobytes(), self.times.tobytes(),
+                    bytes(self.statuses))
@@ -0,0 +1,347 @@
+import glob
+import json
+import logging
+import os
+import threading
+
+
+SNAPSHOT_NAME = "snapshot.json"
+SEGMENT_PATTERN = "wal-{:020d}.log"
+
+
+class SharedExclusiveLock:
+    """Lock held shared by any number of mutators or exclusively by
+    one snapshot
+
+    Mutations take it shared so they never wait on each other, while a
+    snapshot takes it exclusively to see a state that contains exactly
+    the journaled mutations.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            self._shared += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._shared -= 1
+            if self._shared == 0:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            while self._exclusive:
+                self._cond.wait()
+            self._exclusive = True
+            while self._shared:
+                self._cond.wait()
+
+    def release_exclusive(self):
+        with self._cond:
+            self._exclusive = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire_shared()
+        return self
+
+    def __exit__(self, *exc):
+        self.release_shared()
+
+
+class Journal:
+    """Write-ahead log of server mutations with periodic snapshots
+
+    Every mutation is appended to the current log segment as one json
+    line carrying a sequence number. A single writer thread drains
+    pending records, writes them and issues one fsync for the whole
+    group, so concurrent requests share the cost of a flush (group
+    commit).
+
+    Every `snapshot_every` records a snapshot of the full state is
+    written in the background, a new log segment is started and older
+    segments are deleted. Recovery loads the latest snapshot and
+    replays only the records logged after it.
+
+    Usage from a mutating helper:
+
+        with journal.gate:
+            seq = journal.log(record)
+            ... apply the mutation in memory ...
+        journal.wait(seq)
+    """
+
+    def __init__(self, data_dir, capture_state, snapshot_every=100000,
+                 fsync=True, encode_state=None):
+        """Opens the journal directory without recovering it
+
+        Args:
+            data_dir (str): directory for log segments and snapshots
+            capture_state (callable): returns the state to snapshot;
+                                      called while mutations are held
+                                      off, so it should only copy
+            snapshot_every (int): records between automatic snapshots,
+                                  None disables them
+            fsync (bool): fsync every group commit
+            encode_state (callable): turns the captured state into the
+                                     json-serializable snapshot, called
+                                     after mutations resume; by default
+                                     the captured state is written as is
+        """
+        self.data_dir = data_dir
+        self.capture_state = capture_state
+        self.encode_state = encode_state
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.gate = SharedExclusiveLock()
+        self.seq = 0
+        self.durable_seq = 0
+        self._since_snapshot = 0
+        self._snapshotting = False
+        self._rotate_after = None
+        self._snapshot_lock = threading.Lock()
+        self._pending = []
+        self._error = None
+        self._cond = threading.Condition()
+        self._file = None
+        self._writer = None
+        self._closed = False
+        os.makedirs(data_dir, exist_ok=True)
+
+    def recover(self, restore_state, apply_record):
+        """Rebuilds state from the latest snapshot and the log tail,
+        then opens a new log segment for appends
+
+        A torn record left by a crash ends the replay and is truncated
+        from its segment, together with anything logged after it, so
+        new records are never appended behind it.
+
+        Args:
+            restore_state (callable): called with the snapshot state,
+                                      if a snapshot exists
+            apply_record (callable): called with every record logged
+                                     after the snapshot, in order
+
+        Returns:
+            int: number of log records replayed
+        """
+        snapshot_seq = 0
+        path = os.path.join(self.data_dir, SNAPSHOT_NAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            snapshot_seq = snapshot["seq"]
+            restore_state(snapshot["state"])
+        self.seq = snapshot_seq
+        replayed = 0
+        segments = self._segments()
+        for n, segment in enumerate(segments):
+            torn_at = None
+            with open(segment, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("record is missing its newline")
+                        record = json.loads(line)
+                    except ValueError:
+                        torn_at = offset
+                        break
+                    offset += len(line)
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    apply_record(record)
+                    self.seq = record["seq"]
+                    replayed += 1
+            if torn_at is not None:
+                self._truncate_torn(segment, torn_at, segments[n + 1:])
+                break
+        self.durable_seq = self.seq
+        self._since_snapshot = replayed
+        self._open_segment()
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="journal-writer", daemon=True)
+        self._writer.start()
+        logging.info('Recovered journal at sequence {} ({} records '
+                     'replayed)'.format(self.seq, replayed))
+        return replayed
+
+    def log(self, record):
+        """Queues a mutation record for the group commit
+
+        Must be called while holding `gate`, in the same critical
+        section that applies the mutation.
+
+        Args:
+            record (dict): json-serializable mutation, given an added
+                           "seq" key
+
+        Returns:
+            int: sequence number to pass to wait()
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("journal is closed")
+            self.seq += 1
+            record["seq"] = self.seq
+            self._pending.append(json.dumps(record, separators=(",", ":")))
+            self._since_snapshot += 1
+            self._cond.notify_all()
+            seq = self.seq
+            start_snapshot = (self.snapshot_every is not None and
+                              self._since_snapshot >= self.snapshot_every
+                              and not self._snapshotting)
+            if start_snapshot:
+                self._snapshotting = True
+        if start_snapshot:
+            threading.Thread(target=self.snapshot, name="journal-snapshot",
+                             daemon=True).start()
+        return seq
+
+    def wait(self, seq):
+        """Blocks until the record with sequence number seq is durable
+
+        Args:
+            seq (int): sequence number returned by log()
+        """
+        with self._cond:
+            while self.durable_seq < seq and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+
+    def snapshot(self):
+        """Writes a snapshot of the current state and drops the log
+        segments it covers
+
+        Returns:
+            int: sequence number covered by the snapshot
+        """
+        with self._snapshot_lock:
+            try:
+                return self._snapshot()
+            finally:
+                with self._cond:
+                    self._snapshotting = False
+
+    def _snapshot(self):
+        self.gate.acquire_exclusive()
+        try:
+            state = self.capture_state()
+            with self._cond:
+                seq = self.seq
+                self._since_snapshot = 0
+                self._rotate_after = seq
+                self._cond.notify_all()
+        finally:
+            self.gate.release_exclusive()
+        if self.encode_state is not None:
+            state = self.encode_state(state)
+        with self._cond:
+            while self._rotate_after is not None and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+        path = os.path.join(self.data_dir, SNAPSHOT_NAME)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"seq": seq, "state": state}, f,
+                      separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        for segment in self._segments():
+            if self._segment_start(segment) <= seq:
+                os.remove(segment)
+        logging.info('Wrote snapshot at sequence {}'.format(seq))
+        return seq
+
+    def close(self):
+        """Flushes pending records and stops the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._writer is not None:
+            self._writer.join()
+        if self._file is not None:
+            self._file.close()
+
+    def _truncate_torn(self, segment, offset, later_segments):
+        # A crash mid-write leaves a partial record at the end of the
+        # log. It was never acknowledged, so it is cut off here: appends
+        # after it would otherwise follow the torn bytes and be lost on
+        # the next recovery.
+        logging.warning('Truncating torn journal record in {} at byte '
+                        '{}'.format(segment, offset))
+        with open(segment, "r+b") as f:
+            f.truncate(offset)
+            f.flush()
+            os.fsync(f.fileno())
+        for path in later_segments:
+            logging.warning('Removing journal segment {} written after a '
+                            'torn record'.format(path))
+            os.remove(path)
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.data_dir, "wal-*.log")))
+
+    @staticmethod
+    def _segment_start(path):
+        return int(os.path.basename(path)[4:-4])
+
+    def _open_segment(self):
+        path = os.path.join(self.data_dir,
+                            SEGMENT_PATTERN.format(self.seq + 1))
+        self._file = open(path, "a")
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while (not self._pending and self._rotate_after is None
+                       and not self._closed):
+                    self._cond.wait()
+                if (not self._pending and self._rotate_after is None
+                        and self._closed):
+                    return
+                batch = self._pending
+                self._pending = []
+                rotate_after = self._rotate_after
+            try:
+                if rotate_after is None:
+                    self._write(batch)
+                else:
+                    # Records covered by the snapshot close the old
+                    # segment, the rest start the new one
+                    split = rotate_after - self.durable_seq
+                    self._write(batch[:split])
+                    self._file.close()
+                    self._file = open(os.path.join(
+                        self.data_dir, SEGMENT_PATTERN.format(
+                            rotate_after + 1)), "a")
+                    self._write(batch[split:])
+            except OSError as e:
+                logging.error('Journal write failed: {}'.format(e))
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.durable_seq += len(batch)
+                if rotate_after is not None:
+                    self._rotate_after = None
+                self._cond.notify_all()
+
+    def _write(self, lines):
+        if not lines:
+            return
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
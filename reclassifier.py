@@ -0,0 +1,156 @@
+from collections import OrderedDict
+import logging
+import queue
+import threading
+import time
+
+
+class Reclassifier:
+    """Background reclassification of stored heart rate statuses
+
+    A job names the patients whose stored readings must be classified
+    again, e.g. after a new threshold profile was activated or a
+    patient's age was corrected. A single daemon thread works through
+    the jobs in order, one run of at most `chunk` readings at a time,
+    by calling
+
+        step(patient_id, position, chunk, thresholds)
+            -> (next position or None, readings, statuses changed)
+
+    until it returns None for each patient. Between runs it sleeps for
+    `pause` seconds, so a patient's lock is only held for one run and
+    ingest threads keep getting the interpreter while a whole census
+    is reclassified.
+
+    The thread is started on the first submitted job. The last
+    `max_jobs` jobs are kept for inspection. When several processes
+    share the data, job ids can be handed out and job states published
+    through the storage engine with the new_job_id and on_update hooks.
+    """
+
+    def __init__(self, step, chunk=10000, pause=0.001, max_jobs=100,
+                 new_job_id=None, on_update=None):
+        """Configures the reclassifier without starting its thread
+
+        Args:
+            step (callable): reclassifies one run of a patient's
+                             readings, see above
+            chunk (int): most readings reclassified per step
+            pause (float): seconds slept between steps
+            max_jobs (int): finished jobs kept for inspection
+            new_job_id (callable): gives the id of a new job, by
+                                   default ids count up from 1
+            on_update (callable): called with a copy of a job's state
+                                  whenever it changes
+        """
+        self.step = step
+        self.chunk = chunk
+        self.pause = pause
+        self.max_jobs = max_jobs
+        self.new_job_id = new_job_id or self._count_job_id
+        self.on_update = on_update
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, patient_ids, thresholds):
+        """Queues a reclassification job
+
+        Args:
+            patient_ids (list): ids of the patients to reclassify
+            thresholds (ThresholdTable): thresholds to classify with
+
+        Returns:
+            dict: the job's state, see job()
+        """
+        job = {"job_id": self.new_job_id(),
+               "state": "queued",
+               "profile": thresholds.version,
+               "patients": len(patient_ids),
+               "patients_done": 0,
+               "readings": 0,
+               "changed": 0}
+        # Published before the thread can pick the job up, so a later
+        # state is never overwritten by this one
+        self._publish(dict(job))
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="reclassifier",
+                                                daemon=True)
+                self._thread.start()
+            self._queue.put((job, list(patient_ids), thresholds))
+            return dict(job)
+
+    def job(self, job_id):
+        """Gives the state of a job
+
+        Args:
+            job_id (int): id returned by submit()
+
+        Returns:
+            dict: job_id, state ("queued", "running", "done" or
+                  "failed"), profile version, patients to do and done,
+                  readings reclassified and statuses changed so far;
+                  None if the job is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def join(self):
+        """Blocks until every queued job has finished"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            job, patient_ids, thresholds = self._queue.get()
+            try:
+                self._update(job, state="running")
+                for patient_id in patient_ids:
+                    position = None
+                    while True:
+                        position, readings, changed = self.step(
+                            patient_id, position, self.chunk, thresholds)
+                        self._update(job, readings=readings,
+                                     changed=changed)
+                        if position is None:
+                            break
+                        time.sleep(self.pause)
+                    self._update(job, patients_done=1)
+                self._update(job, state="done")
+            except Exception:
+                logging.exception("Reclassification job {} failed"
+                                  .format(job["job_id"]))
+                self._update(job, state="failed")
+            finally:
+                self._queue.task_done()
+
+    def _count_job_id(self):
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            return job_id
+
+    def _update(self, job, state=None, **counts):
+        with self._lock:
+            if state is not None:
+                job["state"] = state
+            for key, value in counts.items():
+                job[key] += value
+            published = dict(job)
+        self._publish(published)
+
+    def _publish(self, job):
+        if self.on_update is None:
+            return
+        try:
+            self.on_update(job)
+        except Exception:
+            logging.exception("Could not publish reclassification job "
+                              "{}".format(job["job_id"]))
@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import threading
+
+
+ENTRY_OVERHEAD = 200
+
+
+class ResponseCache:
+    """Byte-bounded LRU cache of encoded GET responses
+
+    Each entry is stored with the tags of the entities it was built
+    from, e.g. ("patient", 1) or ("attending", "Smith.J"), and
+    invalidate() drops every entry carrying a tag when that entity
+    changes. When the cached bytes exceed `max_bytes`, the least
+    recently used entries are evicted.
+
+    A response computed while its entity was being changed must not be
+    cached. Callers therefore take generation(tags) before computing
+    and pass it to put(), which ignores the entry if any of its tags
+    was invalidated in between:
+
+        entry = cache.get(key)
+        if entry is None:
+            generation = cache.generation(tags)
+            entry = ... compute ...
+            cache.put(key, entry, tags, generation)
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """Creates an empty cache
+
+        Args:
+            max_bytes (int): bound on cached body bytes, plus a fixed
+                             ENTRY_OVERHEAD per entry
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._tagged = {}
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "misses": 0, "evictions": 0,
+                        "invalidations": 0}
+
+    def get(self, key):
+        """Looks up a cached response, counting a hit or a miss
+
+        Args:
+            key (tuple): route name and parameters
+
+        Returns:
+            tuple: the response given to put(), (body bytes, content
+                   type, etag) for the routes, None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counts["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counts["hits"] += 1
+            return entry[0]
+
+    def generation(self, tags):
+        """Gives the current invalidation generation of some tags
+
+        Args:
+            tags (tuple): entity tags of a response about to be built
+
+        Returns:
+            tuple: value to pass to put()
+        """
+        with self._lock:
+            return self._generation(tags)
+
+    def put(self, key, response, tags, generation):
+        """Caches a response unless its entities changed meanwhile
+
+        Args:
+            key (tuple): route name and parameters
+            response (tuple): body bytes first, e.g. (body bytes,
+                              content type, etag)
+            tags (tuple): entity tags the response was built from
+            generation (tuple): generation(tags) taken before building
+        """
+        cost = len(response[0]) + ENTRY_OVERHEAD
+        with self._lock:
+            if cost > self.max_bytes:
+                return
+            if generation != self._generation(tags):
+                return
+            self._remove(key)
+            self._entries[key] = (response, tags)
+            self.size += cost
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._counts["evictions"] += 1
+
+    def invalidate(self, *tags):
+        """Drops every response built from the given entities
+
+        Args:
+            tags: entity tags, e.g. ("patient", 1)
+        """
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+                for key in self._tagged.pop(tag, ()):
+                    if self._remove(key):
+                        self._counts["invalidations"] += 1
+
+    def clear(self):
+        """Drops every entry, e.g. when the storage engine changes"""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._tagged.clear()
+            self.size = 0
+
+    def stats(self):
+        """Gives cache counters
+
+        Returns:
+            dict: hits, misses, evictions, invalidations, entries,
+                  bytes and max_bytes
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self.size
+            stats["max_bytes"] = self.max_bytes
+            return stats
+
+    def _generation(self, tags):
+        return (self._epoch,) + tuple(self._generations.get(x, 0)
+                                      for x in tags)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        response, tags = entry
+        self.size -= len(response[0]) + ENTRY_OVERHEAD
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+        return True
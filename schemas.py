@@ -0,0 +1,159 @@
+from heart_rate_log import MAX_TIMESTAMP, parse_timestamp_string
+
+
+NOT_A_DICT = "The input was not a dictionary."
+
+
+def parse_timestamp(value):
+    """Parses a posted reading timestamp
+
+    Args:
+        value (int or str): epoch milliseconds, or local time formatted
+                            as "2018-03-09 11:00:36"
+
+    Returns:
+        int: epoch milliseconds, from 0 up to MAX_TIMESTAMP excluded
+        str: error message if value is not a valid timestamp
+    """
+    timestamp = None
+    if type(value) is int:
+        timestamp = value
+    elif type(value) is str:
+        try:
+            timestamp = parse_timestamp_string(value)
+        except ValueError:
+            pass
+    else:
+        return "The key timestamp has invalid data type"
+    if timestamp is not None and 0 <= timestamp < MAX_TIMESTAMP:
+        return timestamp
+    return "The value \"{}\" in key timestamp is not a valid " \
+           "timestamp".format(value)
+
+
+def parse_interval_time(value):
+    """Parses the posted start of a heart rate averaging interval
+
+    Args:
+        value (str): local time formatted as "2018-03-09 11:00:36"
+
+    Returns:
+        int: epoch milliseconds
+        str: error message if value is not a valid time
+    """
+    if not isinstance(value, str):
+        return "The key heart_rate_average_since has invalid data type"
+    try:
+        return parse_timestamp_string(value)
+    except ValueError:
+        return "The value \"{}\" in key heart_rate_average_since is not " \
+               "a valid timestamp".format(value)
+
+
+class Schema:
+    """Request body schema compiled into a validator
+
+    Required keys are given in the format validate_dict_input takes,
+    {key: [allowed_type, ...]}. Keys allowing both str and int are
+    coerced to int, so handlers receive typed values and never parse
+    them a second time. A required key may instead map to a converter,
+    as optional keys do, returning the converted value or an error
+    message, e.g. parse_timestamp.
+
+    Everything that does not depend on the request (allowed type sets,
+    which keys to coerce, the missing key and type error messages) is
+    worked out once when the schema is built, so routes build their
+    schema at import and validation is a single pass over the keys.
+    Error messages are those of validate_dict_input, checked in the
+    same order.
+    """
+
+    def __init__(self, required, optional=None):
+        """Compiles a schema
+
+        Args:
+            required (dict): {key: [allowed_type, ...] or converter}
+            optional (dict): {key: converter}, converter(value) giving
+                             the value or an error message
+        """
+        self.keys = tuple(required) + tuple(optional or ())
+        self._required = [
+            (key, None, False, types,
+             "The key {} is missing from input".format(key), None)
+            if callable(types) else
+            (key, frozenset(types), set(types) == {str, int}, None,
+             "The key {} is missing from input".format(key),
+             "The key {} has invalid data type".format(key))
+            for key, types in required.items()]
+        self._optional = list((optional or {}).items())
+
+    def validate(self, in_data):
+        """Validates and converts one request body
+
+        Args:
+            in_data: decoded json request body
+
+        Returns:
+            tuple: values of self.keys in order, None for an optional
+                   key which was not posted
+            str: error message if the body is invalid
+        """
+        if type(in_data) is not dict:
+            return NOT_A_DICT
+        values = []
+        for key, types, to_int, convert, missing, invalid in self._required:
+            if key not in in_data:
+                return missing
+            value = in_data[key]
+            if convert is not None:
+                value = convert(value)
+                if isinstance(value, str):
+                    return value
+            elif type(value) not in types:
+                return invalid
+            if to_int and type(value) is str:
+                try:
+                    value = int(value)
+                except ValueError:
+                    return "The value \"{}\" in key {} cannot be cast to " \
+                           "int".format(value, key)
+            values.append(value)
+        for key, convert in self._optional:
+            value = None
+            if key in in_data:
+                value = convert(in_data[key])
+                if isinstance(value, str):
+                    return value
+            values.append(value)
+        return tuple(values)
+
+    def validate_many(self, records):
+        """Validates the records of a bulk request
+
+        Args:
+            records (list): decoded json records
+
+        Returns:
+            list: for each record in order, its tuple of values or its
+                  error message, see validate()
+        """
+        validate = self.validate
+        return [validate(x) for x in records]
+
+
+# Bodies of the POST routes
+NEW_PATIENT_SCHEMA = Schema({"patient_id": [int, str],
+                             "attending_username": [str],
+                             "patient_age": [int, str]})
+NEW_ATTENDING_SCHEMA = Schema({"attending_username": [str],
+                               "attending_email": [str],
+                               "attending_phone": [str]})
+HEART_RATE_SCHEMA = Schema({"patient_id": [str, int],
+                            "heart_rate": [str, int]},
+                           {"timestamp": parse_timestamp})
+INTERVAL_AVERAGE_SCHEMA = Schema({"patient_id": [str, int],
+                                  "heart_rate_average_since":
+                                  parse_interval_time})
+ACTIVATE_PROFILE_SCHEMA = Schema({"version": [str]})
+PATIENT_AGE_SCHEMA = Schema({"patient_id": [str, int],
+                             "patient_age": [str, int]})
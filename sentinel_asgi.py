@@ -0,0 +1,623 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+from event_broker import format_event
+from serialization import encode_json
+from schemas import NEW_PATIENT_SCHEMA, NEW_ATTENDING_SCHEMA, \
+    HEART_RATE_SCHEMA, INTERVAL_AVERAGE_SCHEMA
+import sentinel_server as server
+
+
+HANDLER_THREADS = 8
+RECEIVE_TIMEOUT = 60
+
+# Storage calls may wait on a journal fsync or a SQLite lock, so
+# handlers run on a small pool while the event loop keeps serving the
+# connections. An idle or slow connection costs no thread.
+executor = ThreadPoolExecutor(max_workers=HANDLER_THREADS,
+                              thread_name_prefix="sentinel-asgi")
+
+
+def new_patient(in_data):
+    """Handles POST /api/new_patient, see sentinel_server.new_patient
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    values = NEW_PATIENT_SCHEMA.validate(in_data)
+    if isinstance(values, str):
+        return values, 400
+    patient = server.add_patient_to_database(*values)
+    if isinstance(patient, str):
+        return patient, 400
+    return "Added patient {}".format(patient["id"]), 200
+
+
+def new_attending(in_data):
+    """Handles POST /api/new_attending, see sentinel_server.new_attending
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    values = NEW_ATTENDING_SCHEMA.validate(in_data)
+    if isinstance(values, str):
+        return values, 400
+    attending = server.add_attending_to_database(*values)
+    if isinstance(attending, str):
+        return attending, 400
+    return "Added attending {}".format(attending["name"]), 200
+
+
+def heart_rate(in_data):
+    """Handles POST /api/heart_rate, see sentinel_server.heart_rate
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    values = HEART_RATE_SCHEMA.validate(in_data)
+    if isinstance(values, str):
+        return values, 400
+    pat_id, hr_info, timestamp = values
+    if not 0 <= hr_info <= server.MAX_HEART_RATE:
+        return "Heart rate {} out of range".format(hr_info), 400
+    patient = server.get_patient_from_database(pat_id)
+    if isinstance(patient, str):
+        return patient, 400
+    add_hr = server.add_heart_rate(patient, hr_info, timestamp)
+    return server.heart_rate_ack(pat_id, add_hr), 200
+
+
+def heart_rate_batch(in_data):
+    """Handles POST /api/heart_rate/batch, see
+    sentinel_server.heart_rate_batch
+
+    Args:
+        in_data (list): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    if type(in_data) is not list:
+        return "The input was not a list.", 400
+    results = server.add_heart_rate_batch(in_data)
+    rejected = sum(1 for x in results if "error" in x)
+    return {"accepted": len(results) - rejected,
+            "rejected": rejected,
+            "results": results}, 200
+
+
+def heart_rate_interval_avg(in_data):
+    """Handles POST /api/heart_rate/interval_average, see
+    sentinel_server.heart_rate_interval_avg
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    values = INTERVAL_AVERAGE_SCHEMA.validate(in_data)
+    if isinstance(values, str):
+        return values, 400
+    pat_id, interval_time = values
+    patient = server.get_patient_from_database(pat_id)
+    if isinstance(patient, str):
+        return patient, 400
+    hr_int_avg = server.heart_rate_interval_average(interval_time, patient)
+    if isinstance(hr_int_avg, str):
+        return hr_int_avg, 400
+    return hr_int_avg, 200
+
+
+def lookup_patient(patient_id):
+    """Resolves a patient id taken from a URL
+
+    Args:
+        patient_id (str): path segment holding the id
+
+    Returns:
+        dict: patient dictionary
+        tuple: (error message, 400) if the id is invalid or unknown
+    """
+    check = server.str_to_int(patient_id)
+    if not check[1]:
+        return "Invalid patient ID", 400
+    patient = server.get_patient_from_database(check[0])
+    if isinstance(patient, str):
+        return patient, 400
+    return patient
+
+
+def status_pid(patient_id):
+    """Handles GET /api/status/<patient_id>"""
+    patient = lookup_patient(patient_id)
+    if isinstance(patient, tuple):
+        return patient
+    return server.get_last_heart_rate(patient), 200
+
+
+def heart_rate_pid(patient_id, args):
+    """Handles GET /api/heart_rate/<patient_id>, see
+    sentinel_server.heart_rate_pid"""
+    patient = lookup_patient(patient_id)
+    if isinstance(patient, tuple):
+        return patient
+    if any(x in args for x in server.HISTORY_QUERY_KEYS):
+        page = server.heart_rate_page(patient, args)
+        return page, 400 if isinstance(page, str) else 200
+    # jsonify in the Flask route sends the message for a patient with
+    # no readings as a json string, not as text
+    return server.encode_compact(server.prev_heart_rate(patient)), 200
+
+
+def heart_rate_avg_pid(patient_id):
+    """Handles GET /api/heart_rate/average/<patient_id>"""
+    patient = lookup_patient(patient_id)
+    if isinstance(patient, tuple):
+        return patient
+    if len(patient["HR_data"]) == 0:
+        return "ERROR: no heart rate values saved for patient", 400
+    return patient["HR_data"].average(), 200
+
+
+def heart_rate_summary_pid(patient_id):
+    """Handles GET /api/heart_rate/summary/<patient_id>"""
+    patient = lookup_patient(patient_id)
+    if isinstance(patient, tuple):
+        return patient
+    return patient["HR_data"].summary(), 200
+
+
+def patients_attending_username(attending_username):
+    """Handles GET /api/patients/<attending_username>"""
+    summary = server.get_attending_summary(attending_username)
+    if isinstance(summary, str):
+        return summary, 400
+    return summary, 200
+
+
+def view_alert_stats():
+    """Handles GET /api/alerts/stats"""
+    alert_stats = server.alert_policy.stats()
+    alert_stats["delivered"] = server.alert_dispatcher.sent
+    alert_stats["failed"] = server.alert_dispatcher.failed
+    alert_stats["dead_letters"] = len(server.alert_dispatcher.dead_letters)
+    return alert_stats, 200
+
+
+def view_cache_stats():
+    """Handles GET /api/cache/stats"""
+    return server.response_cache.stats(), 200
+
+
+def status():
+    """Handles GET /"""
+    return "Server is on", 200
+
+
+def cached(kind, handler, query=False):
+    """Serves a patient or attending handler's successful responses
+    from the response cache shared with the Flask routes
+
+    Args:
+        kind (str): "patient" or "attending"
+        handler (callable): "path" handler to cache
+        query (bool): whether the handler also takes the query
+                      parameters dict, see sentinel_server.cached_route
+
+    Returns:
+        callable: "cached" handler giving (status code, content type,
+                  body, ETag or None)
+    """
+    def compute(key, args):
+        result = handler(key, args) if query else handler(key)
+        status_code, content_type, body = render(result)
+        return status_code, content_type.decode(), body
+
+    def cached_handler(key, if_none_match, args):
+        variant = server.query_variant(args) if query else ()
+        return server.cached_response(handler.__name__, kind, key,
+                                      lambda: compute(key, args),
+                                      if_none_match, variant)
+    return cached_handler
+
+
+# (method, path pattern, handler, how the handler takes the request):
+# "json" handlers get the decoded body, "path" handlers the URL
+# segment, "cached" handlers the URL segment, If-None-Match header
+# and query parameters, "none" handlers nothing and "stream" handlers
+# a line iterator over the body; "events" routes name the event
+# stream kind passed to sentinel_server.open_event_stream and
+# "export" routes the database passed to export_database
+ROUTES = [
+    ("GET", r"/", status, "none"),
+    ("POST", r"/api/new_patient", new_patient, "json"),
+    ("POST", r"/api/new_attending", new_attending, "json"),
+    ("POST", r"/api/heart_rate", heart_rate, "json"),
+    ("POST", r"/api/heart_rate/batch", heart_rate_batch, "json"),
+    ("POST", r"/api/heart_rate/ndjson",
+     lambda stream: (server.ingest_ndjson(stream), 200), "stream"),
+    ("POST", r"/api/heart_rate/interval_average", heart_rate_interval_avg,
+     "json"),
+    ("GET", r"/api/status/([^/]+)", cached("patient", status_pid), "cached"),
+    ("GET", r"/api/heart_rate/average/([^/]+)",
+     cached("patient", heart_rate_avg_pid), "cached"),
+    ("GET", r"/api/heart_rate/summary/([^/]+)",
+     cached("patient", heart_rate_summary_pid), "cached"),
+    ("GET", r"/api/heart_rate/([^/]+)",
+     cached("patient", heart_rate_pid, True), "cached"),
+    ("GET", r"/api/patients/([^/]+)",
+     cached("attending", patients_attending_username), "cached"),
+    ("GET", r"/api/stream/patient/([^/]+)", "patient", "events"),
+    ("GET", r"/api/stream/attending/([^/]+)", "attending", "events"),
+    ("GET", r"/api/patient_database/", "patients", "export"),
+    ("GET", r"/api/attending_database/", "attendings", "export"),
+    ("GET", r"/api/alerts/stats", view_alert_stats, "none"),
+    ("GET", r"/api/cache/stats", view_cache_stats, "none"),
+    ("GET", r"/api/thresholds",
+     lambda: (server.threshold_state(), 200), "none"),
+    ("POST", r"/api/thresholds", server.load_profile_request, "json"),
+    ("POST", r"/api/thresholds/activate", server.activate_profile_request,
+     "json"),
+    ("POST", r"/api/reclassify", server.reclassify_request, "json"),
+    ("GET", r"/api/reclassify/([^/]+)", server.job_request, "path"),
+    ("POST", r"/api/patient_age", server.patient_age_request, "json"),
+]
+COMPILED_ROUTES = [(method, re.compile(pattern), handler, takes)
+                   for method, pattern, handler, takes in ROUTES]
+
+
+def match_route(method, path):
+    """Finds the handler for a request
+
+    Args:
+        method (str): HTTP method
+        path (str): URL path
+
+    Returns:
+        tuple: (handler, how it takes the request, path argument), or
+               (None, status, None) with status 404 or 405
+    """
+    allowed = False
+    for route_method, pattern, handler, takes in COMPILED_ROUTES:
+        match = pattern.fullmatch(path)
+        if match is None:
+            continue
+        if route_method == method:
+            return handler, takes, match.group(1) if match.groups() \
+                else None
+        allowed = True
+    return None, 405 if allowed else 404, None
+
+
+class ReceiveStream:
+    """Iterates the lines of a request body from a handler thread
+
+    Each body chunk is awaited on the event loop as the handler asks
+    for more, so a streamed upload is processed while it arrives and
+    never held in memory as a whole.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.more_body = True
+
+    def chunks(self):
+        while self.more_body:
+            message = asyncio.run_coroutine_threadsafe(
+                self.receive(), self.loop).result(RECEIVE_TIMEOUT)
+            if message["type"] == "http.disconnect":
+                return
+            self.more_body = message.get("more_body", False)
+            yield message.get("body", b"")
+
+    def __iter__(self):
+        pending = b""
+        for chunk in self.chunks():
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if pending:
+            yield pending
+
+
+async def read_body(receive):
+    """Collects the whole request body
+
+    Args:
+        receive (callable): ASGI receive channel
+
+    Returns:
+        bytes: request body
+    """
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        body.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(body)
+
+
+def render(result):
+    """Encodes a handler result like the Flask routes do
+
+    Strings are sent as text/html, bytes as already encoded json and
+    anything else as json rendered by the Flask app's json provider,
+    so both entry points give byte-identical responses.
+
+    Args:
+        result (tuple): (response body, status code)
+
+    Returns:
+        tuple: (status code, content type, body bytes)
+    """
+    body, status_code = result
+    if isinstance(body, str):
+        return status_code, b"text/html; charset=utf-8", body.encode()
+    if isinstance(body, bytes):
+        return status_code, b"application/json", body + b"\n"
+    return (status_code, b"application/json",
+            encode_json(body, server.app.json.default) + b"\n")
+
+
+async def send_response(send, status_code, content_type, body, headers=()):
+    await send({"type": "http.response.start",
+                "status": status_code,
+                "headers": [(b"content-type", content_type),
+                            (b"content-length", str(len(body)).encode())] +
+                list(headers)})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def handle_http(scope, receive, send):
+    """Serves one HTTP request
+
+    An exception raised while handling the request is logged and
+    answered with a 500 response, as Flask does, unless the response
+    had already started; the connection is then dropped.
+    """
+    started = False
+
+    async def send_tracked(message):
+        nonlocal started
+        started = True
+        await send(message)
+
+    try:
+        await dispatch(scope, receive, send_tracked)
+    except Exception:
+        logging.exception("Exception on {} [{}]".format(scope["path"],
+                                                        scope["method"]))
+        if started:
+            raise
+        await send_response(send, 500, b"text/plain; charset=utf-8",
+                            b"Internal Server Error")
+
+
+async def dispatch(scope, receive, send):
+    """Routes an HTTP request to its handler and sends the response"""
+    handler, takes, argument = match_route(scope["method"], scope["path"])
+    if handler is None:
+        message = "Not Found" if takes == 404 else "Method Not Allowed"
+        await send_response(send, takes, b"text/plain; charset=utf-8",
+                            message.encode())
+        return
+    loop = asyncio.get_running_loop()
+    if takes == "events":
+        await stream_events(scope, receive, send, handler, argument)
+        return
+    if takes == "export":
+        await stream_export(scope, send, handler)
+        return
+    if takes == "json":
+        body = await read_body(receive)
+        try:
+            in_data = json.loads(body)
+        except ValueError:
+            await send_response(send, 400, b"text/plain; charset=utf-8",
+                                b"Failed to decode JSON object")
+            return
+        call = (handler, in_data)
+    elif takes == "stream":
+        call = (handler, ReceiveStream(receive, loop))
+    elif takes == "path":
+        call = (handler, argument)
+    elif takes == "cached":
+        call = (handler, argument, header(scope, b"if-none-match"),
+                query_args(scope))
+    else:
+        call = (handler,)
+    result = await loop.run_in_executor(executor, *call)
+    if takes == "cached":
+        # Already rendered by the cache
+        status_code, content_type, body, etag = result
+        headers = []
+        if etag is not None:
+            headers = [(b"etag", etag.encode()),
+                       (b"cache-control", b"no-cache")]
+        await send_response(send, status_code, content_type.encode(), body,
+                            headers)
+    else:
+        await send_response(send, *render(result))
+
+
+def header(scope, name):
+    """Gives a request header
+
+    Args:
+        scope (dict): ASGI connection scope
+        name (bytes): lower case header name
+
+    Returns:
+        str: header value, None if not sent
+    """
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def query_args(scope):
+    """Gives the query parameters of a request
+
+    Args:
+        scope (dict): ASGI connection scope
+
+    Returns:
+        dict: first value sent for each parameter name
+    """
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    return {name: values[0] for name, values in query.items()}
+
+
+def last_event_id(scope):
+    """Gives the event id a reconnecting SSE client resumes from
+
+    Args:
+        scope (dict): ASGI connection scope
+
+    Returns:
+        str: Last-Event-ID header or last_event_id query parameter,
+             None for a new client
+    """
+    value = header(scope, b"last-event-id")
+    if value is not None:
+        return value
+    return query_args(scope).get("last_event_id")
+
+
+async def stream_events(scope, receive, send, kind, key):
+    """Serves /api/stream/<kind>/<key> as Server-Sent Events
+
+    See sentinel_server.stream_patient. The subscription wakes the
+    event loop when an event is published, so a waiting dashboard
+    costs no thread. The stream ends when the client disconnects or
+    falls too far behind.
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    subscription = await loop.run_in_executor(
+        executor, server.open_event_stream, kind, key, last_event_id(scope),
+        lambda: loop.call_soon_threadsafe(wake.set))
+    if isinstance(subscription, str):
+        await send_response(send, *render((subscription, 400)))
+        return
+    disconnected = False
+
+    async def watch_disconnect():
+        nonlocal disconnected
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected = True
+        wake.set()
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type",
+                                 b"text/event-stream; charset=utf-8"),
+                                (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")]})
+        await send({"type": "http.response.body", "more_body": True,
+                    "body": "retry: {}\n\n".format(
+                        server.EVENT_RETRY_MS).encode()})
+        while not disconnected:
+            # Cleared before draining, so an event published meanwhile
+            # sets it again and is not missed
+            wake.clear()
+            chunk = []
+            event = subscription.get_nowait()
+            while event is not None:
+                chunk.append(format_event(event))
+                event = subscription.get_nowait()
+            if chunk:
+                await send({"type": "http.response.body",
+                            "body": "".join(chunk).encode(),
+                            "more_body": True})
+                continue
+            if subscription.ended():
+                break
+            try:
+                await asyncio.wait_for(wake.wait(), server.EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await send({"type": "http.response.body",
+                            "body": b": keepalive\n\n", "more_body": True})
+        if not disconnected:
+            await send({"type": "http.response.body", "body": b""})
+    finally:
+        subscription.close()
+        watcher.cancel()
+
+
+async def stream_export(scope, send, kind):
+    """Serves a database dump route, see
+    sentinel_server.export_database
+
+    Each block is produced on the handler pool and sent before the
+    next one is read, so a slow client holds no more than one block.
+    """
+    loop = asyncio.get_running_loop()
+    compress = server.accepts_gzip(header(scope, b"accept-encoding"))
+    blocks = server.export_database(kind, compress)
+    headers = [(b"content-type", b"application/json")] + \
+        [(name.lower().encode(), value.encode())
+         for name, value in server.export_headers(compress)]
+    await send({"type": "http.response.start", "status": 200,
+                "headers": headers})
+    while True:
+        block = await loop.run_in_executor(executor, next, blocks, None)
+        if block is None:
+            break
+        await send({"type": "http.response.body", "body": block,
+                    "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            server.configure_storage_from_env()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            server.storage.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point serving the same /api routes as the Flask app
+
+    Run it with any ASGI server, e.g.
+
+        uvicorn sentinel_asgi:app --port 5000
+
+    Connections are held by the event loop, so thousands of bedside
+    monitors and dashboards can stay connected without a thread
+    each. Requests are handled by the same database helpers, storage
+    engine and alert dispatcher as sentinel_server, and tachycardia
+    emails are queued to the dispatcher without blocking. Storage is
+    configured from the environment at lifespan startup, as
+    sentinel_server does when run directly.
+    """
+    if scope["type"] == "http":
+        await handle_http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
@@ -1,13 +1,145 @@
 from typing import Type
-from flask import Flask, request, jsonify
-import requests
-from datetime import datetime as dt
+from flask import Flask, Response, current_app, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+import base64
+import functools
 import logging
+import json
+import os
+import threading
+import zlib
+from heart_rate_log import STATUS_LABELS, \
+    format_timestamp, now_timestamp, parse_timestamp_string
+from serialization import encode_json, encode_page
+from storage import MemoryStorage, SQLiteStorage
+from alert_dispatcher import AlertDispatcher
+from alert_policy import AlertPolicy
+from event_broker import EventBroker, format_event
+from response_cache import ResponseCache
+from tachycardia import DEFAULT_THRESHOLDS, ThresholdTable, \
+    classify_column
+from reclassifier import Reclassifier
+from schemas import Schema, NEW_PATIENT_SCHEMA, NEW_ATTENDING_SCHEMA, \
+    HEART_RATE_SCHEMA, INTERVAL_AVERAGE_SCHEMA, ACTIVATE_PROFILE_SCHEMA, \
+    PATIENT_AGE_SCHEMA
+
+
+MAX_HEART_RATE = 65535
+EMAIL_SERVER_URL = "http://vcm-7631.vm.duke.edu:5007/hrss/send_email"
+ALERT_REPEAT_WINDOW = 300
+ALERT_DIGEST_INTERVAL = 60
+NDJSON_CHUNK_SIZE = 1000
+NDJSON_MAX_ERRORS = 100
+SNAPSHOT_EVERY = 100000
+EVENT_HISTORY = 1000
+EVENT_QUEUE = 256
+EVENT_KEEPALIVE = 15
+EVENT_RETRY_MS = 2000
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+HISTORY_QUERY_KEYS = ("since", "until", "limit", "cursor", "fields")
+EXPORT_READINGS = 1000
+EXPORT_BLOCK_BYTES = 64 * 1024
+RECLASSIFY_CHUNK = 10000
+RECLASSIFY_PAUSE = 0.001
+
+
+class SentinelJSONProvider(DefaultJSONProvider):
+    """JSON provider which renders heart rate series (HeartRateLog
+    columns or SQLite-backed series) as the legacy list of reading
+    dicts
+
+    Compact responses, the default outside debug mode, are encoded by
+    serialization.encode_json, so jsonify uses orjson when it is
+    installed and responses are built from bytes directly. Indented
+    responses and dumps() are left to DefaultJSONProvider.
+    """
+
+    @staticmethod
+    def default(o):
+        if hasattr(o, "to_list"):
+            return o.to_list()
+        return DefaultJSONProvider.default(o)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and current_app.debug) or \
+                self.compact is False:
+            return super().response(*args, **kwargs)
+        # The arguments are taken as jsonify documents
+        if args and kwargs:
+            raise TypeError("jsonify() takes either args or kwargs, "
+                            "not both")
+        obj = args[0] if len(args) == 1 else args or kwargs or None
+        return current_app.response_class(
+            encode_json(obj, self.default) + b"\n", mimetype=self.mimetype)
 
 
 app = Flask(__name__)
-attending_database = []
-patient_database = []
+app.json = SentinelJSONProvider(app)
+alert_dispatcher = AlertDispatcher(EMAIL_SERVER_URL)
+alert_policy = AlertPolicy(ALERT_REPEAT_WINDOW, ALERT_DIGEST_INTERVAL,
+                           on_digest=lambda att, entries:
+                           tach_digest_email(att, entries))
+# The in-memory engine's registries stay importable as
+# patient_database / attending_database
+storage = MemoryStorage()
+attending_database = storage.attendings
+patient_database = storage.patients
+event_broker = EventBroker(EVENT_HISTORY, EVENT_QUEUE)
+# Latest (epoch ms timestamp, status) published per patient id, to
+# detect status changes
+patient_status = {}
+patient_status_lock = threading.Lock()
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES)
+# Active thresholds and every loaded profile, by version, compiled
+# from the profiles in storage when its threshold_version() was
+# thresholds_seen, see refresh_thresholds
+tach_thresholds = DEFAULT_THRESHOLDS
+threshold_profiles = {DEFAULT_THRESHOLDS.version: DEFAULT_THRESHOLDS}
+thresholds_seen = None
+threshold_lock = threading.Lock()
+reclassifier = Reclassifier(lambda *args: reclassify_step(*args),
+                            RECLASSIFY_CHUNK, RECLASSIFY_PAUSE,
+                            new_job_id=lambda: storage.new_job_id(),
+                            on_update=lambda job: storage.save_job(job))
+
+
+def cached_route(kind, query=False):
+    """Decorates a GET route of one patient or attending so its
+    successful responses are served from response_cache and tagged
+    with an ETag, see cached_response
+
+    Args:
+        kind (str): "patient" if the route takes a patient id,
+                    "attending" if it takes an attending username
+        query (bool): whether the route reads query parameters, which
+                      are then part of the cache key
+
+    Returns:
+        callable: route decorator
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            (key,) = view_args.values()
+
+            def compute():
+                response = app.make_response(view(**view_args))
+                return (response.status_code, response.content_type,
+                        response.get_data())
+            variant = query_variant(request.args.to_dict()) if query \
+                else ()
+            status_code, content_type, body, etag = cached_response(
+                view.__name__, kind, key, compute,
+                request.headers.get("If-None-Match"), variant)
+            response = Response(body, status_code, content_type=content_type)
+            if etag is not None:
+                response.headers["ETag"] = etag
+                response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
 
 
 @app.route("/", methods=["GET"])
@@ -38,27 +170,24 @@ def new_patient():
     to server
 
     Returns:
-        dict: patient dictionary added to database
+        str: "Added patient <patient_id>"
     """
     # Accept and validate input
     in_data = request.get_json()
-    expected_values = {"patient_id": [int, str],
-                       "attending_username": [str],
-                       "patient_age": [int, str]}
-    error_string, status_code = validate_dict_input(in_data, expected_values)
-    if error_string is not True:
-        return error_string, status_code
+    values = NEW_PATIENT_SCHEMA.validate(in_data)
+    if type(values) == str:
+        return values, 400
 
     # It is noted that attending_username will already exist
     # within attending database
 
     # External method handlers
-    new_patient = add_patient_to_database(in_data["patient_id"],
-                                          in_data["attending_username"],
-                                          in_data["patient_age"])
+    new_patient = add_patient_to_database(*values)
+    if type(new_patient) == str:
+        return new_patient, 400
 
     # Data output & return
-    return "Added patient {}".format(new_patient), 200
+    return "Added patient {}".format(new_patient["id"]), 200
 
 
 @app.route("/api/new_attending", methods=["POST"])
@@ -79,24 +208,21 @@ def new_attending():
     as specified by the add_attending_to_databasee() method
 
     Returns:
-        dict: attending dict added to database
+        str: "Added attending <attending_username>"
     """
     # Accept and validate attending input
     in_data = request.get_json()
-    expected_values = {"attending_username": [str],
-                       "attending_email": [str],
-                       "attending_phone": [str]}
-    error_string, status_code = validate_dict_input(in_data, expected_values)
-    if error_string is not True:
-        return error_string, status_code
+    values = NEW_ATTENDING_SCHEMA.validate(in_data)
+    if type(values) == str:
+        return values, 400
 
     # External methods
-    attending = add_attending_to_database(in_data["attending_username"],
-                                          in_data["attending_email"],
-                                          in_data["attending_phone"])
+    attending = add_attending_to_database(*values)
+    if type(attending) == str:
+        return attending, 400
 
     # Data output and return
-    return "Added attending {}".format(attending), 200
+    return "Added attending {}".format(attending["name"]), 200
 
 
 @app.route("/api/heart_rate", methods=["POST"])
@@ -109,39 +235,100 @@ def heart_rate():
     json request should contain a dict formatted as follows:
     {
         "patient_id": int, # Should be patient MRN
-        "heart_rate": int
+        "heart_rate": int,
+        "timestamp": int/str  # Optional, epoch milliseconds or
+                              # "2018-03-09 11:00:36", defaults to
+                              # time of posting
     }
     This method will be used to match heart-rate
     information to an existing patient,
     as specified by the patient_id
 
     Returns:
-        int: Fetched heart rate
+        str: acknowledgement with the stored heart rate, status and
+        timestamp, see heart_rate_ack
     """
     # Accept and validate id and heart rate input
     in_data = request.get_json()
-    expected_values = {"patient_id": [str, int],
-                       "heart_rate": [str, int]}
-    error_string, status_code = validate_dict_input(in_data, expected_values)
-    if error_string is not True:
-        return error_string, status_code
+    values = HEART_RATE_SCHEMA.validate(in_data)
+    if type(values) == str:
+        return values, 400
 
     # Match patient and update heart rate information
-    pat_id = str_to_int(in_data["patient_id"])[0]
-    hr_info = str_to_int(in_data["heart_rate"])[0]
+    pat_id, hr_info, timestamp = values
+    if not 0 <= hr_info <= MAX_HEART_RATE:
+        return "Heart rate {} out of range".format(hr_info), 400
     patient = get_patient_from_database(pat_id)
     if (type(patient)) == str:
         return patient, 400
 
-    add_hr = add_heart_rate(patient, hr_info)
+    add_hr = add_heart_rate(patient, hr_info, timestamp)
 
     # Data output and return
-    msg = "Added heart rate information {} for ".format(add_hr)
-    msg += "patient id {}".format(in_data["patient_id"])
-    return msg, 200
+    return heart_rate_ack(pat_id, add_hr), 200
+
+
+@app.route("/api/heart_rate/batch", methods=["POST"])
+def heart_rate_batch():
+    """Accepts json request and posts many patient heart rates
+    to server database at once.
+
+    json request should contain a list of dicts formatted as follows:
+    [
+        {
+            "patient_id": int/str,  # Should be patient MRN
+            "heart_rate": int/str,
+            "timestamp": int/str    # Optional, epoch milliseconds or
+                                    # "2018-03-09 11:00:36", defaults
+                                    # to time of posting
+        },
+        ...
+    ]
+    This method will be used by monitoring stations which collect
+    readings for many beds. Records are validated individually, and
+    an invalid record does not prevent the others from being stored.
+
+    Returns:
+        dict: {"accepted": int, "rejected": int, "results": list} where
+        results holds, in request order, either the stored reading
+        with its patient_id or {"error": str} for each record
+    """
+    in_data = request.get_json()
+    if type(in_data) is not list:
+        return "The input was not a list.", 400
+    results = add_heart_rate_batch(in_data)
+    rejected = sum(1 for x in results if "error" in x)
+    return jsonify({"accepted": len(results) - rejected,
+                    "rejected": rejected,
+                    "results": results}), 200
+
+
+@app.route("/api/heart_rate/ndjson", methods=["POST"])
+def heart_rate_ndjson():
+    """Accepts a newline-delimited json upload of heart rates and
+    posts them to server database while the body is being read.
+
+    The request body (Content-Type application/x-ndjson) should hold
+    one reading per line, formatted like a /api/heart_rate/batch
+    record:
+    {"patient_id": 1, "heart_rate": 75, "timestamp": "2018-03-09 11:00:36"}
+    This method will be used to back-fill readings after an outage.
+    The body is never parsed as a whole: lines are read from the
+    request stream and stored in chunks of NDJSON_CHUNK_SIZE, with
+    progress logged after each chunk, so memory use does not depend
+    on upload size.
+
+    Returns:
+        dict: {"lines": int, "accepted": int, "rejected": int,
+        "chunks": int, "errors": list} where errors holds up to
+        NDJSON_MAX_ERRORS {"line": int, "error": str} entries
+    """
+    summary = ingest_ndjson(request.stream)
+    return jsonify(summary), 200
 
 
 @app.route("/api/status/<patient_id>", methods=["GET"])
+@cached_route("patient")
 def status_pid(patient_id):
     """Accepts patient id and returns json containing
     latest heart rate, status, and timestamp.
@@ -183,6 +370,7 @@ def status_pid(patient_id):
 
 
 @app.route("/api/heart_rate/<patient_id>", methods=["GET"])
+@cached_route("patient", query=True)
 def heart_rate_pid(patient_id):
     """Variable URL route that accepts a patient id and
     returns a list of all previous heart rate measurements
@@ -196,8 +384,13 @@ def heart_rate_pid(patient_id):
     This method will be used to view all the previously input
     heart rates for a specified patient.
 
+    With any of the query parameters since, until, limit, cursor or
+    fields, one page of the history is returned instead, see
+    heart_rate_page.
+
     Returns:
         list: list of integers of saved heart rate values
+        dict: page of the history when queried with parameters
         string: error message string will be returned if no
         matching patient id is found in the database
     """
@@ -211,11 +404,18 @@ def heart_rate_pid(patient_id):
     if (type(patient)) == str:
         return patient, 400
 
+    args = request.args.to_dict()
+    if any(x in args for x in HISTORY_QUERY_KEYS):
+        page = heart_rate_page(patient, args)
+        if type(page) == str:
+            return page, 400
+        return Response(page + b"\n", mimetype="application/json"), 200
     hr_list = prev_heart_rate(patient)
     return jsonify(hr_list), 200
 
 
 @app.route("/api/heart_rate/average/<patient_id>", methods=["GET"])
+@cached_route("patient")
 def heart_rate_avg_pid(patient_id):
     """Variable URL route that accepts a patient id and
     returns patient's average heart rate across all measurements.
@@ -244,13 +444,49 @@ def heart_rate_avg_pid(patient_id):
     if (type(patient)) == str:
         return patient, 400
 
-    hr_list = prev_heart_rate(patient)
-    if(type(hr_list) == str):
-        return hr_list, 400
-    hr_avg = heart_rate_average(hr_list)
+    if len(patient["HR_data"]) == 0:
+        return "ERROR: no heart rate values saved for patient", 400
+    hr_avg = patient["HR_data"].average()
     return jsonify(hr_avg), 200
 
 
+@app.route("/api/heart_rate/summary/<patient_id>", methods=["GET"])
+@cached_route("patient")
+def heart_rate_summary_pid(patient_id):
+    """Variable URL route that accepts a patient id and
+    returns the running heart rate aggregates for that patient.
+
+    <patient_id> request should contain an existing pid.
+    The output will return a json dict formatted as follows:
+    {
+        "count": int,                   # number of readings
+        "average": int,                 # integer average heart rate
+        "min": int,                     # lowest heart rate (null if none)
+        "max": int,                     # highest heart rate (null if none)
+        "tachycardic_count": int,       # tachycardic readings
+        "tachycardic_fraction": float,  # tachycardic_count / count
+        "last": dict                    # latest reading, as returned by
+                                        # /api/status/<patient_id>
+    }
+    The aggregates are maintained by add_heart_rate as readings
+    arrive, so this route does not depend on history length.
+
+    Returns:
+        dict: heart rate aggregates
+        string: error message string will be returned if no
+        matching patient id is found in the database
+    """
+    check = str_to_int(patient_id)
+    if not check[1]:
+        return "Invalid patient ID", 400
+
+    patient = get_patient_from_database(check[0])
+    if type(patient) == str:
+        return patient, 400
+
+    return jsonify(patient["HR_data"].summary()), 200
+
+
 @app.route("/api/heart_rate/interval_average", methods=["POST"])
 def heart_rate_interval_avg():
     """Accepts json request and posts new patient heart rate
@@ -272,31 +508,27 @@ def heart_rate_interval_avg():
         int: heart rate interval average
     """
     in_data = request.get_json()
-    expected_values = {"patient_id": [str, int],
-                       "heart_rate_average_since": [str]}
-    error_string, status_code = validate_dict_input(in_data, expected_values)
-    if error_string is not True:
-        return error_string, status_code
+    values = INTERVAL_AVERAGE_SCHEMA.validate(in_data)
+    if type(values) == str:
+        return values, 400
 
     # print("Check 1\n")
 
-    pat_id = str_to_int(in_data["patient_id"])[0]
+    pat_id, interval_time = values
     patient = get_patient_from_database(pat_id)
     if (type(patient)) == str:
         return patient, 400
 
     # print("Check 2\n")
 
-    hr_interval = heart_rate_interval(in_data["heart_rate_average_since"],
-                                      patient)
-    if type(hr_interval) == str:
-        return hr_interval, 400
-    else:
-        hr_int_avg = heart_rate_average(hr_interval)
+    hr_int_avg = heart_rate_interval_average(interval_time, patient)
+    if type(hr_int_avg) == str:
+        return hr_int_avg, 400
     return jsonify(hr_int_avg), 200
 
 
 @app.route("/api/patients/<attending_username>", methods=["GET"])
+@cached_route("attending")
 def patients_attending_username(attending_username):
     """Accepts attending name and returns a list of patients
     that attending is responsible for by querying the database.
@@ -317,46 +549,89 @@ def patients_attending_username(attending_username):
     with provided attending. Furthermore, if no HR data was ever posted,
     last_heart_rate, last_time, and status will be empty lists.
 
+    The list is kept by the storage engine as pre-encoded json, updated
+    as patients are added and readings stored, so serving it does not
+    walk the attending's patients.
+
     Returns:
         string: json string formatted as above
     """
     # Accept and validate input
-    in_data = attending_username
-    print(in_data)
-    attending = get_attending_from_database(in_data)
-    if(type(attending) == str):
-        return attending, 400
-    if(attending not in attending_database):
-        return "ERROR: Attending not in database", 400
+    summary = get_attending_summary(attending_username)
+    if type(summary) == str:
+        return summary, 400
 
-    # External method handlers
+    # Data output & return
+    return Response(summary + b"\n", mimetype="application/json"), 200
 
-    # Assumes all patients within attending list are existing
-    # patients (since patients only added to an attending's list)
-    # with new_patient call
-    patList = []
-    pats = attending["patients"]
-
-    for pat in pats:
-        pat_info = get_last_heart_rate(pat)
-        if(len(pat_info) != 0):
-            newDict = {
-                "patient_id": pat["id"],
-                "last_heart_rate": pat_info["heart_rate"],
-                "last_time": pat_info["timestamp"],
-                "status": pat_info["status"]
-            }
-        else:
-            newDict = {
-                "patient_id": pat["id"],
-                "last_heart_rate": [],
-                "last_time": [],
-                "status": []
-            }
-        patList.append(newDict)
 
-    # Data output & return
-    return jsonify(patList), 200
+@app.route("/api/stream/patient/<patient_id>", methods=["GET"])
+def stream_patient(patient_id):
+    """Streams live heart rate events of a patient as Server-Sent
+    Events
+
+    <patient_id> request should contain an existing pid.
+    The response (Content-Type text/event-stream) stays open and
+    pushes an event whenever a heart rate is stored for the patient:
+
+    event: heart_rate
+    data: {"heart_rate": 75, "patient_id": 1, "status": "not tachycardic",
+           "timestamp": "2018-03-09 11:00:36"}
+
+    followed by a "status" event {"patient_id", "status", "previous",
+    "timestamp"} when the reading changes the patient's tachycardic
+    status. This method will be used by dashboards instead of polling
+    /api/status/<patient_id>. A reconnecting client sending the
+    Last-Event-ID header (or a last_event_id query parameter) is first
+    sent the events it missed, or a "reset" event if they are no
+    longer buffered. Clients that fall more than EVENT_QUEUE events
+    behind are disconnected and resume the same way.
+
+    Returns:
+        stream: text/event-stream of events
+        string: error message string will be returned if no
+        matching patient id is found in the database
+    """
+    subscription = open_event_stream("patient", patient_id,
+                                     last_event_id())
+    if type(subscription) == str:
+        return subscription, 400
+    return event_stream_response(subscription)
+
+
+@app.route("/api/stream/attending/<attending_username>", methods=["GET"])
+def stream_attending(attending_username):
+    """Streams live heart rate events of every patient of an
+    attending as Server-Sent Events
+
+    <attending_username> request should contain a name formatted as
+    "Lastname.Firstinitial". Events are formatted as for
+    /api/stream/patient/<patient_id>. This method will be used by
+    nurse-station dashboards instead of polling
+    /api/patients/<attending_username>.
+
+    Returns:
+        stream: text/event-stream of events
+        string: error message string will be returned if the
+        attending is not found
+    """
+    subscription = open_event_stream("attending", attending_username,
+                                     last_event_id())
+    if type(subscription) == str:
+        return subscription, 400
+    return event_stream_response(subscription)
+
+
+@app.route("/api/cache/stats", methods=["GET"])
+def view_cache_stats():
+    """Allows you to view response cache counters
+
+    Returns:
+        json: cache hits and misses, entries evicted to stay within
+        RESPONSE_CACHE_BYTES and dropped by writes, and the current
+        entry count and size
+    """
+    return jsonify(response_cache.stats()), 200
 
 
 @app.route("/api/patient_database/", methods=["GET"])
@@ -366,11 +641,14 @@ def view_patient_db():
 
     Method curated by Anuj Som
 
+    The database is streamed, see export_database, and gzip
+    compressed if the client accepts it.
+
     Returns:
         json: entire patient database
     """
     # Data output & return
-    return jsonify(patient_database), 200
+    return export_response("patients")
 
 
 @app.route("/api/attending_database/", methods=["GET"])
@@ -380,11 +658,259 @@ def view_attending_db():
 
     Method curated by Anuj Som
 
+    Attendings list the ids of their patients, which are found in
+    the patient database. The database is streamed like
+    view_patient_db.
+
     Returns:
-        json: entire patient database
+        json: entire attending database
     """
     # Data output & return
-    return jsonify(attending_database), 200
+    return export_response("attendings")
+
+
+def export_response(kind):
+    """Builds the streamed response of a database dump route
+
+    Args:
+        kind (str): "patients" or "attendings"
+
+    Returns:
+        Response: json chunks produced as the client reads them
+    """
+    compress = accepts_gzip(request.headers.get("Accept-Encoding"))
+    return Response(export_database(kind, compress),
+                    headers=export_headers(compress),
+                    mimetype="application/json")
+
+
+def export_database(kind, compress=False):
+    """Streams the patient or attending database as json
+
+    Patients are encoded one at a time and their readings
+    EXPORT_READINGS at a time, and the output is handed out in blocks
+    of about EXPORT_BLOCK_BYTES, so memory use does not grow with the
+    database. The opening bracket is sent at once, so the client
+    starts receiving before the first patient is read. The patient
+    dump is the json jsonify would give for storage.patient_list();
+    attendings hold the ids of their patients rather than the
+    patient dicts, whose readings are in the patient dump.
+
+    Args:
+        kind (str): "patients" or "attendings"
+        compress (bool): gzip the output
+
+    Yields:
+        bytes: the next block of the response body
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def block(data, final=False):
+        if compressor is None:
+            return data
+        return compressor.compress(data) + compressor.flush(
+            zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    yield block(b"[")
+    if kind == "patients":
+        items = (export_patient(x) for x in storage.iter_patients())
+    else:
+        items = ([encode_compact(x)] for x in storage.iter_attendings())
+    pending, size = [], 0
+    for i, chunks in enumerate(items):
+        if i:
+            pending.append(b",")
+        for chunk in chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= EXPORT_BLOCK_BYTES:
+                yield block(b"".join(pending))
+                pending, size = [], 0
+    pending.append(b"]\n")
+    yield block(b"".join(pending), final=True)
+
+
+def export_patient(patient):
+    """Encodes one patient for export_database
+
+    Args:
+        patient (dict): accepts patient dict containing all patient info
+
+    Yields:
+        bytes: json pieces of the patient dict
+    """
+    hr_data = patient["HR_data"]
+    # Keys are sorted, so the readings come first
+    yield b'{"HR_data":['
+    after, first = None, True
+    while True:
+        readings, after = encode_page(hr_data, after=after,
+                                      limit=EXPORT_READINGS)
+        if readings != b"[]":
+            yield readings[1:-1] if first else b"," + readings[1:-1]
+            first = False
+        if after is None:
+            break
+    fields = {k: v for k, v in patient.items() if k != "HR_data"}
+    yield b"]," + encode_compact(fields)[1:]
+
+
+def encode_compact(value):
+    """Encodes a value as jsonify does, without the trailing newline
+
+    Args:
+        value: json-serializable value
+
+    Returns:
+        bytes: compact json with sorted keys
+    """
+    return encode_json(value, app.json.default)
+
+
+def accepts_gzip(accept_encoding):
+    """Tells whether a client accepts gzip encoded responses
+
+    Args:
+        accept_encoding (str): Accept-Encoding request header, if any
+
+    Returns:
+        bool: True if gzip (or any encoding) is accepted
+    """
+    if accept_encoding is None:
+        return False
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        if name.strip().lower() not in ("gzip", "*"):
+            continue
+        quality = 1.0
+        key, _, value = params.partition("=")
+        if key.strip() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        return quality > 0
+    return False
+
+
+def export_headers(compress):
+    """Gives the extra headers of a database dump response
+
+    Args:
+        compress (bool): whether the body is gzip compressed
+
+    Returns:
+        list: (name, value) header pairs
+    """
+    headers = [("Vary", "Accept-Encoding")]
+    if compress:
+        headers.append(("Content-Encoding", "gzip"))
+    return headers
+
+
+@app.route("/api/alerts/stats", methods=["GET"])
+def view_alert_stats():
+    """Allows you to view tachycardia alert counters
+
+    Returns:
+        json: alerts emailed immediately, coalesced into digests and
+        suppressed as repeats, digests sent, and the email dispatcher's
+        delivered, failed and dead-lettered counts
+    """
+    alert_stats = alert_policy.stats()
+    alert_stats["delivered"] = alert_dispatcher.sent
+    alert_stats["failed"] = alert_dispatcher.failed
+    alert_stats["dead_letters"] = len(alert_dispatcher.dead_letters)
+    return jsonify(alert_stats), 200
+
+
+@app.route("/api/thresholds", methods=["GET"])
+def view_thresholds():
+    """Allows you to view the tachycardia threshold profiles
+
+    Returns:
+        json: {"active": version, "profiles": [profile, ...]}
+    """
+    return jsonify(threshold_state()), 200
+
+
+@app.route("/api/thresholds", methods=["POST"])
+def new_threshold_profile():
+    """Accepts json request and loads a tachycardia threshold profile
+
+    json request should contain a dict formatted as follows:
+    {
+        "version": str, # Unique name of the profile
+        "bands": [[int, int, int], ...], # [first age, end age excluded,
+                                         #  highest normal heart rate]
+        "default": int, # Highest normal heart rate of other ages
+        "activate": bool # Optional, classify new readings with the
+                         # profile, true by default
+    }
+    Readings already stored keep their status until reclassified,
+    see reclassify.
+
+    Returns:
+        str: confirmation or error message
+    """
+    return load_profile_request(request.get_json())
+
+
+@app.route("/api/thresholds/activate", methods=["POST"])
+def activate_thresholds():
+    """Accepts json request {"version": str} and classifies new
+    readings with that loaded threshold profile
+
+    Returns:
+        str: confirmation or error message
+    """
+    return activate_profile_request(request.get_json())
+
+
+@app.route("/api/reclassify", methods=["POST"])
+def reclassify():
+    """Accepts json request and starts reclassifying stored readings
+    with the active threshold profile
+
+    json request {"patient_id": int} reclassifies one patient and
+    {} every patient. The work is
+    done in the background, see reclassifier.Reclassifier.
+
+    Returns:
+        json: state of the started job, see /api/reclassify/<job_id>
+        str: error message if the patient is not found
+    """
+    return reclassify_request(request.get_json())
+
+
+@app.route("/api/reclassify/<job_id>", methods=["GET"])
+def reclassify_job(job_id):
+    """Variable URL route giving the progress of a reclassification job
+
+    Returns:
+        json: job_id, state, profile, patients, patients_done,
+        readings and changed
+        str: error message if the job is unknown
+    """
+    return job_request(job_id)
+
+
+@app.route("/api/patient_age", methods=["POST"])
+def patient_age():
+    """Accepts json request and corrects a patient's age
+
+    json request should contain a dict formatted as follows:
+    {
+        "patient_id": int, # Should be patient MRN
+        "patient_age": int # Corrected age in years
+    }
+    The patient's stored readings are then reclassified in the
+    background.
+
+    Returns:
+        json: state of the reclassification job
+        str: error message
+    """
+    return patient_age_request(request.get_json())
 
 
 def validate_dict_input(in_data, expected_keys):
@@ -413,25 +939,9 @@ def validate_dict_input(in_data, expected_keys):
     Returns:
         [type]: [description]
     """
-    if type(in_data) is not dict:
-        return "The input was not a dictionary.", 400
-    for key in expected_keys:
-        # Ensure all expected keys exist within in_data
-        if key not in in_data:
-            return "The key {} is missing from input".format(key), 400
-
-        # Ensure all types are valid
-        if type(in_data[key]) not in expected_keys[key]:
-            return "The key {} has invalid data type".format(key), 400
-
-        # Verify str are able to cleanly cast to int
-        if set(expected_keys[key]) == set([str, int]):
-            check = str_to_int(in_data[key])
-            if not check[1]:
-                m1 = "The value \"{}\"".format(in_data[key])
-                m2 = " in key {} cannot be cast to int".format(key)
-                return m1+m2, 400
-
+    values = Schema(expected_keys).validate(in_data)
+    if type(values) == str:
+        return values, 400
     return True, 200
 
 
@@ -443,8 +953,9 @@ def add_patient_to_database(pat_id, att_name, pat_age):
     Method inputs patient id, attending name, and patient age
     and constructs a patient dictionary to hold information about
     patient. It then stores this patient dict within the attending's
-    "patients" key, adds the patient to the patient_database, and
-    returns the patient dictionary.
+    "patients" key, adds the patient to the patient_database keyed by
+    its integer id, and returns the patient dictionary. Patient ids
+    are checked for uniqueness here so lookups never have to.
 
     Args:
         pat_id (str, int): Patient's unique id
@@ -453,18 +964,16 @@ def add_patient_to_database(pat_id, att_name, pat_age):
 
     Returns:
         dict: newly constructed patient dictionary
+        str: error message if a patient with that id already exists
     """
-    patient = {
-            "id": str_to_int(pat_id)[0],
-            "age": str_to_int(pat_age)[0],
-            "attending": att_name,
-            "HR_data": []
-        }
-    patient_database.append(patient)
+    id_no = str_to_int(pat_id)[0]
     attendant = get_attending_from_database(att_name)
-    try:
-        attendant["patients"].append(patient)
-    except TypeError:
+    patient = storage.add_patient(id_no, att_name, str_to_int(pat_age)[0])
+    if patient is None:
+        logging.error('ID {} already exists in DB'.format(pat_id))
+        return "ERROR: patient id ({}) not unique identifier".format(id_no)
+    response_cache.invalidate(("patient", id_no), ("attending", att_name))
+    if type(attendant) == str:
         logging.error('ID {} unable to be added to DB'.format(pat_id))
         return patient
     logging.info('Registered new patient with ID {}'.format(pat_id))
@@ -476,9 +985,10 @@ def get_patient_from_database(id_no):
 
     Method curated by Anuj Som
 
-    Method inputs patient id, iterates through the patient_database
-    and returns the id it finds, or throws error if no patient with
-    that id found, or id key not unique.
+    Method inputs patient id, looks it up in the patient_database
+    and returns the patient it finds, or returns an error string if
+    no patient with that id is found. Uniqueness is enforced when
+    patients are added, so a single keyed lookup is sufficient.
 
     Args:
         pat_id (int): Patient's unique id (must be int)
@@ -486,12 +996,10 @@ def get_patient_from_database(id_no):
     Returns:
         dict: Patient dictionary within the database
     """
-    patlist = [x for x in patient_database if x["id"] == id_no]
-    if len(patlist) == 0:
+    patient = storage.get_patient(id_no)
+    if patient is None:
         return "ERROR: no patient with id {} in database".format(id_no)
-    if len(patlist) > 1:
-        return "ERROR: patient id ({}) not unique identifier".format(id_no)
-    return patlist[0]
+    return patient
 
 
 def add_attending_to_database(att_name, att_email, att_phone):
@@ -502,7 +1010,9 @@ def add_attending_to_database(att_name, att_email, att_phone):
     Method inputs attending name, attending_email, and attending_phone
     and constructs a attending dictionary to hold information about
     the physician. It then stores this attending dict within the
-    attending_database, and returns the new attending dictionary.
+    attending_database keyed by username, and returns the new
+    attending dictionary. Usernames are checked for uniqueness here
+    so lookups never have to.
 
     Args:
         att_name (str): Attending's unique name
@@ -511,14 +1021,13 @@ def add_attending_to_database(att_name, att_email, att_phone):
 
     Returns:
         dict: newly constructed attending dictionary
+        str: error message if an attending with that name already exists
     """
-    attendant = {
-            "name": att_name,
-            "email": att_email,
-            "phone": att_phone,
-            "patients": []
-        }
-    attending_database.append(attendant)
+    attendant = storage.add_attending(att_name, att_email, att_phone)
+    if attendant is None:
+        logging.error('Attending {} already exists in DB'.format(att_name))
+        return "ERROR: name not unique identifier"
+    response_cache.invalidate(("attending", att_name))
     logging.info('Registered new attending physician with username {} '
                  'and email {}'.format(att_name, att_email))
     return attendant
@@ -529,53 +1038,407 @@ def get_attending_from_database(attendant_name):
 
     Method curated by Anuj Som
 
-    Method inputs unique attending name, uses this to iterate through
-    attending_database and find that attending.
-    Returns error str if attending name not unique or not in db.
+    Method inputs unique attending name and uses this as the key
+    into attending_database to find that attending.
+    Returns error str if attending name not in db.
 
     Args:
-        pat_id (int): Patient's unique id (must be int)
+        attendant_name (str): Attending's unique name
 
     Returns:
-        dict: Patient dictionary within the database
+        dict: Attending dictionary within the database
     """
-    attlist = [x for x in attending_database if x["name"] == attendant_name]
-    if len(attlist) == 0:
+    attendant = storage.get_attending(attendant_name)
+    if attendant is None:
         return "ERROR: no attending in database"
-    if len(attlist) > 1:
-        return "ERROR: name not unique identifier"
-    return attlist[0]
+    return attendant
+
 
+def get_attending_summary(attendant_name):
+    """Method which handles accessing an attending's patient summary
 
-def add_heart_rate(patient, heart_rate):
+    Args:
+        attendant_name (str): Attending's unique name
+
+    Returns:
+        bytes: json list of {"patient_id", "last_heart_rate",
+               "last_time", "status"} dicts, one per patient
+        str: error message if the attending is not in the database
+    """
+    summary = storage.attending_summary(attendant_name)
+    if summary is None:
+        return "ERROR: no attending in database"
+    return summary
+
+
+def add_heart_rate(patient, heart_rate, timestamp=None, sync=True,
+                   status=None):
     """Method which handles adding heart rate data to patient
 
     Method curated by Braden Garrison
 
     Method accepts patient, heart_rate input and calculates
-    tachycardia status and obtains timestamp, and bundles this
-    into a dict hr_info which is then returned.
+    tachycardia status and obtains timestamp, stores these in the
+    patient's HR_data columns and returns the stored reading as a
+    dict hr_info.
 
     Args:
         patient (dict): Patient dictionary from database
         heart_rate (int): HR in bpm
+        timestamp (int): epoch milliseconds of the reading, defaults
+                         to now
+        sync (bool): make the reading durable before returning; batch
+                     callers pass False and call refresh_thresholds()
+                     and storage.sync() once instead
+        status (str): tachycardia status of the reading if it was
+                      already classified, as add_heart_rate_batch does
 
     Returns:
         dict: HR_data which is added to patient_HR list.
     """
-    timestamp = dt.now()
-    timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-    tach = is_tachycardic(heart_rate, patient["age"])
+    if timestamp is None:
+        timestamp = now_timestamp()
+    if sync:
+        refresh_thresholds()
+    tach = status or is_tachycardic(heart_rate, patient["age"])
     if tach == "tachycardic":
-        att, email = tach_warning(patient, heart_rate)
-        tach_email(patient, att, email)
+        tach_alert(patient, heart_rate)
+    storage.add_heart_rate(patient, heart_rate, tach, timestamp, sync)
+    response_cache.invalidate(("patient", patient["id"]),
+                              ("attending", patient["attending"]))
     hr_info = {"heart_rate": heart_rate,
                "status": tach,
-               "timestamp": timestamp}
-    patient["HR_data"].append(hr_info)
+               "timestamp": format_timestamp(timestamp)}
+    publish_heart_rate(patient, hr_info, timestamp)
     return hr_info
 
 
+def publish_heart_rate(patient, hr_info, timestamp):
+    """Pushes a stored reading to the live event streams
+
+    A "heart_rate" event goes to the patient's and the attending's
+    streams. If the reading is the patient's latest and its status
+    differs from the previous latest reading's, a "status" event
+    follows it. Readings back-filled with an older timestamp do not
+    change the status. Readings are ordered by their epoch millisecond
+    timestamps, not the rendered local times, which tie within a
+    second and go back when daylight saving time ends.
+
+    Args:
+        patient (dict): Patient dictionary from database
+        hr_info (dict): stored reading returned by add_heart_rate
+        timestamp (int): epoch milliseconds of the reading
+    """
+    topics = ["patient:{}".format(patient["id"]),
+              "attending:{}".format(patient["attending"])]
+    event = dict(hr_info, patient_id=patient["id"])
+    with patient_status_lock:
+        event_broker.publish(topics, "heart_rate", event)
+        latest = patient_status.get(patient["id"])
+        if latest is not None and timestamp < latest[0]:
+            return
+        patient_status[patient["id"]] = (timestamp, hr_info["status"])
+        previous = latest[1] if latest is not None else None
+        if previous != hr_info["status"]:
+            event_broker.publish(topics, "status",
+                                 {"patient_id": patient["id"],
+                                  "status": hr_info["status"],
+                                  "previous": previous,
+                                  "timestamp": hr_info["timestamp"]})
+
+
+def open_event_stream(kind, key, last_event_id=None, notify=None):
+    """Subscribes to the live events of a patient or an attending
+
+    Args:
+        kind (str): "patient" or "attending"
+        key (str): patient id or attending username from the URL
+        last_event_id (str): id of the last event the client received
+        notify (callable): see event_broker.Subscription
+
+    Returns:
+        Subscription: subscription to the events
+        str: error message if the patient or attending is not found
+    """
+    if kind == "patient":
+        check = str_to_int(key)
+        if not check[1]:
+            return "Invalid patient ID"
+        found = get_patient_from_database(check[0])
+        key = check[0]
+    else:
+        found = get_attending_from_database(key)
+    if type(found) == str:
+        return found
+    return event_broker.subscribe("{}:{}".format(kind, key), last_event_id,
+                                  notify)
+
+
+def last_event_id():
+    """Gives the event id a reconnecting SSE client resumes from
+
+    Returns:
+        str: Last-Event-ID header or last_event_id query parameter,
+             None for a new client
+    """
+    return request.headers.get("Last-Event-ID",
+                               request.args.get("last_event_id"))
+
+
+def event_stream_response(subscription):
+    """Streams a subscription's events as a text/event-stream
+
+    A comment line is sent every EVENT_KEEPALIVE seconds without
+    events, which keeps proxies from closing the connection and lets
+    the server notice disconnected clients.
+
+    Args:
+        subscription (Subscription): subscription to stream
+
+    Returns:
+        Response: streaming response
+    """
+    def generate():
+        try:
+            yield "retry: {}\n\n".format(EVENT_RETRY_MS)
+            while True:
+                event = subscription.get(EVENT_KEEPALIVE)
+                if event is not None:
+                    yield format_event(event)
+                elif subscription.ended():
+                    return
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            subscription.close()
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache",
+                             "X-Accel-Buffering": "no"})
+
+
+def cached_response(view_name, kind, key, compute, if_none_match=None,
+                    variant=()):
+    """Serves a patient or attending GET response from response_cache
+
+    Responses about an existing patient or attending carry an ETag
+    made of the storage epoch and the entity's version, read before
+    the response is built. A client sending that tag back in
+    If-None-Match while the version is unchanged is answered 304 Not
+    Modified with an empty body.
+
+    Only 200 responses are cached. They are dropped by add_heart_rate,
+    add_patient_to_database and add_attending_to_database whenever
+    the patient or attending changes. For storage engines shared with
+    other processes, whose writes this process would not see, the
+    version is part of the cache key instead, so a change made
+    elsewhere makes the next request miss.
+
+    Args:
+        view_name (str): route name, part of the cache key
+        kind (str): "patient" or "attending"
+        key (str): patient id or attending username from the URL
+        compute (callable): builds the response, returning
+                            (status code, content type, body bytes)
+        if_none_match (str): If-None-Match request header, if any
+        variant (tuple): further cache key parts, e.g. from
+                         query_variant()
+
+    Returns:
+        tuple: (status code, content type, body bytes, ETag or None)
+    """
+    if kind == "patient":
+        check = str_to_int(key)
+        if not check[1]:
+            return compute() + (None,)
+        key = check[0]
+    version = storage.version(kind, key)
+    etag = None
+    if version is not None:
+        etag = '"{}-{}"'.format(storage.epoch, version)
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            return 304, "text/html; charset=utf-8", b"", etag
+    tags = ((kind, key),)
+    cache_key = (view_name, key, variant)
+    if storage.shared:
+        cache_key += (version,)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return 200, cached[1], cached[0], cached[2]
+    generation = response_cache.generation(tags)
+    status_code, content_type, body = compute()
+    if status_code == 200:
+        response_cache.put(cache_key, (body, content_type, etag), tags,
+                           generation)
+    return status_code, content_type, body, etag
+
+
+def query_variant(args):
+    """Gives the cache key part of a request's query parameters
+
+    Args:
+        args (dict): query parameter names and values
+
+    Returns:
+        tuple: sorted (name, value) pairs
+    """
+    return tuple(sorted(args.items()))
+
+
+def etag_matches(if_none_match, etag):
+    """Tells whether an If-None-Match header names the current ETag
+
+    Args:
+        if_none_match (str): comma separated entity tags or "*"
+        etag (str): current quoted entity tag
+
+    Returns:
+        bool: True if the client's copy is current
+    """
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag or tag == "*":
+            return True
+    return False
+
+
+def heart_rate_ack(pat_id, hr_info):
+    """Acknowledges a stored heart rate in a line of text
+
+    Args:
+        pat_id (int): patient id
+        hr_info (dict): stored reading returned by add_heart_rate
+
+    Returns:
+        str: e.g. "Added heart rate information 75 (not tachycardic,
+             2018-03-09 11:00:36) for patient id 1"
+    """
+    return "Added heart rate information {} ({}, {}) for patient id " \
+           "{}".format(hr_info["heart_rate"], hr_info["status"],
+                       hr_info["timestamp"], pat_id)
+
+
+def add_heart_rate_batch(records):
+    """Method which handles adding many heart rate readings at once
+
+    Each record is validated like a /api/heart_rate post, including
+    its optional "timestamp". Valid records are then grouped by
+    patient so that each patient is looked up once and its heart
+    rates are classified in one classify_column call against the
+    threshold for the patient's age, before the readings are stored
+    with their statuses through add_heart_rate. A
+    record which fails while being stored (e.g. its tachycardia alert
+    cannot find the patient's attending) is reported as an error
+    without failing the rest of the batch, and the readings stored so
+    far are synced whatever happens.
+
+    Args:
+        records (list): dicts with "patient_id", "heart_rate" and
+                        optionally "timestamp" keys
+
+    Returns:
+        list: for each record in order, the stored reading dict with
+              an added "patient_id" key, or {"error": str}
+    """
+    results = [None] * len(records)
+    by_patient = {}
+    for i, values in enumerate(HEART_RATE_SCHEMA.validate_many(records)):
+        if type(values) == str:
+            results[i] = {"error": values}
+            continue
+        pat_id, hr, timestamp = values
+        if not 0 <= hr <= MAX_HEART_RATE:
+            results[i] = {"error": "Heart rate {} out of range".format(hr)}
+            continue
+        by_patient.setdefault(pat_id, []).append((i, hr, timestamp))
+
+    refresh_thresholds()
+    try:
+        for pat_id, readings in by_patient.items():
+            patient = get_patient_from_database(pat_id)
+            if type(patient) == str:
+                for i, hr, timestamp in readings:
+                    results[i] = {"error": patient}
+                continue
+            codes = classify_column([x[1] for x in readings],
+                                    tach_thresholds.limit(patient["age"]))
+            for (i, hr, timestamp), code in zip(readings, codes):
+                try:
+                    hr_info = add_heart_rate(patient, hr, timestamp,
+                                             sync=False,
+                                             status=STATUS_LABELS[code])
+                except Exception as e:
+                    logging.exception('Heart rate {} for patient ID {} '
+                                      'not stored'.format(hr, pat_id))
+                    results[i] = {"error": "ERROR: heart rate not stored "
+                                           "({})".format(e)}
+                    continue
+                hr_info["patient_id"] = pat_id
+                results[i] = hr_info
+    finally:
+        storage.sync()
+    return results
+
+
+def ingest_ndjson(stream, chunk_size=NDJSON_CHUNK_SIZE):
+    """Method which handles storing heart rates read from a
+    newline-delimited json stream
+
+    Lines are decoded one at a time and collected into chunks which
+    are stored with add_heart_rate_batch. Only counters and the first
+    NDJSON_MAX_ERRORS errors are kept between chunks.
+
+    Args:
+        stream (file-like): binary stream of json lines
+        chunk_size (int): readings stored per chunk
+
+    Returns:
+        dict: {"lines": int, "accepted": int, "rejected": int,
+               "chunks": int, "errors": list}
+    """
+    summary = {"lines": 0, "accepted": 0, "rejected": 0, "chunks": 0,
+               "errors": []}
+    chunk = []
+    line_nos = []
+
+    def record_error(line_no, error):
+        summary["rejected"] += 1
+        if len(summary["errors"]) < NDJSON_MAX_ERRORS:
+            summary["errors"].append({"line": line_no, "error": error})
+
+    def flush():
+        for line_no, result in zip(line_nos, add_heart_rate_batch(chunk)):
+            if "error" in result:
+                record_error(line_no, result["error"])
+            else:
+                summary["accepted"] += 1
+        summary["chunks"] += 1
+        logging.info('NDJSON ingest: {} lines read, {} readings stored, '
+                     '{} rejected'.format(summary["lines"],
+                                          summary["accepted"],
+                                          summary["rejected"]))
+        chunk.clear()
+        line_nos.clear()
+
+    for line in stream:
+        summary["lines"] += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record_error(summary["lines"], "Line is not valid json")
+            continue
+        chunk.append(record)
+        line_nos.append(summary["lines"])
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return summary
+
+
 def get_last_heart_rate(patient):
     """Method which handles obtains patient's latest heart_rate data
 
@@ -613,37 +1476,347 @@ def is_tachycardic(hr, age):
     Returns:
         str: string describing result - "tachycardic" or "not tachycardic"
     """
-    if 1 <= age < 3:
-        if hr > 151:
-            tach = "tachycardic"
-        else:
-            tach = "not tachycardic"
-    elif 3 <= age < 5:
-        if hr > 137:
-            tach = "tachycardic"
-        else:
-            tach = "not tachycardic"
-    elif 5 <= age < 8:
-        if hr > 133:
-            tach = "tachycardic"
-        else:
-            tach = "not tachycardic"
-    elif 8 <= age < 12:
-        if hr > 130:
-            tach = "tachycardic"
-        else:
-            tach = "not tachycardic"
-    elif 12 <= age < 15:
-        if hr > 119:
-            tach = "tachycardic"
-        else:
-            tach = "not tachycardic"
+    # The age band thresholds are looked up in tach_thresholds, see
+    # tachycardia.ThresholdTable; inlined as this runs for every post
+    limits = tach_thresholds.limits
+    limit = limits[age] if 0 <= age < len(limits) \
+        else tach_thresholds.default
+    return STATUS_LABELS[hr > limit]
+
+
+def refresh_thresholds(force=False):
+    """Compiles the threshold profiles in storage if they changed since
+    they were last read
+
+    Profiles are kept by the storage engine, so they survive restarts
+    and, with storage shared by several worker processes, a profile
+    loaded or activated through one worker applies to all of them.
+    Checking for a change costs one lookup of the storage's
+    threshold_version(). Tables already compiled are reused.
+
+    Args:
+        force (bool): read the profiles even if unchanged, e.g. after
+                      switching storage engines
+    """
+    global tach_thresholds, threshold_profiles, thresholds_seen
+    if not force and storage.threshold_version() == thresholds_seen:
+        return
+    with threshold_lock:
+        seen, active, profiles = storage.threshold_profiles()
+        tables = {DEFAULT_THRESHOLDS.version: DEFAULT_THRESHOLDS}
+        for profile in profiles:
+            table = threshold_profiles.get(profile["version"])
+            if table is None or table.to_profile() != profile:
+                table = ThresholdTable.from_profile(profile)
+            tables[table.version] = table
+        threshold_profiles = tables
+        tach_thresholds = tables.get(active, DEFAULT_THRESHOLDS)
+        thresholds_seen = seen
+
+
+def threshold_state():
+    """Gives the active threshold profile and every loaded profile
+
+    Returns:
+        dict: {"active": version, "profiles": [profile, ...]}
+    """
+    refresh_thresholds()
+    with threshold_lock:
+        return {"active": tach_thresholds.version,
+                "profiles": [x.to_profile()
+                             for x in threshold_profiles.values()]}
+
+
+def load_threshold_profile(profile, activate=True):
+    """Loads a threshold profile, optionally making it active
+
+    A version may only be loaded again with the same thresholds.
+
+    Args:
+        profile (dict): see tachycardia.ThresholdTable.from_profile
+        activate (bool): classify new readings with the profile
+
+    Returns:
+        ThresholdTable: the loaded thresholds
+        str: error message if the profile is invalid
+    """
+    table = ThresholdTable.from_profile(profile)
+    if type(table) == str:
+        return table
+    if table.version == DEFAULT_THRESHOLDS.version:
+        stored = DEFAULT_THRESHOLDS.to_profile()
+    else:
+        stored = storage.add_threshold_profile(table.to_profile())
+    if stored != table.to_profile():
+        return "ERROR: threshold profile {} is already loaded with " \
+               "other thresholds".format(table.version)
+    if activate:
+        storage.activate_threshold_profile(table.version)
+    refresh_thresholds()
+    with threshold_lock:
+        return threshold_profiles.get(table.version, table)
+
+
+def activate_threshold_profile(version):
+    """Classifies new readings with a loaded threshold profile
+
+    Args:
+        version (str): version of the profile
+
+    Returns:
+        ThresholdTable: the activated thresholds
+        str: error message if no such profile was loaded
+    """
+    refresh_thresholds()
+    with threshold_lock:
+        table = threshold_profiles.get(version)
+    if table is None:
+        return "ERROR: no threshold profile {}".format(version)
+    storage.activate_threshold_profile(version)
+    refresh_thresholds()
+    return table
+
+
+def reclassify_patients(pat_id=None):
+    """Starts reclassifying stored readings with the active thresholds
+
+    Args:
+        pat_id (int): patient to reclassify, None for every patient
+
+    Returns:
+        dict: state of the started job
+        str: error message if the patient is not found
+    """
+    if pat_id is None:
+        patient_ids = [x["id"] for x in storage.iter_patients()]
     else:
-        if hr > 100:
-            tach = "tachycardic"
-        else:
-            tach = "not tachycardic"
-    return tach
+        patient = get_patient_from_database(pat_id)
+        if type(patient) == str:
+            return patient
+        patient_ids = [pat_id]
+    refresh_thresholds()
+    return reclassifier.submit(patient_ids, tach_thresholds)
+
+
+def reclassify_step(patient_id, position, size, thresholds):
+    """Reclassifies one run of a patient's stored readings, the step
+    of reclassifier
+
+    Cached responses about the patient are dropped when a status
+    changed, and once the patient is done a "status" event is
+    published if its latest status changed.
+
+    Args:
+        patient_id (int): patient to reclassify
+        position: position returned by the previous step, None at first
+        size (int): most readings to reclassify
+        thresholds (ThresholdTable): thresholds to classify with
+
+    Returns:
+        tuple: (next position or None, readings, statuses changed)
+    """
+    patient = storage.get_patient(patient_id)
+    if patient is None:
+        return None, 0, 0
+    position, readings, changed = storage.reclassify(
+        patient, position, size, thresholds.limit(patient["age"]))
+    if changed:
+        response_cache.invalidate(("patient", patient["id"]),
+                                  ("attending", patient["attending"]))
+    if position is None and len(patient["HR_data"]):
+        latest = patient["HR_data"][-1]
+        topics = ["patient:{}".format(patient["id"]),
+                  "attending:{}".format(patient["attending"])]
+        with patient_status_lock:
+            known = patient_status.get(patient["id"])
+            if known is not None and known[1] != latest["status"]:
+                patient_status[patient["id"]] = (known[0],
+                                                 latest["status"])
+                event_broker.publish(topics, "status",
+                                     {"patient_id": patient["id"],
+                                      "status": latest["status"],
+                                      "previous": known[1],
+                                      "timestamp": latest["timestamp"]})
+    return position, readings, changed
+
+
+def correct_patient_age(pat_id, age):
+    """Corrects a patient's age and reclassifies its stored readings
+
+    Args:
+        pat_id (int): patient id
+        age (int): corrected age in years
+
+    Returns:
+        dict: state of the reclassification job
+        str: error message if the patient is not found
+    """
+    patient = get_patient_from_database(pat_id)
+    if type(patient) == str:
+        return patient
+    storage.set_patient_age(patient, age)
+    response_cache.invalidate(("patient", pat_id))
+    return reclassify_patients(pat_id)
+
+
+def load_profile_request(in_data):
+    """Handles a posted threshold profile for both front ends
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    if type(in_data) is not dict:
+        return "The input was not a dictionary.", 400
+    activate = in_data.get("activate", True)
+    if type(activate) is not bool:
+        return "The key activate has invalid data type", 400
+    table = load_threshold_profile(in_data, activate)
+    if type(table) == str:
+        return table, 400
+    return "Loaded threshold profile {}".format(table.version), 200
+
+
+def activate_profile_request(in_data):
+    """Handles a posted profile activation for both front ends
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (response body, status code)
+    """
+    values = ACTIVATE_PROFILE_SCHEMA.validate(in_data)
+    if type(values) == str:
+        return values, 400
+    table = activate_threshold_profile(*values)
+    if type(table) == str:
+        return table, 400
+    return "Activated threshold profile {}".format(table.version), 200
+
+
+def reclassify_request(in_data):
+    """Handles a posted reclassification for both front ends
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (job state or error message, status code)
+    """
+    if type(in_data) is not dict:
+        return "The input was not a dictionary.", 400
+    pat_id = None
+    if "patient_id" in in_data:
+        check = str_to_int(in_data["patient_id"])
+        if not check[1]:
+            return "Invalid patient ID", 400
+        pat_id = check[0]
+    job = reclassify_patients(pat_id)
+    if type(job) == str:
+        return job, 400
+    return job, 200
+
+
+def job_request(job_id):
+    """Handles a reclassification job lookup for both front ends
+
+    Args:
+        job_id (str): job id from the URL
+
+    Returns:
+        tuple: (job state or error message, status code)
+    """
+    check = str_to_int(job_id)
+    job = None
+    if check[1]:
+        # Storage engines shared by several workers know the jobs of
+        # all of them, the others leave jobs to this reclassifier
+        job = storage.get_job(check[0]) or reclassifier.job(check[0])
+    if job is None:
+        return "ERROR: no reclassification job {}".format(job_id), 400
+    return job, 200
+
+
+def patient_age_request(in_data):
+    """Handles a posted age correction for both front ends
+
+    Args:
+        in_data (dict): decoded json request body
+
+    Returns:
+        tuple: (job state or error message, status code)
+    """
+    values = PATIENT_AGE_SCHEMA.validate(in_data)
+    if type(values) == str:
+        return values, 400
+    job = correct_patient_age(*values)
+    if type(job) == str:
+        return job, 400
+    return job, 200
+
+
+def tach_alert(patient, hr):
+    """Notifies the attending of a tachycardic HR post, subject to
+    the alert policy
+
+    Repeats for a patient who alerted within the last
+    ALERT_REPEAT_WINDOW seconds are only counted. Otherwise the alert
+    is logged by tach_warning and either emailed now by tach_email or,
+    if the attending was emailed within the last ALERT_DIGEST_INTERVAL
+    seconds, added to their next digest email.
+
+    Args:
+        patient (dict): Accepts patient dict containing all patient info
+        hr (int): Accepts posted heart rate as integer
+
+    Returns:
+        str: alert policy decision, "send", "coalesce" or "suppress"
+    """
+    decision = alert_policy.evaluate(patient["id"], patient["attending"])
+    if decision == AlertPolicy.SUPPRESS:
+        return decision
+    att, email = tach_warning(patient, hr)
+    if decision == AlertPolicy.SEND:
+        tach_email(patient, att, email)
+    return decision
+
+
+def tach_digest_email(att_name, entries):
+    """Emails an attending a digest of coalesced tachycardia alerts
+
+    Called by alert_policy when an attending's digest interval ends.
+    The email lists each patient that became tachycardic since the
+    attending was last emailed, with the number of repeat readings
+    suppressed since.
+
+    Args:
+        att_name (str): attending username
+        entries (list): dicts {"patient_id": int, "suppressed": int}
+
+    Returns:
+        bool: True if the email was queued for delivery, False if the
+              attending is missing or the alert queue was full
+    """
+    att = get_attending_from_database(att_name)
+    if type(att) == str:
+        logging.error('Tachycardia digest for {} not sent: {}'.format(
+            att_name, att))
+        return False
+    lines = ['Patient ID {} ({} further tachycardic readings)'.format(
+             x["patient_id"], x["suppressed"]) for x in entries]
+    email_msg = ('Dear Dr. {},\n'
+                 'The HR sentinel server has detected tachycardic heart '
+                 'rates for the following patients since your last '
+                 'alert:\n{}'.format(att_name.split('.')[0],
+                                     '\n'.join(lines)))
+    email_req = {"from_email": "HR_sentinel@gmail.com",
+                 "to_email": att["email"],
+                 "subject": 'WARNING: Tachycardic HR Digest',
+                 "content": email_msg}
+    return alert_dispatcher.submit(email_req)
 
 
 def tach_warning(patient, hr):
@@ -679,7 +1852,9 @@ def tach_email(patient, att, email):
     This server not only logs any events of tachycardic HR postings
     but also emails the attending on file for that patient. The email
     will alert the attending of the patient ID associated with the
-    HR posting.
+    HR posting. The email request is handed to alert_dispatcher,
+    which posts it from a background thread with timeouts and
+    retries, so the heart rate post never waits on the email server.
 
     Args:
         patient (dict): accepts patient dict containing all patient info
@@ -687,26 +1862,22 @@ def tach_email(patient, att, email):
         email (str): accepts attending email as string
 
     Returns:
-        int: status code returned from interaction with email server
-        str: status text describing successful email or error message
+        bool: True if the email was queued for delivery, False if the
+              alert queue was full
     """
-    path = "http://vcm-7631.vm.duke.edu:5007/hrss/send_email"
     email_subj = 'WARNING: Tachycardic HR Detected'
     att_name_list = att["name"].split('.')
     att_last_name = att_name_list[0]
-    email_msg = 'Dear Dr. {},\n'
-    'The HR sentinel server has just detected a tachycardic '
-    'heart rate for your patient with ID {}. Please tend to '
-    'them as soon as possible.'.format(att_last_name,
-                                       patient["id"])
+    email_msg = ('Dear Dr. {},\n'
+                 'The HR sentinel server has just detected a tachycardic '
+                 'heart rate for your patient with ID {}. Please tend to '
+                 'them as soon as possible.'.format(att_last_name,
+                                                    patient["id"]))
     email_req = {"from_email": "HR_sentinel@gmail.com",
                  "to_email": email,
                  "subject": email_subj,
                  "content": email_msg}
-    r = requests.post(path, json=email_req)
-    print(r.status_code)
-    print(r.text)
-    return
+    return alert_dispatcher.submit(email_req)
 
 
 def prev_heart_rate(patient):
@@ -725,11 +1896,102 @@ def prev_heart_rate(patient):
     """
     if len(patient["HR_data"]) == 0:
         return "ERROR: no heart rate values saved for patient"
+    return patient["HR_data"].values()
+
+
+def heart_rate_page(patient, args):
+    """Gives one page of a patient's heart rate history
+
+    The time bounds and the cursor position are resolved by binary
+    search on the patient's time index (an index seek with SQLite
+    storage), so a page costs the same whatever the history length.
+
+    Args:
+        patient (dict): accepts patient dict containing all patient info
+        args (dict): query parameters, all optional:
+            since (str): "2018-03-09 11:00:36", readings taken at or
+                         after this second
+            until (str): readings taken before this second
+            limit (str): readings per page, PAGE_SIZE by default and
+                         at most MAX_PAGE_SIZE
+            cursor (str): next_cursor of the previous page
+            fields (str): "values" for heart rates only (default) or
+                          "readings" for heart rate, status and
+                          timestamp dicts
+
+    Returns:
+        bytes: json {"heart_rates": list, "next_cursor": str or None},
+               readings encoded by serialization.encode_page
+        str: error message if a parameter is invalid
+    """
+    bounds = {}
+    for name in ["since", "until"]:
+        if name in args:
+            try:
+                bounds[name] = parse_timestamp_string(args[name])
+            except ValueError:
+                return "ERROR: {} must be formatted as " \
+                       "\"2018-03-09 11:00:36\"".format(name)
+    limit = PAGE_SIZE
+    if "limit" in args:
+        limit, valid = str_to_int(args["limit"])
+        if not valid or limit < 1:
+            return "ERROR: limit must be a positive integer"
+        limit = min(limit, MAX_PAGE_SIZE)
+    fields = args.get("fields", "values")
+    if fields not in ("values", "readings"):
+        return "ERROR: fields must be \"values\" or \"readings\""
+    after = None
+    if "cursor" in args:
+        after = decode_cursor(args["cursor"])
+        if after is None:
+            return "ERROR: invalid cursor"
+    if fields == "values":
+        rows, position = patient["HR_data"].page(bounds.get("since"),
+                                                 bounds.get("until"),
+                                                 after, limit)
+        heart_rates = encode_json([x[0] for x in rows])
     else:
-        hr_list = []
-        for x in patient["HR_data"]:
-            hr_list.append(x["heart_rate"])
-    return hr_list
+        heart_rates, position = encode_page(patient["HR_data"],
+                                            bounds.get("since"),
+                                            bounds.get("until"),
+                                            after, limit)
+    next_cursor = encode_cursor(position) if position is not None else None
+    return b'{"heart_rates":' + heart_rates + b',"next_cursor":' + \
+        encode_json(next_cursor) + b"}"
+
+
+def encode_cursor(position):
+    """Encodes a history position as an opaque cursor string
+
+    Args:
+        position (tuple): (timestamp, skip) from a page() call
+
+    Returns:
+        str: url-safe cursor
+    """
+    text = "{!r}:{}".format(*position)
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor made by encode_cursor
+
+    Args:
+        cursor (str): cursor sent by the client
+
+    Returns:
+        tuple: (timestamp, skip), None if the cursor is invalid
+    """
+    try:
+        text = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, skip = text.split(":")
+        position = (int(timestamp), int(skip))
+    except (ValueError, UnicodeError):
+        return None
+    if position[1] < 0:
+        return None
+    return position
 
 
 def heart_rate_average(hr_list):
@@ -737,8 +1999,8 @@ def heart_rate_average(hr_list):
 
     Method curated by Braden Garrison
 
-    The accepted heart rate list of a specific patient is iterated
-    through to produce a total which is then divided by the list
+    The accepted heart rate list of a specific patient is summed
+    to produce a total which is then divided by the list
     length to produce the heart rate average.
 
     Args:
@@ -747,12 +2009,9 @@ def heart_rate_average(hr_list):
     Returns:
         int: rounded average heart rate value for a patient
     """
-    total = 0
     if len(hr_list) == 0:
         return 0
-    for x in hr_list:
-        total += x
-    hr_avg = int(total/len(hr_list))
+    hr_avg = int(sum(hr_list)/len(hr_list))
     return hr_avg
 
 
@@ -761,30 +2020,123 @@ def heart_rate_interval(interval_time, patient):
 
     Method curated by Braden Garrison
 
-    Iterates through patient heart rate values to determine which
-    heart rates were posted after the specified interval time,
-    then returns a list of those heart rates to be averaged later.
+    Binary searches the patient's time-ordered heart rate values to
+    find the first heart rate posted after the specified interval
+    time, then returns a list of the heart rates from there on.
 
     Args:
-        interval_time (str): posted interval time in format
-                             "Y-%m-%d %H:%M%S"
+        interval_time (str or int): posted interval time in format
+                                    "Y-%m-%d %H:%M%S", or its epoch
+                                    milliseconds
         patient (dict): accepts patient dict containing all patient info
 
     Returns:
         list: heart rate list containing all heart rates posted after interval
     """
-    interval_dt = dt.strptime(interval_time, "%Y-%m-%d %H:%M:%S")
-    hr_interval = []
-    if len(patient["HR_data"]) == 0:
+    since = interval_start(interval_time)
+    hr_data = patient["HR_data"]
+    if len(hr_data) == 0:
         return "ERROR: no heart rate values saved for patient"
-    else:
-        for x in patient["HR_data"]:
-            hr_dt = dt.strptime(x["timestamp"], "%Y-%m-%d %H:%M:%S")
-            if hr_dt > interval_dt:
-                hr_interval.append(x["heart_rate"])
+    hr_interval = hr_data.values(since)
     return hr_interval
 
 
+def heart_rate_interval_average(interval_time, patient):
+    """Averages the heart rates posted after a specified time
+
+    Uses the patient's time index and heart rate prefix sums so the
+    average costs one binary search and a subtraction, regardless of
+    how many readings are stored.
+
+    Args:
+        interval_time (str or int): posted interval time in format
+                                    "Y-%m-%d %H:%M%S", or its epoch
+                                    milliseconds
+        patient (dict): accepts patient dict containing all patient info
+
+    Returns:
+        int: rounded average of heart rates posted after the interval,
+             0 if there are none
+        str: error message if the patient has no heart rate values
+    """
+    since = interval_start(interval_time)
+    hr_data = patient["HR_data"]
+    if len(hr_data) == 0:
+        return "ERROR: no heart rate values saved for patient"
+    count, total = hr_data.sum_since(since)
+    if count == 0:
+        return 0
+    return int(total/count)
+
+
+def interval_start(interval_time):
+    """Gives the earliest stored timestamp that counts as after
+    an interval time
+
+    Readings are compared at whole-second resolution, as their
+    rendered timestamps are, so anything within the interval's
+    own second is excluded. The interval time is parsed once here,
+    and stored timestamps are then compared as integers.
+
+    Args:
+        interval_time (str or int): interval time formatted as
+                                    "2018-03-09 11:00:36", or its epoch
+                                    milliseconds as converted by
+                                    INTERVAL_AVERAGE_SCHEMA
+
+    Returns:
+        int: epoch milliseconds of the first second after interval_time
+    """
+    if isinstance(interval_time, str):
+        interval_time = parse_timestamp_string(interval_time)
+    return interval_time + 1000
+
+
+def enable_persistence(data_dir, snapshot_every=SNAPSHOT_EVERY):
+    """Recovers the in-memory databases from data_dir and journals
+    every later mutation there
+
+    Args:
+        data_dir (str): directory holding the journal and snapshots
+        snapshot_every (int): journal records between snapshots
+
+    Returns:
+        Journal: the opened journal
+    """
+    journal = storage.enable_journal(data_dir, snapshot_every)
+    response_cache.clear()
+    refresh_thresholds(force=True)
+    return journal
+
+
+def use_storage(new_storage):
+    """Switches the storage engine behind the database helpers
+
+    Args:
+        new_storage (MemoryStorage, SQLiteStorage): engine to use
+    """
+    global storage
+    storage = new_storage
+    response_cache.clear()
+    with patient_status_lock:
+        patient_status.clear()
+    refresh_thresholds(force=True)
+
+
+def configure_storage_from_env():
+    """Selects the storage engine from environment variables
+
+    SENTINEL_SQLITE_PATH selects the SQLite engine with that database
+    file. Otherwise SENTINEL_DATA_DIR enables the in-memory engine's
+    journal in that directory. With neither set, data is only held in
+    memory.
+    """
+    if os.environ.get("SENTINEL_SQLITE_PATH"):
+        use_storage(SQLiteStorage(os.environ["SENTINEL_SQLITE_PATH"]))
+    elif os.environ.get("SENTINEL_DATA_DIR"):
+        enable_persistence(os.environ["SENTINEL_DATA_DIR"])
+
+
 def str_to_int(value):
     """Converts an input string
     into int value, or returns input
@@ -811,4 +2163,5 @@ def str_to_int(value):
 if __name__ == "__main__":
     logging.basicConfig(filename='HR_sentinel_server_log.log',
                         filemode='w', level=logging.INFO)
+    configure_storage_from_env()
     app.run()
@@ -0,0 +1,115 @@
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+from werkzeug.serving import make_server
+from storage import SQLiteStorage
+
+
+def open_listener(host, port, backlog=1024):
+    """Opens the listening socket shared by every worker
+
+    Args:
+        host (str): interface to bind
+        port (int): port to bind, 0 picks a free port
+        backlog (int): pending connection queue length
+
+    Returns:
+        socket.socket: bound, listening socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock):
+    """Serves the Flask app on an inherited listening socket
+
+    Runs in a forked child. The storage engine is configured here,
+    after the fork, so every worker opens its own SQLite connections
+    to the shared database file.
+
+    Args:
+        sock (socket.socket): listening socket opened by the parent
+    """
+    import sentinel_server
+    sentinel_server.configure_storage_from_env()
+    host, port = sock.getsockname()
+    server = make_server(host, port, sentinel_server.app, threaded=True,
+                         fd=sock.fileno())
+    server.serve_forever()
+
+
+def serve(host, port, workers, sqlite_path):
+    """Runs the server as several worker processes sharing one store
+
+    Each worker is a forked process accepting connections from the
+    same listening socket, so the kernel spreads requests across
+    them. All workers use the SQLite engine on one database file,
+    which in WAL mode lets them read concurrently while writes are
+    serialized by SQLite. Every write is committed before its
+    response is sent, so a read through any worker sees it.
+
+    Alert suppression and coalescing state is kept per worker.
+
+    Args:
+        host (str): interface to bind
+        port (int): port to bind
+        workers (int): number of worker processes
+        sqlite_path (str): shared SQLite database file
+    """
+    os.environ["SENTINEL_SQLITE_PATH"] = sqlite_path
+    # Create the schema once, before any worker can race on it
+    SQLiteStorage(sqlite_path).close()
+    sock = open_listener(host, port)
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(sock)
+            finally:
+                os._exit(0)
+        children.append(pid)
+    logging.info('Started {} workers on {}:{}'.format(
+        workers, *sock.getsockname()))
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the HR sentinel server with several worker "
+                    "processes sharing one SQLite store")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--sqlite", default=os.environ.get(
+        "SENTINEL_SQLITE_PATH", "sentinel.db"),
+        help="shared database file (default $SENTINEL_SQLITE_PATH or "
+             "sentinel.db)")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.workers, args.sqlite)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(filename='HR_sentinel_server_log.log',
+                        filemode='a', level=logging.INFO)
+    main(sys.argv[1:])
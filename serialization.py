@@ -0,0 +1,142 @@
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+from heart_rate_log import STATUS_LABELS, format_timestamp
+from response_cache import ResponseCache
+
+
+# Readings per cached block of an encoded HeartRateLog; a divisor of
+# the page sizes clients usually ask for, so their pages are made of
+# whole blocks
+ENCODED_BLOCK = 500
+ENCODED_CACHE_BYTES = 64 * 1024 * 1024
+# Everything of an encoded reading between the heart rate and the
+# timestamp string, by status code
+STATUS_PARTS = [b',"status":' + json.dumps(x).encode() + b',"timestamp":"'
+                for x in STATUS_LABELS]
+# Encoded blocks of readings by (log token, log generation, index of
+# the first reading), least recently used first out
+encoded_blocks = ResponseCache(ENCODED_CACHE_BYTES)
+
+
+def encode_json(value, default=None):
+    """Encodes a value as compact json with sorted keys, as jsonify
+    does, without the trailing newline
+
+    orjson is used when it is installed, falling back to the standard
+    library for anything it cannot encode (e.g. integers beyond 64
+    bits). orjson writes non-ASCII characters as UTF-8 where the
+    standard library escapes them, and very small or large floats
+    without an exponent sign (1e22, not 1e+22); both are the same
+    json.
+
+    Args:
+        value: json-serializable value
+        default (callable): converts objects json cannot encode
+
+    Returns:
+        bytes: encoded json
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=default,
+                                option=orjson.OPT_SORT_KEYS |
+                                orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(value, default=default, sort_keys=True,
+                      separators=(",", ":")).encode()
+
+
+def encode_reading(heart_rate, status_code, timestamp):
+    """Encodes stored reading fields as the json of render_reading
+
+    Args:
+        heart_rate (int): HR in bpm
+        status_code (int): index into STATUS_LABELS
+        timestamp (int): epoch milliseconds of the reading
+
+    Returns:
+        bytes: {"heart_rate": int, "status": str, "timestamp": str}
+    """
+    return b'{"heart_rate":%d%s%s"}' % (
+        heart_rate, STATUS_PARTS[status_code],
+        format_timestamp(timestamp).encode())
+
+
+def encode_readings(rows):
+    """Encodes stored readings as a json list of reading objects
+
+    Args:
+        rows (iterable): (heart rate, status code, timestamp) tuples
+
+    Returns:
+        bytes: json list, as jsonify would give for the rendered
+               reading dicts
+    """
+    return b"[" + b",".join([encode_reading(*x) for x in rows]) + b"]"
+
+
+def encode_page(series, since=None, until=None, after=None, limit=None):
+    """Gives one page of a heart rate series with its readings encoded
+    as a json list
+
+    Pages of a HeartRateLog are encoded in blocks of ENCODED_BLOCK
+    readings aligned on the log's indexes. Each whole block is kept in
+    encoded_blocks under the log's token and generation, which only
+    appends leave unchanged, so re-reading a history only encodes the
+    readings added since and the partial blocks at the page's ends.
+    The cache is bounded by ENCODED_CACHE_BYTES across all logs, so
+    histories longer than any fixed number of readings are cached as
+    long as they fit. Other series (SQLite storage) are encoded
+    reading by reading.
+
+    Args:
+        series: patient "HR_data" series
+        since, until, after, limit: see HeartRateLog.page
+
+    Returns:
+        tuple: (json list bytes, position of the next page or None)
+    """
+    if not hasattr(series, "indexed_page"):
+        rows, position = series.page(since, until, after, limit)
+        return encode_readings(rows), position
+    rows, position, start, generation = series.indexed_page(
+        since, until, after, limit)
+    parts = []
+    offset = 0
+    while offset < len(rows):
+        index = start + offset
+        stop = min(len(rows), offset + ENCODED_BLOCK - index % ENCODED_BLOCK)
+        if stop - offset < ENCODED_BLOCK:
+            parts.extend(encode_reading(*x) for x in rows[offset:stop])
+        else:
+            parts.append(encode_block(series.token, generation, index,
+                                      rows[offset:stop]))
+        offset = stop
+    return b"[" + b",".join(parts) + b"]", position
+
+
+def encode_block(token, generation, index, rows):
+    """Encodes a whole block of a HeartRateLog's readings, served from
+    encoded_blocks when cached
+
+    Args:
+        token (int): the log's token
+        generation (int): the log's generation when rows were read
+        index (int): index of the block's first reading in the log
+        rows (list): the block's (heart rate, status code, timestamp)
+                     tuples
+
+    Returns:
+        bytes: the readings' json objects joined by commas
+    """
+    key = (token, generation, index)
+    entry = encoded_blocks.get(key)
+    if entry is not None:
+        return entry[0]
+    block = b",".join([encode_reading(*x) for x in rows])
+    encoded_blocks.put(key, (block, None), (), encoded_blocks.generation(()))
+    return block
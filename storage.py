@@ -0,0 +1,1035 @@
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import sqlite3
+import threading
+from heart_rate_log import HeartRateLog, STATUS_LABELS, STATUS_CODES
+from tachycardia import classify_column
+from heart_rate_log import render_reading
+from persistence import Journal
+from serialization import encode_json
+
+
+def patient_summary(patient_id, reading):
+    """Encodes one entry of an attending's patient summary
+
+    Args:
+        patient_id (int): patient id
+        reading (dict): latest reading dict, or [] if none was posted
+
+    Returns:
+        bytes: json object {"last_heart_rate", "last_time",
+               "patient_id", "status"}, with the last reading fields
+               set to [] when there is no reading, encoded like the
+               Flask json provider (sorted keys, compact)
+    """
+    if len(reading) != 0:
+        entry = {"patient_id": patient_id,
+                 "last_heart_rate": reading["heart_rate"],
+                 "last_time": reading["timestamp"],
+                 "status": reading["status"]}
+    else:
+        entry = {"patient_id": patient_id,
+                 "last_heart_rate": [],
+                 "last_time": [],
+                 "status": []}
+    return encode_json(entry)
+
+
+class AttendingSummary:
+    """Pre-encoded patient summary of one attending
+
+    Holds one json fragment per patient, in registration order, and
+    the encoded json list joining them. A new reading only marks its
+    patient as changed; the next read re-encodes the changed patients'
+    fragments and joins the list again, and later reads return the
+    cached bytes until another reading arrives. Neither a reading nor
+    a read walks the attending's other patients' data.
+    """
+
+    def __init__(self):
+        self._fragments = {}
+        self._changed = {}
+        self._body = b"[]"
+        self._lock = threading.Lock()
+
+    def add_patient(self, patient):
+        """Appends a patient to the summary"""
+        with self._lock:
+            self._fragments[patient["id"]] = None
+            self._changed[patient["id"]] = patient
+            self._body = None
+
+    def touch(self, patient):
+        """Marks a patient of the summary as having a new reading"""
+        with self._lock:
+            if patient["id"] in self._fragments:
+                self._changed[patient["id"]] = patient
+                self._body = None
+
+    def encode(self):
+        """Gives the summary as an encoded json list
+
+        Returns:
+            bytes: json list of patient_summary() objects
+        """
+        with self._lock:
+            if self._body is None:
+                for patient_id, patient in self._changed.items():
+                    hr_data = patient["HR_data"]
+                    self._fragments[patient_id] = patient_summary(
+                        patient_id, hr_data[-1] if len(hr_data) else [])
+                self._changed.clear()
+                self._body = b"[" + b",".join(self._fragments.values()) \
+                    + b"]"
+            return self._body
+
+
+class MemoryStorage:
+    """In-process storage engine
+
+    Attendings and patients are dicts keyed by username and integer
+    id, and each patient's readings live in a HeartRateLog. With
+    enable_journal() every mutation is also written to a write-ahead
+    log with periodic snapshots, so the state survives restarts.
+
+    Storage engines share this interface, used by the database
+    helpers in sentinel_server:
+
+        add_attending(name, email, phone) -> attending dict or None
+        get_attending(name) -> attending dict or None
+        add_patient(id_no, attending, age) -> patient dict or None
+        get_patient(id_no) -> patient dict or None
+        patient_list() / attending_list() -> lists of dicts
+        iter_patients() -> patient dicts, read in batches
+        iter_attendings() -> attending dicts with patient ids only
+        attending_summary(name) -> json bytes or None
+        version(kind, key) -> int or None
+        add_heart_rate(patient, heart_rate, status, timestamp, sync)
+        set_patient_age(patient, age)
+        reclassify(patient, position, size, limit)
+            -> (next position or None, readings, statuses changed)
+        add_threshold_profile(profile) -> profile stored for its version
+        activate_threshold_profile(version)
+        threshold_profiles()
+            -> (change count, active version or None, profiles)
+        threshold_version() -> change count
+        new_job_id() -> int
+        save_job(job)
+        get_job(job_id) -> job dict or None
+        sync()
+
+    add_* return None when the id or username already exists. A
+    patient dict's "HR_data" is a heart rate series supporting len(),
+    indexing, iteration, to_list(), values(since), page(...),
+    sum_since(ts), average() and summary(), as HeartRateLog does.
+    Timestamps are integer epoch milliseconds throughout.
+    Every method is safe to call from concurrent request threads.
+
+    Every patient ("patient", id) and attending ("attending", name)
+    has a version number which increases with each change to it: a
+    new reading changes the patient and its attending, a new patient
+    changes its attending. Versions are only comparable for the same
+    `epoch`, a string identifying the engine's version sequence.
+
+    `shared` tells whether other processes may change the stored data,
+    in which case callers caching what they read must check versions
+    rather than rely on seeing every change.
+
+    Tachycardia threshold profiles loaded at runtime and the version
+    of the active one are stored too, so they survive restarts and
+    are seen by every process sharing the data; threshold_version()
+    counts changes to them. Reclassification jobs are given their ids
+    and publish their progress through the engine, so any process can
+    report a job's state.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.patients = {}
+        self.attendings = {}
+        self.journal = None
+        # Guards the duplicate check and insert of registry entries and
+        # the attendings' patient lists; readings only take the lock of
+        # their patient's HeartRateLog
+        self._registry_lock = threading.Lock()
+        self._summaries = {}
+        # Versions restart with the process, so the epoch does too
+        self.epoch = os.urandom(4).hex()
+        self._versions = {}
+        self._versions_lock = threading.Lock()
+        # Threshold profiles by version in load order, guarded by the
+        # registry lock
+        self._profiles = {}
+        self._active_profile = None
+        self._thresholds_version = 0
+        self._next_job_id = 1
+
+    def add_attending(self, name, email, phone):
+        """Stores a new attending, None if the username exists"""
+        attendant = {"name": name,
+                     "email": email,
+                     "phone": phone,
+                     "patients": []}
+        with self._registry_lock:
+            if name in self.attendings:
+                return None
+            with self._journaled({"op": "new_attending", "name": name,
+                                  "email": email, "phone": phone},
+                                 sync=False):
+                self._insert_attending(attendant)
+        self.sync()
+        return attendant
+
+    def get_attending(self, name):
+        """Gives the attending with a username, None if not found"""
+        return self.attendings.get(name)
+
+    def add_patient(self, id_no, attending, age):
+        """Stores a new patient and links it to its attending, None if
+        the id exists"""
+        patient = {"id": id_no,
+                   "age": age,
+                   "attending": attending,
+                   "HR_data": HeartRateLog()}
+        with self._registry_lock:
+            if id_no in self.patients:
+                return None
+            with self._journaled({"op": "new_patient", "id": id_no,
+                                  "age": age, "attending": attending},
+                                 sync=False):
+                self._insert_patient(patient)
+        self.sync()
+        return patient
+
+    def get_patient(self, id_no):
+        """Gives the patient with an id, None if not found"""
+        return self.patients.get(id_no)
+
+    def patient_list(self):
+        """Gives every patient in registration order"""
+        with self._registry_lock:
+            return list(self.patients.values())
+
+    def attending_list(self):
+        """Gives every attending in registration order"""
+        with self._registry_lock:
+            return list(self.attendings.values())
+
+    def iter_patients(self):
+        """Iterates over every patient in registration order"""
+        return iter(self.patient_list())
+
+    def iter_attendings(self):
+        """Iterates over every attending in registration order, with
+        the ids of its patients instead of the patient dicts"""
+        for attendant in self.attending_list():
+            patients = list(attendant["patients"])
+            yield {"name": attendant["name"],
+                   "email": attendant["email"],
+                   "phone": attendant["phone"],
+                   "patients": [x["id"] for x in patients]}
+
+    def attending_summary(self, name):
+        """Gives an attending's patients with their latest reading as
+        encoded json (see patient_summary), None if not found"""
+        summary = self._summaries.get(name)
+        if summary is None or name not in self.attendings:
+            return None
+        return summary.encode()
+
+    def version(self, kind, key):
+        """Gives the version of a patient or attending, None if not
+        found"""
+        registry = self.patients if kind == "patient" else self.attendings
+        if key not in registry:
+            return None
+        return self._versions.get((kind, key), 0)
+
+    def add_heart_rate(self, patient, heart_rate, status, timestamp,
+                       sync=True):
+        """Stores a classified reading in the patient's series; with
+        sync=False durability is deferred until sync()"""
+        hr_data = patient["HR_data"]
+        with self._journaled({"op": "heart_rate", "id": patient["id"],
+                              "hr": heart_rate,
+                              "status": STATUS_CODES[status],
+                              "ms": timestamp}, sync, hr_data.lock):
+            hr_data.append(heart_rate, status, timestamp)
+        self._touch(patient)
+
+    def set_patient_age(self, patient, age):
+        """Corrects a patient's age; stored statuses are left to
+        reclassify()"""
+        with self._journaled({"op": "patient_age", "id": patient["id"],
+                              "age": age}, lock=patient["HR_data"].lock):
+            patient["age"] = age
+        self._bump(("patient", patient["id"]))
+
+    def reclassify(self, patient, position, size, limit):
+        """Recomputes the stored status of up to `size` readings
+
+        Each call holds the patient's lock for one run of readings
+        only, so readings keep being added between calls. Positions are
+        keys of the last reading done rather than indexes, so readings
+        added out of order meanwhile are neither skipped nor
+        reclassified twice.
+
+        Args:
+            patient (dict): patient whose readings are reclassified
+            position: None to start with the oldest reading, else the
+                      position returned by the previous call
+            size (int): most readings to reclassify
+            limit (int): highest normal heart rate for the patient
+
+        Returns:
+            tuple: (next position or None once every reading is done,
+                    readings reclassified, statuses changed)
+        """
+        hr_data = patient["HR_data"]
+        with self._journaled({"op": "reclassify", "id": patient["id"],
+                              "after": position, "size": size,
+                              "limit": limit}, lock=hr_data.lock):
+            result = hr_data.reclassify(position, size, limit)
+        if result[2]:
+            self._touch(patient)
+        return result
+
+    def add_threshold_profile(self, profile):
+        """Stores a threshold profile, giving the profile already stored
+        with its version if there is one"""
+        with self._registry_lock:
+            stored = self._profiles.get(profile["version"])
+            if stored is not None:
+                return stored
+            with self._journaled({"op": "threshold_profile",
+                                  "profile": profile}, sync=False):
+                self._insert_profile(profile)
+        self.sync()
+        return profile
+
+    def activate_threshold_profile(self, version):
+        """Stores the version of the active threshold profile"""
+        with self._registry_lock:
+            with self._journaled({"op": "activate_profile",
+                                  "version": version}, sync=False):
+                self._activate_profile(version)
+        self.sync()
+
+    def threshold_profiles(self):
+        """Gives the change count, the active version (None until one
+        is activated) and the stored profiles in load order"""
+        with self._registry_lock:
+            return (self._thresholds_version, self._active_profile,
+                    list(self._profiles.values()))
+
+    def threshold_version(self):
+        """Gives the number of changes to the threshold profiles"""
+        return self._thresholds_version
+
+    def new_job_id(self):
+        """Gives the id of a new reclassification job"""
+        with self._registry_lock:
+            job_id = self._next_job_id
+            self._next_job_id += 1
+            return job_id
+
+    def save_job(self, job):
+        """Publishes a job's state; jobs of an engine no other process
+        shares are only reported by the reclassifier running them"""
+
+    def get_job(self, job_id):
+        """Gives a job's state published by another process, None if
+        unknown"""
+        return None
+
+    def sync(self):
+        """Waits until every journaled mutation is durable"""
+        if self.journal is not None:
+            self.journal.wait(self.journal.seq)
+
+    def enable_journal(self, data_dir, snapshot_every):
+        """Recovers state from data_dir and journals every later
+        mutation there
+
+        Args:
+            data_dir (str): directory holding the journal and snapshots
+            snapshot_every (int): journal records between snapshots
+
+        Returns:
+            Journal: the opened journal
+        """
+        journal = Journal(data_dir, self._capture_state, snapshot_every,
+                          encode_state=self._encode_state)
+        journal.recover(self._restore_state, self._apply_record)
+        self.journal = journal
+        return journal
+
+    def disable_journal(self):
+        """Flushes and closes the journal, keeping the in-memory state"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def close(self):
+        """Releases the engine's resources"""
+        self.disable_journal()
+
+    def _insert_attending(self, attendant):
+        self.attendings[attendant["name"]] = attendant
+        self._summaries[attendant["name"]] = AttendingSummary()
+        self._bump(("attending", attendant["name"]))
+
+    def _insert_patient(self, patient):
+        self.patients[patient["id"]] = patient
+        attendant = self.attendings.get(patient["attending"])
+        if attendant is not None:
+            attendant["patients"].append(patient)
+            self._summaries[attendant["name"]].add_patient(patient)
+        self._bump(("patient", patient["id"]),
+                   ("attending", patient["attending"]))
+
+    def _insert_profile(self, profile):
+        self._profiles[profile["version"]] = profile
+        self._thresholds_version += 1
+
+    def _activate_profile(self, version):
+        self._active_profile = version
+        self._thresholds_version += 1
+
+    def _touch(self, patient):
+        # Taken after the reading's lock is released, since encoding
+        # the summary locks the patient's log inside the summary's lock
+        summary = self._summaries.get(patient["attending"])
+        if summary is not None:
+            summary.touch(patient)
+        self._bump(("patient", patient["id"]),
+                   ("attending", patient["attending"]))
+
+    def _bump(self, *keys):
+        # Bumped after the change is applied, so a reader seeing the
+        # new version also sees the change
+        with self._versions_lock:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+    @contextmanager
+    def _journaled(self, record, sync=True, lock=None):
+        # The record is logged and the enclosed mutation applied under
+        # the journal gate, so a snapshot always sees them together;
+        # the caller then waits for the group commit. A lock given here
+        # is held around both, inside the gate, so mutations it orders
+        # reach the log in the order they are applied.
+        if lock is None:
+            lock = nullcontext()
+        journal = self.journal
+        if journal is None:
+            with lock:
+                yield
+            return
+        with journal.gate, lock:
+            seq = journal.log(record)
+            yield
+        if sync:
+            journal.wait(seq)
+
+    def _capture_state(self):
+        # Runs with mutations held off, so the columns are only copied
+        # here and base64-encoded by _encode_state once they resume
+        attendings = [{"name": x["name"], "email": x["email"],
+                       "phone": x["phone"]}
+                      for x in self.attendings.values()]
+        patients = [{"id": x["id"], "age": x["age"],
+                     "attending": x["attending"],
+                     "HR_data": x["HR_data"].column_bytes()}
+                    for x in self.patients.values()]
+        thresholds = {"active": self._active_profile,
+                      "profiles": list(self._profiles.values())}
+        return {"attendings": attendings, "patients": patients,
+                "thresholds": thresholds}
+
+    @staticmethod
+    def _encode_state(state):
+        for x in state["patients"]:
+            x["HR_data"] = HeartRateLog.encode_columns(x["HR_data"])
+        return state
+
+    def _restore_state(self, state):
+        self.patients.clear()
+        self.attendings.clear()
+        self._summaries.clear()
+        self._versions.clear()
+        self._profiles.clear()
+        self._active_profile = None
+        self.epoch = os.urandom(4).hex()
+        for x in state["attendings"]:
+            self._insert_attending({"name": x["name"],
+                                    "email": x["email"],
+                                    "phone": x["phone"],
+                                    "patients": []})
+        for x in state["patients"]:
+            self._insert_patient(
+                {"id": x["id"], "age": x["age"],
+                 "attending": x["attending"],
+                 "HR_data": HeartRateLog.from_columns(x["HR_data"])})
+        # Snapshots written before profiles were stored have none
+        thresholds = state.get("thresholds", {})
+        for profile in thresholds.get("profiles", []):
+            self._insert_profile(profile)
+        if thresholds.get("active") is not None:
+            self._activate_profile(thresholds["active"])
+
+    def _apply_record(self, record):
+        # Replayed heart rates keep their journaled status and raise
+        # no alerts, since those were handled when first posted
+        if record["op"] == "new_attending":
+            self._insert_attending({"name": record["name"],
+                                    "email": record["email"],
+                                    "phone": record["phone"],
+                                    "patients": []})
+        elif record["op"] == "new_patient":
+            self._insert_patient({"id": record["id"], "age": record["age"],
+                                  "attending": record["attending"],
+                                  "HR_data": HeartRateLog()})
+        elif record["op"] == "heart_rate":
+            patient = self.patients[record["id"]]
+            # Older journals hold "ts" in epoch seconds
+            timestamp = record["ms"] if "ms" in record else \
+                round(record["ts"] * 1000)
+            patient["HR_data"].append(
+                record["hr"], STATUS_LABELS[record["status"]], timestamp)
+            self._touch(patient)
+        elif record["op"] == "patient_age":
+            self.patients[record["id"]]["age"] = record["age"]
+        elif record["op"] == "reclassify":
+            patient = self.patients[record["id"]]
+            patient["HR_data"].reclassify(record["after"], record["size"],
+                                          record["limit"])
+            self._touch(patient)
+        elif record["op"] == "threshold_profile":
+            self._insert_profile(record["profile"])
+        elif record["op"] == "activate_profile":
+            self._activate_profile(record["version"])
+
+
+# Rows read per query by the iter_* methods
+ITER_BATCH = 500
+# Reclassification jobs kept in SQLite storage for inspection
+JOBS_KEPT = 100
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attendings (
+    name TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS patients (
+    id INTEGER PRIMARY KEY,
+    age INTEGER NOT NULL,
+    attending TEXT NOT NULL,
+    hr_count INTEGER NOT NULL DEFAULT 0,
+    hr_total INTEGER NOT NULL DEFAULT 0,
+    hr_min INTEGER,
+    hr_max INTEGER,
+    tach_count INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS patients_attending ON patients (attending);
+CREATE TABLE IF NOT EXISTS heart_rates (
+    patient_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    heart_rate INTEGER NOT NULL,
+    status INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS heart_rates_patient_ts
+    ON heart_rates (patient_id, ts);
+CREATE TABLE IF NOT EXISTS threshold_profiles (
+    version TEXT PRIMARY KEY,
+    profile TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reclassify_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job TEXT NOT NULL
+);
+"""
+
+INSERT_READING = ("INSERT INTO heart_rates (patient_id, ts, heart_rate, "
+                  "status) VALUES (?, ?, ?, ?)")
+UPDATE_AGGREGATES = ("UPDATE patients SET hr_count = hr_count + 1, "
+                     "hr_total = hr_total + ?1, "
+                     "hr_min = min(coalesce(hr_min, ?1), ?1), "
+                     "hr_max = max(coalesce(hr_max, ?1), ?1), "
+                     "tach_count = tach_count + ?2, "
+                     "version = version + 1 WHERE id = ?3")
+BUMP_THRESHOLDS = ("UPDATE meta SET value = value + 1 "
+                   "WHERE key = 'thresholds_version'")
+BUMP_ATTENDING = ("UPDATE attendings SET version = version + 1 "
+                  "WHERE name = ?")
+# Version columns added to databases created before they existed
+MIGRATIONS = [("attendings", "version",
+               "ALTER TABLE attendings ADD COLUMN version INTEGER NOT NULL "
+               "DEFAULT 1"),
+              ("patients", "version",
+               "ALTER TABLE patients ADD COLUMN version INTEGER NOT NULL "
+               "DEFAULT 1")]
+# Rebuilds heart_rates of databases created when ts held REAL epoch
+# seconds, keeping rowids
+MIGRATE_TS_TO_MS = [
+    "ALTER TABLE heart_rates RENAME TO heart_rates_seconds",
+    "CREATE TABLE heart_rates (patient_id INTEGER NOT NULL, "
+    "ts INTEGER NOT NULL, heart_rate INTEGER NOT NULL, "
+    "status INTEGER NOT NULL)",
+    "INSERT INTO heart_rates (rowid, patient_id, ts, heart_rate, status) "
+    "SELECT rowid, patient_id, CAST(round(ts * 1000) AS INTEGER), "
+    "heart_rate, status FROM heart_rates_seconds",
+    "DROP TABLE heart_rates_seconds",
+    "CREATE INDEX heart_rates_patient_ts ON heart_rates (patient_id, ts)"]
+SELECT_READINGS = ("SELECT heart_rate, status, ts FROM heart_rates "
+                   "WHERE patient_id = ? ORDER BY ts, rowid")
+SELECT_ATTENDING_SUMMARY = (
+    "SELECT p.id, r.heart_rate, r.status, r.ts FROM patients p "
+    "LEFT JOIN heart_rates r ON r.rowid = (SELECT rowid FROM heart_rates "
+    "WHERE patient_id = p.id ORDER BY ts DESC, rowid DESC LIMIT 1) "
+    "WHERE p.attending = ? ORDER BY p.rowid")
+SELECT_SUMMARY = ("SELECT p.hr_count, p.hr_total, p.hr_min, p.hr_max, "
+                  "p.tach_count, r.heart_rate, r.status, r.ts "
+                  "FROM patients p LEFT JOIN (SELECT heart_rate, status, ts "
+                  "FROM heart_rates WHERE patient_id = ? "
+                  "ORDER BY ts DESC, rowid DESC LIMIT 1) r WHERE p.id = ?")
+
+
+class SQLiteStorage:
+    """Embedded SQLite storage engine
+
+    Keeps history on disk so it is not limited by RAM. The database
+    runs in WAL mode so readers never block the writer. Readings are
+    stored with ts in integer epoch milliseconds and indexed on
+    (patient_id, ts), which turns interval queries into an index seek,
+    and ranges and averages are computed in SQL. Per
+    patient count, total, min, max and tachycardic count are kept in
+    the patients row, updated in the same transaction as each insert.
+
+    Each thread uses its own connection. All statements are constant
+    parameterized SQL, so sqlite3 reuses the prepared statements from
+    its per-connection cache. With sync=False, add_heart_rate leaves
+    its transaction open until sync() commits it, so a batch is
+    written in one transaction.
+
+    Concurrent writers are serialized by SQLite itself: a reading and
+    its aggregate update commit together, and duplicate ids are caught
+    by the primary keys, so no Python-level locking is needed.
+
+    Threshold profiles are rows of threshold_profiles, and the active
+    version and their change count are kept in meta. Job states are
+    json rows of reclassify_jobs, of which the last JOBS_KEPT are kept.
+
+    See MemoryStorage for the interface.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        """Opens (creating if needed) the database at path
+
+        Args:
+            path (str): SQLite database file
+        """
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        for table, column, sql in MIGRATIONS:
+            columns = [x[1] for x in conn.execute(
+                "PRAGMA table_info({})".format(table))]
+            if column not in columns:
+                conn.execute(sql)
+        # Versions live in the database, so they share its lifetime
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) "
+                     "VALUES ('epoch', ?)", (os.urandom(4).hex(),))
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) "
+                     "VALUES ('thresholds_version', 0)")
+        self.epoch = conn.execute("SELECT value FROM meta "
+                                  "WHERE key = 'epoch'").fetchone()[0]
+        conn.commit()
+        # Checked inside a write transaction, so only one process
+        # migrates
+        conn.execute("BEGIN IMMEDIATE")
+        ts_type = [x[2] for x in conn.execute(
+            "PRAGMA table_info(heart_rates)") if x[1] == "ts"][0]
+        if ts_type == "REAL":
+            for sql in MIGRATE_TS_TO_MS:
+                conn.execute(sql)
+        conn.commit()
+
+    def add_attending(self, name, email, phone):
+        conn = self._conn()
+        try:
+            conn.execute("INSERT INTO attendings (name, email, phone) "
+                         "VALUES (?, ?, ?)", (name, email, phone))
+        except sqlite3.IntegrityError:
+            # End the transaction the failed insert opened, which would
+            # otherwise keep the database write-locked
+            conn.commit()
+            return None
+        conn.commit()
+        return {"name": name, "email": email, "phone": phone,
+                "patients": []}
+
+    def get_attending(self, name):
+        conn = self._conn()
+        row = conn.execute("SELECT name, email, phone FROM attendings "
+                           "WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        patients = [self._patient(*x) for x in conn.execute(
+            "SELECT id, age, attending FROM patients WHERE attending = ? "
+            "ORDER BY rowid", (name,))]
+        return {"name": row[0], "email": row[1], "phone": row[2],
+                "patients": patients}
+
+    def add_patient(self, id_no, attending, age):
+        conn = self._conn()
+        try:
+            conn.execute("INSERT INTO patients (id, age, attending) "
+                         "VALUES (?, ?, ?)", (id_no, age, attending))
+        except sqlite3.IntegrityError:
+            # End the transaction the failed insert opened, which would
+            # otherwise keep the database write-locked
+            conn.commit()
+            return None
+        conn.execute(BUMP_ATTENDING, (attending,))
+        conn.commit()
+        return self._patient(id_no, age, attending)
+
+    def get_patient(self, id_no):
+        row = self._conn().execute("SELECT id, age, attending FROM patients "
+                                   "WHERE id = ?", (id_no,)).fetchone()
+        if row is None:
+            return None
+        return self._patient(*row)
+
+    def patient_list(self):
+        return [self._patient(*x) for x in self._conn().execute(
+            "SELECT id, age, attending FROM patients ORDER BY rowid")]
+
+    def attending_list(self):
+        names = [x[0] for x in self._conn().execute(
+            "SELECT name FROM attendings ORDER BY rowid")]
+        return [self.get_attending(name) for name in names]
+
+    def iter_patients(self):
+        # Each batch is a new query on the calling thread's connection,
+        # so the iteration may be resumed from another thread
+        last = 0
+        while True:
+            rows = self._conn().execute(
+                "SELECT rowid, id, age, attending FROM patients "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last, ITER_BATCH)).fetchall()
+            for row in rows:
+                yield self._patient(*row[1:])
+            if len(rows) < ITER_BATCH:
+                return
+            last = rows[-1][0]
+
+    def iter_attendings(self):
+        last = 0
+        while True:
+            conn = self._conn()
+            rows = conn.execute(
+                "SELECT rowid, name, email, phone FROM attendings "
+                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last, ITER_BATCH)).fetchall()
+            for row in rows:
+                ids = [x[0] for x in conn.execute(
+                    "SELECT id FROM patients WHERE attending = ? "
+                    "ORDER BY rowid", (row[1],))]
+                yield {"name": row[1], "email": row[2], "phone": row[3],
+                       "patients": ids}
+            if len(rows) < ITER_BATCH:
+                return
+            last = rows[-1][0]
+
+    def attending_summary(self, name):
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM attendings WHERE name = ?",
+                        (name,)).fetchone() is None:
+            return None
+        fragments = [patient_summary(x[0], render_reading(*x[1:])
+                                     if x[1] is not None else [])
+                     for x in conn.execute(SELECT_ATTENDING_SUMMARY,
+                                           (name,))]
+        return b"[" + b",".join(fragments) + b"]"
+
+    def version(self, kind, key):
+        if kind == "patient":
+            sql = "SELECT version FROM patients WHERE id = ?"
+        else:
+            sql = "SELECT version FROM attendings WHERE name = ?"
+        row = self._conn().execute(sql, (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_heart_rate(self, patient, heart_rate, status, timestamp,
+                       sync=True):
+        patient["HR_data"].append(heart_rate, status, timestamp)
+        self._conn().execute(BUMP_ATTENDING, (patient["attending"],))
+        if sync:
+            self._conn().commit()
+
+    def set_patient_age(self, patient, age):
+        conn = self._conn()
+        conn.execute("UPDATE patients SET age = ?, version = version + 1 "
+                     "WHERE id = ?", (age, patient["id"]))
+        conn.commit()
+        patient["age"] = age
+
+    def reclassify(self, patient, position, size, limit):
+        # Positions are (ts, rowid) keys, so each run seeks the
+        # (patient_id, ts) index and is committed on its own
+        conn = self._conn()
+        ts, rowid = position or (-1, 0)
+        rows = conn.execute(
+            "SELECT ts, rowid, heart_rate, status FROM heart_rates "
+            "WHERE patient_id = ? AND (ts, rowid) > (?, ?) "
+            "ORDER BY ts, rowid LIMIT ?",
+            (patient["id"], ts, rowid, size)).fetchall()
+        codes = classify_column([x[2] for x in rows], limit)
+        updates = [(code, row[1]) for row, code in zip(rows, codes)
+                   if code != row[3]]
+        if updates:
+            conn.executemany("UPDATE heart_rates SET status = ? "
+                             "WHERE rowid = ?", updates)
+            conn.execute("UPDATE patients SET tach_count = tach_count + ?, "
+                         "version = version + 1 WHERE id = ?",
+                         (sum(2 * x[0] - 1 for x in updates), patient["id"]))
+            conn.execute(BUMP_ATTENDING, (patient["attending"],))
+            conn.commit()
+        next_position = rows[-1][:2] if len(rows) == size else None
+        return next_position, len(rows), len(updates)
+
+    def add_threshold_profile(self, profile):
+        conn = self._conn()
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO threshold_profiles (version, profile) "
+            "VALUES (?, ?)", (profile["version"], json.dumps(profile)))
+        if inserted.rowcount:
+            conn.execute(BUMP_THRESHOLDS)
+        stored = conn.execute("SELECT profile FROM threshold_profiles "
+                              "WHERE version = ?",
+                              (profile["version"],)).fetchone()[0]
+        conn.commit()
+        return json.loads(stored)
+
+    def activate_threshold_profile(self, version):
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) "
+                     "VALUES ('active_profile', ?)", (version,))
+        conn.execute(BUMP_THRESHOLDS)
+        conn.commit()
+
+    def threshold_profiles(self):
+        # Read count first: a change made meanwhile is then read again
+        # on the next check. A profile is stored before it is activated,
+        # so the active version is always among the profiles read.
+        conn = self._conn()
+        version = self.threshold_version()
+        active = conn.execute("SELECT value FROM meta "
+                              "WHERE key = 'active_profile'").fetchone()
+        profiles = [json.loads(x[0]) for x in conn.execute(
+            "SELECT profile FROM threshold_profiles ORDER BY rowid")]
+        return version, active[0] if active else None, profiles
+
+    def threshold_version(self):
+        return int(self._conn().execute(
+            "SELECT value FROM meta "
+            "WHERE key = 'thresholds_version'").fetchone()[0])
+
+    def new_job_id(self):
+        conn = self._conn()
+        job_id = conn.execute("INSERT INTO reclassify_jobs (job) "
+                              "VALUES ('{}')").lastrowid
+        conn.execute("DELETE FROM reclassify_jobs WHERE job_id <= ?",
+                     (job_id - JOBS_KEPT,))
+        conn.commit()
+        return job_id
+
+    def save_job(self, job):
+        conn = self._conn()
+        conn.execute("UPDATE reclassify_jobs SET job = ? WHERE job_id = ?",
+                     (json.dumps(job), job["job_id"]))
+        conn.commit()
+
+    def get_job(self, job_id):
+        row = self._conn().execute("SELECT job FROM reclassify_jobs "
+                                   "WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None or row[0] == "{}":
+            return None
+        return json.loads(row[0])
+
+    def sync(self):
+        """Commits readings added with sync=False on this thread"""
+        self._conn().commit()
+
+    def close(self):
+        """Commits and closes this thread's connection"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.commit()
+            conn.close()
+            self._local.conn = None
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _patient(self, id_no, age, attending):
+        return {"id": id_no,
+                "age": age,
+                "attending": attending,
+                "HR_data": SQLiteHeartRateSeries(self, id_no)}
+
+
+class SQLiteHeartRateSeries:
+    """Heart rate series of one patient stored in SQLite
+
+    Offers the same read interface as HeartRateLog, answered with
+    indexed SQL queries instead of in-memory columns.
+    """
+
+    __slots__ = ("storage", "patient_id")
+
+    def __init__(self, storage, patient_id):
+        self.storage = storage
+        self.patient_id = patient_id
+
+    def append(self, heart_rate, status, timestamp):
+        """Inserts a reading and updates the patient's aggregates,
+        leaving the commit to the storage engine"""
+        code = STATUS_CODES[status]
+        conn = self.storage._conn()
+        conn.execute(INSERT_READING,
+                     (self.patient_id, timestamp, heart_rate, code))
+        conn.execute(UPDATE_AGGREGATES, (heart_rate, code, self.patient_id))
+
+    def reading(self, index):
+        if index < 0:
+            sql = ("SELECT heart_rate, status, ts FROM heart_rates "
+                   "WHERE patient_id = ? ORDER BY ts DESC, rowid DESC "
+                   "LIMIT 1 OFFSET ?")
+            offset = -index - 1
+        else:
+            sql = SELECT_READINGS + " LIMIT 1 OFFSET ?"
+            offset = index
+        row = self.storage._conn().execute(
+            sql, (self.patient_id, offset)).fetchone()
+        if row is None:
+            raise IndexError("reading index out of range")
+        return render_reading(*row)
+
+    def to_list(self):
+        return [render_reading(*x) for x in self.storage._conn().execute(
+            SELECT_READINGS, (self.patient_id,))]
+
+    def values(self, since=None):
+        conn = self.storage._conn()
+        if since is None:
+            rows = conn.execute("SELECT heart_rate FROM heart_rates "
+                                "WHERE patient_id = ? ORDER BY ts, rowid",
+                                (self.patient_id,))
+        else:
+            rows = conn.execute("SELECT heart_rate FROM heart_rates "
+                                "WHERE patient_id = ? AND ts >= ? "
+                                "ORDER BY ts, rowid",
+                                (self.patient_id, since))
+        return [x[0] for x in rows]
+
+    def page(self, since=None, until=None, after=None, limit=None):
+        # Seeks the (patient_id, ts) index; the offset only skips
+        # readings sharing the position's timestamp
+        lower, offset = since, 0
+        if after is not None and (since is None or after[0] >= since):
+            lower, offset = after
+        sql = "SELECT heart_rate, status, ts FROM heart_rates " \
+              "WHERE patient_id = ?"
+        args = [self.patient_id]
+        if lower is not None:
+            sql += " AND ts >= ?"
+            args.append(lower)
+        if until is not None:
+            sql += " AND ts < ?"
+            args.append(until)
+        sql += " ORDER BY ts, rowid LIMIT ? OFFSET ?"
+        args += [-1 if limit is None else limit + 1, offset]
+        rows = self.storage._conn().execute(sql, args).fetchall()
+        if limit is None or len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1][2]
+        skip = sum(1 for x in rows if x[2] == last)
+        if last == lower:
+            skip += offset
+        return rows, (last, skip)
+
+    def sum_since(self, timestamp):
+        return tuple(self.storage._conn().execute(
+            "SELECT count(*), coalesce(sum(heart_rate), 0) "
+            "FROM heart_rates WHERE patient_id = ? AND ts >= ?",
+            (self.patient_id, timestamp)).fetchone())
+
+    def average(self):
+        count, total = self._aggregates()[:2]
+        if count == 0:
+            return 0
+        return int(total/count)
+
+    def summary(self):
+        # One statement reads the aggregates and the latest reading, so
+        # both come from the same database snapshot
+        row = self.storage._conn().execute(
+            SELECT_SUMMARY, (self.patient_id, self.patient_id)).fetchone()
+        if row is None:
+            row = (0, 0, None, None, 0, None, None, None)
+        count, total, hr_min, hr_max, tach_count = row[:5]
+        return {"count": count,
+                "average": int(total/count) if count else 0,
+                "min": hr_min,
+                "max": hr_max,
+                "tachycardic_count": tach_count,
+                "tachycardic_fraction": tach_count/count if count else 0.0,
+                "last": render_reading(*row[5:]) if count else []}
+
+    def _aggregates(self):
+        row = self.storage._conn().execute(
+            "SELECT hr_count, hr_total, hr_min, hr_max, tach_count "
+            "FROM patients WHERE id = ?", (self.patient_id,)).fetchone()
+        return row if row is not None else (0, 0, None, None, 0)
+
+    def __len__(self):
+        return self._aggregates()[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        return self.reading(index)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __eq__(self, other):
+        if isinstance(other, (list, HeartRateLog, SQLiteHeartRateSeries)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.to_list())
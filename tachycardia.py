@@ -0,0 +1,197 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# (first age, end age excluded, highest normal heart rate) of each age
+# band; ages outside every band use ADULT_MAX_HR
+AGE_BANDS = ((1, 3, 151), (3, 5, 137), (5, 8, 133), (8, 12, 130),
+             (12, 15, 119))
+ADULT_MAX_HR = 100
+# Ages past this have no band of their own, which bounds table sizes
+MAX_BAND_AGE = 150
+MAX_HEART_RATE = 65535
+
+
+class ThresholdTable:
+    """Tachycardia thresholds compiled into a lookup table indexed by age
+
+    A heart rate above the highest normal heart rate for the patient's
+    age is tachycardic. Instead of walking the age bands for every
+    reading, the bands are expanded once into a list holding the
+    threshold of each age up to the end of the last band, so a
+    classification is one bounds check and one index. Ages past the
+    table, or negative, use the default threshold.
+
+    The same table is kept as a NumPy array, padded with the default
+    threshold, for classify_batch(). NumPy is optional; without it
+    only the per-reading methods are available.
+
+    Tables are immutable and named by a version, so a profile loaded
+    at runtime replaces the active table as a whole.
+    """
+
+    def __init__(self, bands=AGE_BANDS, default=ADULT_MAX_HR,
+                 version="default"):
+        """Compiles the age bands
+
+        Args:
+            bands (tuple): (first age, end age excluded, highest normal
+                           heart rate) tuples
+            default (int): highest normal heart rate of other ages
+            version (str): name of the threshold profile
+        """
+        self.version = version
+        self.bands = tuple(tuple(x) for x in bands)
+        self.default = default
+        self.limits = [default] * max((x[1] for x in self.bands), default=0)
+        for start, end, max_hr in self.bands:
+            for age in range(max(start, 0), end):
+                self.limits[age] = max_hr
+        self._limits_array = None
+        if np is not None:
+            self._limits_array = np.array(self.limits + [default],
+                                          dtype=np.int64)
+
+    def limit(self, age):
+        """Gives the highest normal heart rate for an age
+
+        Args:
+            age (int): patient age in years
+
+        Returns:
+            int: threshold in bpm
+        """
+        if 0 <= age < len(self.limits):
+            return self.limits[age]
+        return self.default
+
+    def classify(self, heart_rate, age):
+        """Classifies one reading
+
+        Args:
+            heart_rate (int): HR in bpm
+            age (int): patient age in years
+
+        Returns:
+            int: 1 if tachycardic, else 0 (see STATUS_LABELS)
+        """
+        return int(heart_rate > self.limit(age))
+
+    def classify_batch(self, heart_rates, ages):
+        """Classifies many readings in one vectorized call
+
+        Args:
+            heart_rates (array-like): HRs in bpm
+            ages (array-like or int): patient age of each reading, or
+                                      one age for all of them
+
+        Returns:
+            numpy.ndarray: uint8 status codes, 1 if tachycardic, else
+                           0 (see STATUS_LABELS)
+        """
+        if np is None:
+            raise ImportError("classify_batch requires numpy")
+        ages = np.asarray(ages, dtype=np.int64)
+        size = len(self.limits)
+        index = np.where((ages >= 0) & (ages < size), ages, size)
+        return (np.asarray(heart_rates) >
+                self._limits_array[index]).astype(np.uint8)
+
+    @classmethod
+    def from_profile(cls, profile):
+        """Builds a table from a posted threshold profile
+
+        Args:
+            profile (dict): {"version": str,
+                             "bands": [[first age, end age excluded,
+                                        highest normal heart rate], ...],
+                             "default": int}
+
+        Returns:
+            ThresholdTable: compiled table
+            str: error message if the profile is invalid
+        """
+        if type(profile) is not dict:
+            return "The threshold profile was not a dictionary."
+        version = profile.get("version")
+        if type(version) is not str or not version:
+            return "The threshold profile needs a version string"
+        default = profile.get("default")
+        if not is_heart_rate(default):
+            return "The threshold profile default must be an integer " \
+                   "heart rate"
+        bands = profile.get("bands")
+        if type(bands) is not list:
+            return "The threshold profile bands must be a list"
+        for band in bands:
+            if type(band) is not list or len(band) != 3 or \
+                    not all(type(x) is int for x in band[:2]) or \
+                    not 0 <= band[0] < band[1] <= MAX_BAND_AGE or \
+                    not is_heart_rate(band[2]):
+                return "Invalid age band {}: expected [first age, end " \
+                       "age, heart rate] with 0 <= first age < end age " \
+                       "<= {}".format(band, MAX_BAND_AGE)
+        ordered = sorted(bands)
+        for previous, band in zip(ordered, ordered[1:]):
+            if band[0] < previous[1]:
+                return "Age bands {} and {} overlap".format(previous, band)
+        return cls(ordered, default, version)
+
+    def to_profile(self):
+        """Gives the profile the table was built from
+
+        Returns:
+            dict: version, bands and default as accepted by
+                  from_profile()
+        """
+        return {"version": self.version,
+                "bands": [list(x) for x in self.bands],
+                "default": self.default}
+
+
+def is_heart_rate(value):
+    """Tells whether a value is a storable heart rate
+
+    Args:
+        value: value to check
+
+    Returns:
+        bool: True for an int from 0 to MAX_HEART_RATE
+    """
+    return type(value) is int and 0 <= value <= MAX_HEART_RATE
+
+
+def classify_column(heart_rates, limit):
+    """Classifies a run of one patient's readings against one threshold
+
+    Args:
+        heart_rates (array-like): HRs in bpm, e.g. an array("H") slice
+        limit (int): highest normal heart rate for the patient's age
+
+    Returns:
+        bytes: one status code per reading, 1 if tachycardic, else 0
+    """
+    if np is not None:
+        return (np.asarray(heart_rates) > limit).astype(np.uint8).tobytes()
+    return bytes(x > limit for x in heart_rates)
+
+
+def count_changes(codes, previous):
+    """Counts the readings whose status code differs between two runs
+
+    Args:
+        codes (bytes): new status codes
+        previous (bytes): status codes of the same readings before
+
+    Returns:
+        int: number of differing codes
+    """
+    if np is not None:
+        return int(np.count_nonzero(np.frombuffer(codes, np.uint8) !=
+                                    np.frombuffer(previous, np.uint8)))
+    return sum(1 for x, y in zip(codes, previous) if x != y)
+
+
+DEFAULT_THRESHOLDS = ThresholdTable()
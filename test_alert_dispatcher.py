@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from alert_dispatcher import AlertDispatcher
+
+
+class StubEmailServer:
+    """Local stand-in for the email service
+
+    Answers each POST with the next status code in `statuses` (the
+    last one repeats) after waiting `delay` seconds, and records the
+    json bodies it received.
+    """
+
+    def __init__(self, statuses=(200,), delay=0):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.received = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                stub.received.append(json.loads(self.rfile.read(length)))
+                time.sleep(stub.delay)
+                if len(stub.statuses) > 1:
+                    status = stub.statuses.pop(0)
+                else:
+                    status = stub.statuses[0]
+                self.send_response(status)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"ok")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/hrss/send_email".format(
+            self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def make_stub():
+    stubs = []
+
+    def make(*args, **kwargs):
+        stub = StubEmailServer(*args, **kwargs)
+        stubs.append(stub)
+        return stub
+    yield make
+    for stub in stubs:
+        stub.close()
+
+
+def test_submit_delivers_in_background(make_stub):
+    stub = make_stub(delay=0.2)
+    dispatcher = AlertDispatcher(stub.url, workers=1)
+    start = time.monotonic()
+    assert dispatcher.submit({"to_email": "a@duke.edu", "content": "hi"})
+    assert time.monotonic() - start < 0.1
+    dispatcher.join()
+    dispatcher.stop()
+    assert stub.received == [{"to_email": "a@duke.edu", "content": "hi"}]
+    assert dispatcher.sent == 1
+    assert len(dispatcher.dead_letters) == 0
+
+
+def test_retries_server_errors_with_backoff(make_stub):
+    stub = make_stub(statuses=(500, 503, 200))
+    dispatcher = AlertDispatcher(stub.url, workers=1, backoff=0.01)
+    dispatcher.submit({"to_email": "a@duke.edu"})
+    dispatcher.join()
+    dispatcher.stop()
+    assert len(stub.received) == 3
+    assert dispatcher.sent == 1
+    assert dispatcher.failed == 0
+
+
+def test_client_error_is_dead_lettered_without_retry(make_stub):
+    stub = make_stub(statuses=(400,))
+    dispatcher = AlertDispatcher(stub.url, workers=1, backoff=0.01)
+    dispatcher.submit({"to_email": "a@duke.edu"})
+    dispatcher.join()
+    dispatcher.stop()
+    assert len(stub.received) == 1
+    letter = dispatcher.dead_letters[0]
+    assert letter["payload"] == {"to_email": "a@duke.edu"}
+    assert letter["attempts"] == 1
+    assert letter["error"].startswith("status 400")
+
+
+def test_timeout_exhausts_attempts(make_stub):
+    stub = make_stub(delay=0.5)
+    dispatcher = AlertDispatcher(stub.url, workers=1, timeout=0.05,
+                                 max_attempts=2, backoff=0.01)
+    dispatcher.submit({"to_email": "a@duke.edu"})
+    dispatcher.join()
+    dispatcher.stop()
+    assert dispatcher.sent == 0
+    assert dispatcher.failed == 1
+    assert dispatcher.dead_letters[0]["attempts"] == 2
+
+
+def test_full_queue_is_dead_lettered():
+    dispatcher = AlertDispatcher("http://127.0.0.1:9/", max_queue=1)
+    dispatcher._threads = [None]  # keep workers from draining the queue
+    assert dispatcher.submit({"to_email": "a@duke.edu"})
+    assert not dispatcher.submit({"to_email": "b@duke.edu"})
+    assert dispatcher.dead_letters[0]["error"] == "alert queue full"
+    assert dispatcher.dead_letters[0]["attempts"] == 0
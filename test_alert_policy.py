@@ -0,0 +1,59 @@
+import threading
+from alert_policy import AlertPolicy
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_repeats_suppressed_within_window():
+    clock = FakeClock()
+    policy = AlertPolicy(repeat_window=300, digest_interval=60, clock=clock)
+    assert policy.evaluate(1, "Smith.J") == AlertPolicy.SEND
+    for i in range(5):
+        clock.now += 1
+        assert policy.evaluate(1, "Smith.J") == AlertPolicy.SUPPRESS
+    assert policy.suppressed_count(1) == 5
+    clock.now += 300
+    assert policy.evaluate(1, "Smith.J") == AlertPolicy.SEND
+    assert policy.suppressed_count(1) == 0
+    assert policy.stats() == {"sent": 2, "coalesced": 0, "suppressed": 5,
+                              "digests": 0}
+
+
+def test_alerts_coalesced_per_attending():
+    clock = FakeClock()
+    policy = AlertPolicy(repeat_window=300, digest_interval=60, clock=clock)
+    assert policy.evaluate(1, "Smith.J") == AlertPolicy.SEND
+    assert policy.evaluate(2, "Smith.J") == AlertPolicy.COALESCE
+    assert policy.evaluate(3, "Smith.J") == AlertPolicy.COALESCE
+    assert policy.evaluate(2, "Smith.J") == AlertPolicy.SUPPRESS
+    assert policy.evaluate(4, "Som.A") == AlertPolicy.SEND
+    assert policy.flush("Smith.J") == [{"patient_id": 2, "suppressed": 1},
+                                       {"patient_id": 3, "suppressed": 0}]
+    assert policy.flush("Smith.J") == []
+    clock.now += 30
+    assert policy.evaluate(5, "Smith.J") == AlertPolicy.COALESCE
+    clock.now += 60
+    assert policy.evaluate(6, "Smith.J") == AlertPolicy.SEND
+    assert policy.stats() == {"sent": 3, "coalesced": 3, "suppressed": 1,
+                              "digests": 1}
+
+
+def test_digest_delivered_by_timer():
+    received = []
+    done = threading.Event()
+
+    def on_digest(attending, entries):
+        received.append((attending, entries))
+        done.set()
+    policy = AlertPolicy(repeat_window=300, digest_interval=0.05,
+                         on_digest=on_digest)
+    assert policy.evaluate(1, "Smith.J") == AlertPolicy.SEND
+    assert policy.evaluate(2, "Smith.J") == AlertPolicy.COALESCE
+    assert done.wait(2)
+    assert received == [("Smith.J", [{"patient_id": 2, "suppressed": 0}])]
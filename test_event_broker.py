@@ -0,0 +1,88 @@
+import threading
+from event_broker import EventBroker, format_event
+
+
+def test_publish_reaches_topic_subscribers():
+    broker = EventBroker()
+    assert broker.publish(["patient:1"], "heart_rate", {"hr": 60}) is None
+    patient = broker.subscribe("patient:1")
+    attending = broker.subscribe("attending:Smith.J")
+    event_id = broker.publish(["patient:1", "attending:Smith.J"],
+                              "heart_rate", {"hr": 70})
+    broker.publish(["patient:2"], "heart_rate", {"hr": 80})
+    assert patient.get(0) == (event_id, "heart_rate", '{"hr":70}')
+    assert attending.get(0) == (event_id, "heart_rate", '{"hr":70}')
+    assert patient.get(0) is None
+    assert broker.subscriber_count() == 2
+    patient.close()
+    assert broker.subscriber_count("patient:1") == 0
+    assert patient.ended()
+
+
+def test_resume_after_last_event_id():
+    broker = EventBroker()
+    first = broker.subscribe("patient:1")
+    ids = [broker.publish(["patient:1"], "heart_rate", {"hr": x})
+           for x in range(5)]
+    first.close()
+    resumed = broker.subscribe("patient:1", last_event_id=ids[2])
+    assert [resumed.get_nowait()[0] for x in range(2)] == ids[3:]
+    assert resumed.get_nowait() is None
+
+
+def test_resume_compares_sequence_numbers():
+    broker = EventBroker()
+    broker.subscribe("patient:1")
+    ids = [broker.publish(["patient:1"], "heart_rate", {"hr": x})
+           for x in range(12)]
+    # "...-9" sorts after "...-10" as a string
+    resumed = broker.subscribe("patient:1", last_event_id=ids[8])
+    assert [resumed.get_nowait()[0] for x in range(3)] == ids[9:]
+    assert resumed.get_nowait() is None
+
+
+def test_resume_too_old_or_foreign_sends_reset():
+    broker = EventBroker(history=3)
+    broker.subscribe("patient:1")
+    ids = [broker.publish(["patient:1"], "heart_rate", {"hr": x})
+           for x in range(5)]
+    for last_id in [ids[0], "feedbeef-3", "garbage"]:
+        resumed = broker.subscribe("patient:1", last_event_id=last_id)
+        assert resumed.get_nowait() == (ids[-1], EventBroker.RESET, "{}")
+        assert resumed.get_nowait() is None
+    resumed = broker.subscribe("patient:1", last_event_id=ids[1])
+    assert [resumed.get_nowait()[0] for x in range(3)] == ids[2:]
+
+
+def test_slow_subscriber_is_dropped():
+    broker = EventBroker(max_queue=2)
+    slow = broker.subscribe("patient:1")
+    fast = broker.subscribe("patient:1")
+    ids = []
+    for x in range(4):
+        ids.append(broker.publish(["patient:1"], "heart_rate", {"hr": x}))
+        fast.get_nowait()
+    assert slow.overflowed
+    assert broker.dropped == 1
+    assert broker.subscriber_count("patient:1") == 1
+    assert [slow.get(0)[0], slow.get(0)[0]] == ids[:2]
+    assert slow.get(0) is None
+    resumed = broker.subscribe("patient:1", last_event_id=ids[1])
+    assert [resumed.get_nowait()[0] for x in range(2)] == ids[2:]
+
+
+def test_get_waits_and_notify_is_called():
+    notified = threading.Event()
+    broker = EventBroker()
+    subscription = broker.subscribe("patient:1", notify=notified.set)
+    timer = threading.Timer(0.05, broker.publish,
+                            [["patient:1"], "status", {"status": "x"}])
+    timer.start()
+    assert subscription.get(5)[1] == "status"
+    assert notified.is_set()
+    timer.join()
+
+
+def test_format_event():
+    assert format_event(("ab-1", "status", '{"a":1}')) == \
+        'id: ab-1\nevent: status\ndata: {"a":1}\n\n'
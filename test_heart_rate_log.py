@@ -0,0 +1,158 @@
+from array import array
+import base64
+import pytest
+import sys
+from datetime import datetime as dt
+from heart_rate_log import HeartRateLog, format_timestamp, \
+    parse_timestamp_string
+
+
+def test_append_and_render():
+    log = HeartRateLog()
+    ts = int(dt(2021, 10, 31, 12, 0, 0).timestamp()) * 1000
+    log.append(75, "not tachycardic", ts)
+    log.append(130, "tachycardic", ts + 60999)
+    assert len(log) == 2
+    assert log[0] == {"heart_rate": 75, "status": "not tachycardic",
+                      "timestamp": "2021-10-31 12:00:00"}
+    assert log[-1] == {"heart_rate": 130, "status": "tachycardic",
+                       "timestamp": "2021-10-31 12:01:00"}
+    assert log.heart_rates.tolist() == [75, 130]
+    assert list(log.statuses) == [0, 1]
+
+
+def test_from_records_round_trip():
+    records = [{"heart_rate": 60, "status": "not tachycardic",
+                "timestamp": "2021-10-01 12:00:00"},
+               {"heart_rate": 120, "status": "tachycardic",
+                "timestamp": "2021-10-20 12:00:00"}]
+    log = HeartRateLog.from_records(records)
+    assert log == records
+    assert log.to_list() == records
+    assert log[1:] == records[1:]
+    assert list(log) == records
+    assert log == HeartRateLog.from_records(records)
+    assert HeartRateLog() == []
+
+
+@pytest.mark.parametrize("heart_rate", [-1, 65536])
+def test_append_out_of_range(heart_rate):
+    log = HeartRateLog()
+    with pytest.raises(OverflowError):
+        log.append(heart_rate, "not tachycardic", 0)
+    assert len(log.statuses) == 0
+
+
+def test_out_of_order_append_keeps_time_order():
+    log = HeartRateLog()
+    log.append(60, "not tachycardic", 100)
+    log.append(80, "not tachycardic", 300)
+    log.append(70, "not tachycardic", 200)
+    assert log.times.tolist() == [100, 200, 300]
+    assert log.heart_rates.tolist() == [60, 70, 80]
+    assert log.hr_prefix.tolist() == [0, 60, 130, 210]
+
+
+def test_reclassify_runs():
+    log = HeartRateLog()
+    for i, hr in enumerate([90, 110, 130, 150, 170]):
+        log.append(hr, "tachycardic" if hr > 100 else "not tachycardic",
+                   100 * i)
+    assert log.reclassify(None, 2, 120) == ((100, 1), 2, 1)
+    assert log.reclassify((100, 1), 2, 120) == ((300, 1), 2, 0)
+    assert log.reclassify((300, 1), 2, 120) == (None, 1, 0)
+    assert list(log.statuses) == [0, 0, 1, 1, 1]
+    assert log.tach_count == 3
+    assert log.reclassify((400, 1), 2, 120) == (None, 0, 0)
+
+
+def test_reclassify_resumes_after_out_of_order_insert():
+    log = HeartRateLog()
+    for i in range(4):
+        log.append(110, "tachycardic", 100 * i)
+    position, readings, changed = log.reclassify(None, 2, 120)
+    # Lands before the resume key, and at its timestamp
+    log.append(130, "tachycardic", 50)
+    log.append(130, "tachycardic", 100)
+    assert log.reclassify(position, 10, 120) == (None, 3, 2)
+    assert list(log.statuses) == [0, 1, 0, 1, 0, 0]
+
+
+@pytest.mark.parametrize("timestamp, expected", [
+    (0, (3, 210)),
+    (100, (3, 210)),
+    (150, (2, 150)),
+    (300, (1, 80)),
+    (301, (0, 0))])
+def test_sum_since(timestamp, expected):
+    log = HeartRateLog()
+    for hr, ts in [(60, 100), (70, 200), (80, 300)]:
+        log.append(hr, "not tachycardic", ts)
+    assert log.sum_since(timestamp) == expected
+
+
+def test_summary():
+    log = HeartRateLog()
+    assert log.summary() == {"count": 0, "average": 0, "min": None,
+                             "max": None, "tachycardic_count": 0,
+                             "tachycardic_fraction": 0.0, "last": []}
+    ts = int(dt(2021, 10, 31, 12, 0, 0).timestamp()) * 1000
+    log.append(120, "tachycardic", ts + 10000)
+    log.append(60, "not tachycardic", ts)
+    log.append(75, "not tachycardic", ts + 5000)
+    log.append(101, "tachycardic", ts + 20000)
+    summary = log.summary()
+    assert summary["count"] == 4
+    assert summary["average"] == 89
+    assert summary["min"] == 60
+    assert summary["max"] == 120
+    assert summary["tachycardic_count"] == 2
+    assert summary["tachycardic_fraction"] == 0.5
+    assert summary["last"] == {"heart_rate": 101, "status": "tachycardic",
+                               "timestamp": "2021-10-31 12:00:20"}
+
+
+def test_columns_round_trip():
+    log = HeartRateLog()
+    for hr, status, ts in [(60, "not tachycardic", 100000),
+                           (130, "tachycardic", 200500),
+                           (75, "not tachycardic", 300000)]:
+        log.append(hr, status, ts)
+    restored = HeartRateLog.from_columns(log.to_columns())
+    assert restored == log
+    assert restored.hr_prefix == log.hr_prefix
+    assert restored.summary() == log.summary()
+    assert HeartRateLog.from_columns(HeartRateLog().to_columns()) == []
+
+
+def test_columns_from_epoch_seconds():
+    # Snapshots taken before timestamps were stored in milliseconds
+    seconds = [100.0, 200.5, 300.0]
+    columns = {"heart_rates":
+               base64.b64encode(array("H", [60, 130, 75]).tobytes()).decode(),
+               "times":
+               base64.b64encode(array("d", seconds).tobytes()).decode(),
+               "statuses": base64.b64encode(bytes([0, 1, 0])).decode(),
+               "byteorder": sys.byteorder}
+    log = HeartRateLog.from_columns(columns)
+    assert log.times.typecode == "q"
+    assert log.times.tolist() == [100000, 200500, 300000]
+    assert log.tach_count == 1
+
+
+@pytest.mark.parametrize("text", ["2021-10-31 12:00:00", "2021-01-01 00:00:59",
+                                  "1999-12-31 23:59:01", "2021-3-7 4:05:06"])
+def test_timestamp_strings_round_trip(text):
+    timestamp = parse_timestamp_string(text)
+    assert timestamp == int(dt.strptime(text, "%Y-%m-%d %H:%M:%S")
+                            .timestamp()) * 1000
+    expected = dt.fromtimestamp(timestamp / 1000).strftime("%Y-%m-%d %H:%M:%S")
+    assert format_timestamp(timestamp) == expected
+    assert format_timestamp(timestamp + 999) == expected
+
+
+@pytest.mark.parametrize("text", ["2021-10-31T12:00:00", "2021-02-30 12:00:00",
+                                  "2021-10-31 12:00", "yesterday"])
+def test_invalid_timestamp_strings(text):
+    with pytest.raises(ValueError):
+        parse_timestamp_string(text)
@@ -0,0 +1,139 @@
+import os
+import threading
+from persistence import Journal
+
+
+def recover(data_dir, snapshot_every=None):
+    state = {"items": []}
+
+    def restore_state(snapshot):
+        state["items"] = list(snapshot["items"])
+
+    def apply_record(record):
+        state["items"].append(record["value"])
+    journal = Journal(data_dir, lambda: {"items": list(state["items"])},
+                      snapshot_every=snapshot_every)
+    replayed = journal.recover(restore_state, apply_record)
+    return journal, state, replayed
+
+
+def log_value(journal, state, value):
+    with journal.gate:
+        seq = journal.log({"value": value})
+        state["items"].append(value)
+    journal.wait(seq)
+
+
+def test_recover_replays_log(tmp_path):
+    journal, state, replayed = recover(str(tmp_path))
+    assert replayed == 0
+    for i in range(5):
+        log_value(journal, state, i)
+    journal.close()
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == [0, 1, 2, 3, 4]
+    assert replayed == 5
+    assert journal.seq == 5
+    journal.close()
+
+
+def test_snapshot_truncates_log_tail(tmp_path):
+    journal, state, replayed = recover(str(tmp_path))
+    for i in range(3):
+        log_value(journal, state, i)
+    assert journal.snapshot() == 3
+    for i in range(3, 5):
+        log_value(journal, state, i)
+    journal.close()
+    segments = sorted(x for x in os.listdir(str(tmp_path))
+                      if x.startswith("wal-"))
+    assert segments == ["wal-00000000000000000004.log"]
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == [0, 1, 2, 3, 4]
+    assert replayed == 2
+    journal.close()
+
+
+def test_snapshot_encodes_state_outside_gate(tmp_path):
+    state = {"items": []}
+    logged = []
+
+    def encode_state(captured):
+        # Mutations are no longer held off while encoding
+        writer = threading.Thread(target=log_value,
+                                  args=(journal, state, "during"))
+        writer.start()
+        writer.join(5)
+        logged.append(not writer.is_alive())
+        return {"items": list(captured)}
+    journal = Journal(str(tmp_path), lambda: tuple(state["items"]),
+                      snapshot_every=None, encode_state=encode_state)
+    journal.recover(lambda x: None, lambda x: None)
+    log_value(journal, state, "before")
+    assert journal.snapshot() == 1
+    assert logged == [True]
+    journal.close()
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == ["before", "during"]
+    assert replayed == 1
+    journal.close()
+
+
+def test_torn_record_is_skipped(tmp_path):
+    journal, state, replayed = recover(str(tmp_path))
+    log_value(journal, state, "a")
+    journal.close()
+    segment = os.path.join(str(tmp_path), "wal-00000000000000000001.log")
+    with open(segment, "a") as f:
+        f.write('{"value": "b", "se')
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == ["a"]
+    journal.close()
+
+
+def test_records_after_torn_tail_survive_restart(tmp_path):
+    journal, state, replayed = recover(str(tmp_path))
+    for i in range(3):
+        log_value(journal, state, i)
+    journal.close()
+    # The crash tore the first record of the next segment
+    segment = os.path.join(str(tmp_path), "wal-00000000000000000004.log")
+    with open(segment, "w") as f:
+        f.write('{"value":3,"se')
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == [0, 1, 2]
+    assert os.path.getsize(segment) == 0
+    log_value(journal, state, 10)
+    log_value(journal, state, 11)
+    journal.close()
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == [0, 1, 2, 10, 11]
+    assert journal.seq == 5
+    journal.close()
+
+
+def test_concurrent_writers_with_automatic_snapshots(tmp_path):
+    journal, state, replayed = recover(str(tmp_path), snapshot_every=50)
+    lock = threading.Lock()
+
+    def writer(n):
+        for i in range(100):
+            with journal.gate:
+                seq = journal.log({"value": [n, i]})
+                with lock:
+                    state["items"].append([n, i])
+            journal.wait(seq)
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    journal.snapshot()
+    log_value(journal, state, "last")
+    journal.close()
+    expected = state["items"]
+    journal, state, replayed = recover(str(tmp_path))
+    assert state["items"] == expected
+    assert len(expected) == 801
+    assert replayed == 1
+    journal.close()
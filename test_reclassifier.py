@@ -0,0 +1,54 @@
+import threading
+from reclassifier import Reclassifier
+from tachycardia import DEFAULT_THRESHOLDS
+
+
+def test_jobs_run_in_chunks():
+    calls = []
+
+    def step(patient_id, position, size, thresholds):
+        calls.append((patient_id, position))
+        position = (position or 0) + size
+        if position >= 5:
+            return None, size - (position - 5), 1
+        return position, size, 0
+    reclassifier = Reclassifier(step, chunk=2, pause=0)
+    job = reclassifier.submit([1, 2], DEFAULT_THRESHOLDS)
+    assert job["state"] == "queued"
+    reclassifier.join()
+    assert calls == [(1, None), (1, 2), (1, 4), (2, None), (2, 2), (2, 4)]
+    assert reclassifier.job(job["job_id"]) == {
+        "job_id": job["job_id"], "state": "done", "profile": "default",
+        "patients": 2, "patients_done": 2, "readings": 10, "changed": 2}
+    assert reclassifier.job(99) is None
+
+
+def test_failed_job_does_not_stop_the_worker():
+    started = threading.Event()
+
+    def step(patient_id, position, size, thresholds):
+        started.set()
+        if patient_id == 1:
+            raise KeyError(patient_id)
+        return None, 3, 0
+    reclassifier = Reclassifier(step, pause=0, max_jobs=1)
+    first = reclassifier.submit([1], DEFAULT_THRESHOLDS)
+    reclassifier.join()
+    assert reclassifier.job(first["job_id"])["state"] == "failed"
+    second = reclassifier.submit([2], DEFAULT_THRESHOLDS)
+    reclassifier.join()
+    assert reclassifier.job(second["job_id"])["readings"] == 3
+    assert reclassifier.job(first["job_id"]) is None
+
+
+def test_job_ids_and_updates_through_hooks():
+    published = []
+    reclassifier = Reclassifier(lambda *args: (None, 2, 1), pause=0,
+                                new_job_id=lambda: 41,
+                                on_update=published.append)
+    job = reclassifier.submit([1], DEFAULT_THRESHOLDS)
+    reclassifier.join()
+    assert job["job_id"] == 41
+    assert [x["state"] for x in published] == \
+        ["queued", "running", "running", "running", "done"]
+    assert published[-1] == reclassifier.job(41)
@@ -0,0 +1,50 @@
+from response_cache import ResponseCache, ENTRY_OVERHEAD
+
+
+def put(cache, key, body, tags):
+    cache.put(key, (body, "application/json"), tags, cache.generation(tags))
+
+
+def test_hit_miss_and_invalidate():
+    cache = ResponseCache()
+    assert cache.get(("status_pid", 1)) is None
+    put(cache, ("status_pid", 1), b"[]", (("patient", 1),))
+    put(cache, ("patients", "Smith.J"), b"[1]", (("attending", "Smith.J"),))
+    assert cache.get(("status_pid", 1)) == (b"[]", "application/json")
+    cache.invalidate(("patient", 1))
+    assert cache.get(("status_pid", 1)) is None
+    assert cache.get(("patients", "Smith.J")) is not None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == \
+        (2, 2, 1)
+    assert stats["entries"] == 1
+    assert stats["bytes"] == 3 + ENTRY_OVERHEAD
+
+
+def test_least_recently_used_is_evicted():
+    cache = ResponseCache(max_bytes=3 * (ENTRY_OVERHEAD + 10))
+    for i in range(3):
+        put(cache, ("status_pid", i), b"x" * 10, (("patient", i),))
+    cache.get(("status_pid", 0))
+    put(cache, ("status_pid", 3), b"x" * 10, (("patient", 3),))
+    assert cache.get(("status_pid", 1)) is None
+    assert cache.get(("status_pid", 0)) is not None
+    assert cache.stats()["evictions"] == 1
+    put(cache, ("status_pid", 4), b"x" * cache.max_bytes, (("patient", 4),))
+    assert cache.get(("status_pid", 4)) is None
+
+
+def test_response_built_during_a_write_is_not_cached():
+    cache = ResponseCache()
+    tags = (("patient", 1),)
+    generation = cache.generation(tags)
+    cache.invalidate(("patient", 1))
+    cache.put(("status_pid", 1), (b"stale", "application/json"), tags,
+              generation)
+    assert cache.get(("status_pid", 1)) is None
+    generation = cache.generation(tags)
+    cache.clear()
+    cache.put(("status_pid", 1), (b"stale", "application/json"), tags,
+              generation)
+    assert cache.get(("status_pid", 1)) is None
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,73 @@
+import pytest
+from schemas import Schema, HEART_RATE_SCHEMA, INTERVAL_AVERAGE_SCHEMA, \
+    NEW_PATIENT_SCHEMA
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ({"patient_id": "1", "attending_username": "Smith.J",
+      "patient_age": 30}, (1, "Smith.J", 30)),
+    ({"patient_id": 1, "attending_username": "Smith.J",
+      "patient_age": "x"},
+     "The value \"x\" in key patient_age cannot be cast to int"),
+    ({"patient_id": 1, "patient_age": 30},
+     "The key attending_username is missing from input"),
+    ({"patient_id": 1.0, "attending_username": "Smith.J",
+      "patient_age": 30}, "The key patient_id has invalid data type"),
+    ({"patient_id": True, "attending_username": "Smith.J",
+      "patient_age": 30}, "The key patient_id has invalid data type"),
+    ([1, "Smith.J", 30], "The input was not a dictionary.")])
+def test_validate(in_data, expected):
+    from sentinel_server import validate_dict_input
+    assert NEW_PATIENT_SCHEMA.validate(in_data) == expected
+    error = expected if isinstance(expected, str) else True
+    assert validate_dict_input(
+        in_data, {"patient_id": [int, str], "attending_username": [str],
+                  "patient_age": [int, str]})[0] == error
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ({"patient_id": 1, "heart_rate": "75"}, (1, 75, None)),
+    ({"patient_id": 1, "heart_rate": 75, "timestamp": 1635681600000},
+     (1, 75, 1635681600000)),
+    ({"patient_id": 1, "heart_rate": 75, "timestamp": [1]},
+     "The key timestamp has invalid data type"),
+    ({"patient_id": 1, "heart_rate": 75,
+      "timestamp": "9999-12-31 23:59:59"},
+     "The value \"9999-12-31 23:59:59\" in key timestamp is not a valid "
+     "timestamp"),
+    ({"patient_id": 1, "heart_rate": 75,
+      "timestamp": "1969-12-30 23:59:59"},
+     "The value \"1969-12-30 23:59:59\" in key timestamp is not a valid "
+     "timestamp"),
+    ({"patient_id": 1, "heart_rate": "fast", "timestamp": [1]},
+     "The value \"fast\" in key heart_rate cannot be cast to int")])
+def test_optional_keys(in_data, expected):
+    assert HEART_RATE_SCHEMA.validate(in_data) == expected
+
+
+@pytest.mark.parametrize("in_data, expected", [
+    ({"patient_id": "1", "heart_rate_average_since": "2021-10-31 12:00:00"},
+     (1, "2021-10-31 12:00:00")),
+    ({"patient_id": 1, "heart_rate_average_since": "yesterday"},
+     "The value \"yesterday\" in key heart_rate_average_since is not a "
+     "valid timestamp"),
+    ({"patient_id": 1, "heart_rate_average_since": 1635681600000},
+     "The key heart_rate_average_since has invalid data type"),
+    ({"patient_id": 1},
+     "The key heart_rate_average_since is missing from input")])
+def test_required_converter(in_data, expected):
+    from heart_rate_log import parse_timestamp_string
+    if type(expected) is tuple:
+        expected = (expected[0], parse_timestamp_string(expected[1]))
+    assert INTERVAL_AVERAGE_SCHEMA.validate(in_data) == expected
+
+
+def test_validate_many():
+    schema = Schema({"a": [int], "b": [str, int]})
+    assert schema.keys == ("a", "b")
+    assert schema.validate_many([{"a": 1, "b": "2"}, {"a": "1", "b": 2},
+                                 {"a": 1}, None]) == [
+        (1, 2), "The key a has invalid data type",
+        "The key b is missing from input",
+        "The input was not a dictionary."]
+    assert schema.validate_many([]) == []
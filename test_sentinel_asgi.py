@@ -0,0 +1,274 @@
+import asyncio
+import json
+import pytest
+import sentinel_server
+from sentinel_asgi import app
+from storage import MemoryStorage
+
+
+def call(method, path, body=b"", chunk_size=None, headers=()):
+    """Runs one request through the ASGI app with a fake server
+
+    Returns:
+        tuple: (status code, headers dict, body bytes)
+    """
+    if type(body) is not bytes:
+        body = json.dumps(body).encode()
+    chunks = [body[i:i + chunk_size]
+              for i in range(0, len(body), chunk_size)] \
+        if chunk_size else [body]
+    messages = [{"type": "http.request", "body": x,
+                 "more_body": i < len(chunks) - 1}
+                for i, x in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query.encode(), "headers": list(headers)}
+    asyncio.run(app(scope, receive, send))
+    body = b"".join(x.get("body", b"") for x in sent[1:])
+    return (sent[0]["status"], dict(sent[0]["headers"]), body)
+
+
+@pytest.fixture
+def fresh_storage():
+    previous = sentinel_server.storage
+    sentinel_server.use_storage(MemoryStorage())
+    yield sentinel_server.storage
+    sentinel_server.use_storage(previous)
+
+
+def register():
+    call("POST", "/api/new_attending",
+         {"attending_username": "Asgi.A",
+          "attending_email": "asgi@duke.edu",
+          "attending_phone": "111-222-3333"})
+    call("POST", "/api/new_patient",
+         {"patient_id": 1, "attending_username": "Asgi.A",
+          "patient_age": 20})
+
+
+def test_routes_match_flask(fresh_storage):
+    register()
+    call("POST", "/api/heart_rate/batch",
+         [{"patient_id": 1, "heart_rate": 70,
+           "timestamp": "2021-10-31 12:00:00"},
+          {"patient_id": 1, "heart_rate": 90,
+           "timestamp": "2021-10-31 13:00:00"}])
+    # Patient 2 has no readings
+    call("POST", "/api/new_patient",
+         {"patient_id": 2, "attending_username": "Asgi.A",
+          "patient_age": 20})
+    client = sentinel_server.app.test_client()
+    for path in ["/", "/api/status/1", "/api/heart_rate/1",
+                 "/api/status/2", "/api/heart_rate/2",
+                 "/api/heart_rate/average/2", "/api/heart_rate/summary/2",
+                 "/api/heart_rate/average/1", "/api/heart_rate/summary/1",
+                 "/api/patients/Asgi.A", "/api/patient_database/",
+                 "/api/attending_database/", "/api/status/x",
+                 "/api/status/7", "/api/patients/Nobody.N",
+                 "/api/heart_rate/1?limit=1&fields=readings",
+                 "/api/heart_rate/1?since=2021-10-31%2012:30:00",
+                 "/api/heart_rate/1?limit=0", "/api/thresholds"]:
+        # Both entry points share the response cache, which would hide
+        # a difference between them
+        sentinel_server.response_cache.clear()
+        status_code, headers, body = call("GET", path)
+        sentinel_server.response_cache.clear()
+        r = client.get(path)
+        assert status_code == r.status_code
+        assert body == r.data
+        assert headers[b"content-type"].decode() == r.content_type
+    body = {"patient_id": 1,
+            "heart_rate_average_since": "2021-10-31 12:30:00"}
+    status_code, headers, response = call(
+        "POST", "/api/heart_rate/interval_average", body)
+    assert (status_code, response) == (200, b"90\n")
+    body["heart_rate_average_since"] = "yesterday"
+    status_code, headers, response = call(
+        "POST", "/api/heart_rate/interval_average", body)
+    r = client.post("/api/heart_rate/interval_average", json=body)
+    assert status_code == r.status_code == 400
+    assert response == r.data
+
+
+def test_etag(fresh_storage):
+    register()
+    status_code, headers, body = call("GET", "/api/heart_rate/summary/1")
+    etag = headers[b"etag"]
+    assert etag == sentinel_server.app.test_client().get(
+        "/api/heart_rate/summary/1").headers["ETag"].encode()
+    status_code, headers, body = call(
+        "GET", "/api/heart_rate/summary/1",
+        headers=[(b"if-none-match", etag)])
+    assert (status_code, body, headers[b"etag"]) == (304, b"", etag)
+    call("POST", "/api/heart_rate", {"patient_id": 1, "heart_rate": 75})
+    status_code, headers, body = call(
+        "GET", "/api/heart_rate/summary/1",
+        headers=[(b"if-none-match", etag)])
+    assert status_code == 200
+    assert headers[b"etag"] != etag
+
+
+def test_gzip_export(fresh_storage):
+    import gzip
+    register()
+    status_code, headers, body = call(
+        "GET", "/api/patient_database/",
+        headers=[(b"accept-encoding", b"gzip")])
+    assert headers[b"content-encoding"] == b"gzip"
+    assert gzip.decompress(body) == \
+        sentinel_server.app.test_client().get("/api/patient_database/").data
+
+
+@pytest.mark.parametrize("path, body, expected", [
+    ("/api/new_attending", {"attending_username": "Asgi.A",
+                            "attending_email": "x", "attending_phone": "y"},
+     (400, b"ERROR: name not unique identifier")),
+    ("/api/new_patient", {"patient_id": 1, "attending_username": "Asgi.A",
+                          "patient_age": 30},
+     (400, b"ERROR: patient id (1) not unique identifier")),
+    ("/api/new_patient", {"patient_id": 2},
+     (400, b"The key attending_username is missing from input")),
+    ("/api/heart_rate", {"patient_id": 1, "heart_rate": 70000},
+     (400, b"Heart rate 70000 out of range")),
+    ("/api/heart_rate", {"patient_id": 5, "heart_rate": 70},
+     (400, b"ERROR: no patient with id 5 in database")),
+    ("/api/heart_rate/batch", {"patient_id": 1},
+     (400, b"The input was not a list.")),
+    ("/api/heart_rate", b"{not json", (400, b"Failed to decode JSON object")),
+])
+def test_post_errors(fresh_storage, path, body, expected):
+    register()
+    status_code, headers, response = call("POST", path, body)
+    assert (status_code, response) == expected
+
+
+def test_heart_rate_post(fresh_storage):
+    register()
+    status_code, headers, body = call("POST", "/api/heart_rate",
+                                      {"patient_id": 1, "heart_rate": 75})
+    assert status_code == 200
+    assert body.startswith(b"Added heart rate information")
+    assert fresh_storage.get_patient(1)["HR_data"].values() == [75]
+    status_code, headers, body = call("POST", "/api/heart_rate",
+                                      {"patient_id": 1, "heart_rate": 70,
+                                       "timestamp": "2021-10-31 12:00:00"})
+    assert status_code == 200
+    assert body == b"Added heart rate information 70 (not tachycardic, " \
+        b"2021-10-31 12:00:00) for patient id 1"
+    assert fresh_storage.get_patient(1)["HR_data"].values() == [70, 75]
+    status_code, headers, body = call("POST", "/api/heart_rate",
+                                      {"patient_id": 1, "heart_rate": 70,
+                                       "timestamp": None})
+    assert (status_code, body) == \
+        (400, b"The key timestamp has invalid data type")
+
+
+def test_ndjson_is_read_in_chunks(fresh_storage):
+    register()
+    lines = [json.dumps({"patient_id": 1, "heart_rate": 60 + i,
+                         "timestamp": "2021-10-31 12:00:{:02d}".format(i)})
+             for i in range(50)]
+    body = ("\n".join(lines) + "\nnot json\n").encode()
+    status_code, headers, response = call(
+        "POST", "/api/heart_rate/ndjson", body, chunk_size=7)
+    summary = json.loads(response)
+    assert status_code == 200
+    assert summary["accepted"] == 50
+    assert summary["errors"] == [{"line": 51,
+                                  "error": "Line is not valid json"}]
+    assert fresh_storage.get_patient(1)["HR_data"].values() == \
+        list(range(60, 110))
+
+
+@pytest.mark.parametrize("method, path, expected", [
+    ("GET", "/api/unknown", 404),
+    ("GET", "/api/new_patient", 405),
+])
+def test_unknown_routes(method, path, expected):
+    assert call(method, path)[0] == expected
+
+
+def test_handler_errors_give_500(fresh_storage, monkeypatch, caplog):
+    register()
+
+    def fail(*args):
+        raise RuntimeError("storage unavailable")
+
+    monkeypatch.setattr(sentinel_server, "get_patient_from_database", fail)
+    status_code, headers, body = call(
+        "POST", "/api/heart_rate", {"patient_id": 1, "heart_rate": 75})
+    assert (status_code, body) == (500, b"Internal Server Error")
+    assert "Exception on /api/heart_rate [POST]" in caplog.text
+    assert call("GET", "/api/status/1")[0] == 500
+
+
+def test_lifespan(fresh_storage, monkeypatch, tmp_path):
+    monkeypatch.setenv("SENTINEL_SQLITE_PATH", str(tmp_path / "asgi.db"))
+    messages = [{"type": "lifespan.startup"},
+                {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(app({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete",
+                    "lifespan.shutdown.complete"]
+    assert type(sentinel_server.storage).__name__ == "SQLiteStorage"
+
+
+def test_event_stream(fresh_storage):
+    register()
+    patient = fresh_storage.get_patient(1)
+    sent = []
+    disconnect = None
+
+    async def receive():
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    def stream_body():
+        return b"".join(x.get("body", b"") for x in sent[1:])
+
+    async def run():
+        nonlocal disconnect
+        disconnect = asyncio.Event()
+        scope = {"type": "http", "method": "GET",
+                 "path": "/api/stream/patient/1", "headers": [],
+                 "query_string": b""}
+        task = asyncio.ensure_future(app(scope, receive, send))
+        while len(sent) < 2:
+            await asyncio.sleep(0.01)
+        sentinel_server.add_heart_rate(patient, 75)
+        while b"event: status" not in stream_body():
+            await asyncio.sleep(0.01)
+        disconnect.set()
+        await asyncio.wait_for(task, 5)
+
+    asyncio.run(run())
+    assert sent[0]["status"] == 200
+    assert dict(sent[0]["headers"])[b"content-type"] == \
+        b"text/event-stream; charset=utf-8"
+    assert sent[1]["body"] == b"retry: 2000\n\n"
+    events = stream_body().decode().split("\n\n")[1:]
+    assert events[0].split("\n")[1] == "event: heart_rate"
+    assert events[1].split("\n")[1] == "event: status"
+    assert sentinel_server.event_broker.subscriber_count("patient:1") == 0
+    status_code, headers, body = call("GET", "/api/stream/patient/x")
+    assert (status_code, body) == (400, b"Invalid patient ID")
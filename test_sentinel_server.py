@@ -4,6 +4,12 @@ from sentinel_server import get_last_heart_rate, get_patient_from_database
 from sentinel_server import patient_database
 from sentinel_server import attending_database
 from testfixtures import LogCapture
+from heart_rate_log import HeartRateLog
+
+
+def at(*args):
+    # Stored timestamp, in epoch milliseconds, of a local time
+    return int(dt(*args).timestamp()) * 1000
 
 
 @pytest.mark.parametrize("input, expected", [
@@ -56,7 +62,7 @@ def test_add_patient_to_database(pat_id, att_name, pat_age):
 
     add_attending_to_database(att_name, att_name + "@duke.edu", "123-456-7890")
     add_patient_to_database(pat_id, att_name, pat_age)
-    added_patient = patient_database[-1]
+    added_patient = patient_database[str_to_int(pat_id)[0]]
     testPatient = {
             "id": str_to_int(pat_id)[0],
             "age": str_to_int(pat_age)[0],
@@ -69,18 +75,28 @@ def test_add_patient_to_database(pat_id, att_name, pat_age):
 def test_add_patient_to_database_log():
     from sentinel_server import add_patient_to_database
     pat, att = initialize_db()
+    patient_database.clear()
     with LogCapture() as log_c:
         add_patient_to_database(pat["id"], pat["attending"],
                                 pat["age"])
     log_c.check(('root', 'INFO', 'Registered new patient with ID 1'),)
 
 
+def test_add_patient_to_database_duplicate():
+    from sentinel_server import add_patient_to_database
+    pat, att = initialize_db()
+    answer = add_patient_to_database(pat["id"], pat["attending"], 50)
+    assert answer == "ERROR: patient id (1) not unique identifier"
+    assert patient_database[1] is pat
+    assert att["patients"] == [pat]
+
+
 def test_get_patient_from_database():
     from sentinel_server import get_patient_from_database
     from sentinel_server import patient_database
 
     initialize_db()
-    for patient in patient_database:
+    for patient in patient_database.values():
         assert patient == get_patient_from_database(patient["id"])
 
 
@@ -106,6 +122,7 @@ def test_add_attending_to_database(att_name, att_email, att_phone):
 def test_add_attending_to_database_log():
     from sentinel_server import add_attending_to_database
     pat, att = initialize_db()
+    attending_database.clear()
     with LogCapture() as log_c:
         add_attending_to_database(att["name"], att["email"],
                                   att["phone"])
@@ -113,6 +130,16 @@ def test_add_attending_to_database_log():
                  'with username Smith.J and email dr_smith@gmail.com'),)
 
 
+def test_add_attending_to_database_duplicate():
+    from sentinel_server import add_attending_to_database
+    pat, att = initialize_db()
+    answer = add_attending_to_database(att["name"], "other@duke.edu",
+                                       "999-999-9999")
+    assert answer == "ERROR: name not unique identifier"
+    assert attending_database["Smith.J"] is att
+    assert att["patients"] == [pat]
+
+
 def test_get_attending_from_database():
     from sentinel_server import get_attending_from_database
     from sentinel_server import attending_database
@@ -121,7 +148,7 @@ def test_get_attending_from_database():
     #     print(c)
 
     initialize_db()
-    for attendant in attending_database:
+    for attendant in attending_database.values():
         assert attendant == get_attending_from_database(attendant["name"])
 
 
@@ -136,19 +163,21 @@ def tach_warning(patient, hr):
 
 
 @pytest.mark.parametrize("patient, heart_rate, expected", [
-    ({"id": 1, "age": 50, "attending": "Richardson.L", "HR_data": []},
+    ({"id": 1, "age": 50, "attending": "Richardson.L",
+      "HR_data": HeartRateLog()},
      60,
      [{"heart_rate": 60, "status": "not tachycardic",
-      "timestamp": (dt.now()).strftime("%Y-%m-%d %H:%M:%S")}]),
+      "timestamp": None}]),
     ({"id": 2, "age": 20, "attending": "Kidney.S",
-      "HR_data": [{"heart_rate": 60,
-                   "status": "not tachycardic",
-                   "timestamp": "2021-10-31 12:00:00"}]},
+      "HR_data": HeartRateLog.from_records(
+          [{"heart_rate": 60,
+            "status": "not tachycardic",
+            "timestamp": "2021-10-31 12:00:00"}])},
      120,
      [{"heart_rate": 60, "status": "not tachycardic",
        "timestamp": "2021-10-31 12:00:00"},
       {"heart_rate": 120, "status": "tachycardic",
-       "timestamp": (dt.now()).strftime("%Y-%m-%d %H:%M:%S")}])
+       "timestamp": None}])
      ])
 def test_add_heart_rate(patient, heart_rate, expected):
     from sentinel_server import add_heart_rate, is_tachycardic
@@ -156,10 +185,467 @@ def test_add_heart_rate(patient, heart_rate, expected):
     att_name = patient["attending"]
     add_attending_to_database(att_name, att_name + "@duke.edu", "123-456-7890")
     add_heart_rate(patient, heart_rate)
+    # The new reading is stamped with the time it was added
+    expected[-1]["timestamp"] = (dt.now()).strftime("%Y-%m-%d %H:%M:%S")
     answer = patient["HR_data"]
     assert answer == expected
 
 
+def test_tach_alert_suppresses_repeats():
+    from sentinel_server import tach_alert, alert_policy
+    from sentinel_server import add_attending_to_database
+    from sentinel_server import add_patient_to_database
+    initialize_db()
+    add_attending_to_database("Alert.T", "alert@duke.edu", "123-456-7890")
+    pat = add_patient_to_database(901, "Alert.T", 40)
+    with LogCapture() as log_c:
+        assert tach_alert(pat, 120) == "send"
+        assert tach_alert(pat, 125) == "suppress"
+    log_c.check(('root', 'WARNING', 'Tachycardic heart rate of 120 posted '
+                 'for patient ID 901. Contacting attending via email: '
+                 'alert@duke.edu'),)
+    assert alert_policy.suppressed_count(901) == 1
+
+
+def test_add_heart_rate_batch():
+    from sentinel_server import add_heart_rate_batch
+    from sentinel_server import add_patient_to_database
+    pat, att = initialize_db()
+    pat2 = add_patient_to_database(2, "Smith.J", 5)
+    records = [{"patient_id": 1, "heart_rate": 70,
+                "timestamp": "2021-10-31 12:00:00"},
+               {"patient_id": "2", "heart_rate": "140",
+                "timestamp": "2021-10-31 12:00:01"},
+               {"patient_id": 3, "heart_rate": 70},
+               {"patient_id": 1, "heart_rate": "fast"},
+               {"patient_id": 1, "heart_rate": 80,
+                "timestamp": "yesterday"},
+               {"patient_id": 1, "heart_rate": 65,
+                "timestamp": "2021-10-31 11:59:00"},
+               "Potato",
+               {"patient_id": 1, "heart_rate": 66,
+                "timestamp": at(2021, 10, 31, 11, 58, 0) + 250},
+               {"patient_id": 1, "heart_rate": 67, "timestamp": -1},
+               {"patient_id": 1, "heart_rate": 68, "timestamp": 1.5}]
+    results = add_heart_rate_batch(records)
+    assert results == [
+        {"patient_id": 1, "heart_rate": 70, "status": "not tachycardic",
+         "timestamp": "2021-10-31 12:00:00"},
+        {"patient_id": 2, "heart_rate": 140, "status": "tachycardic",
+         "timestamp": "2021-10-31 12:00:01"},
+        {"error": "ERROR: no patient with id 3 in database"},
+        {"error": "The value \"fast\" in key heart_rate cannot be cast "
+                  "to int"},
+        {"error": "The value \"yesterday\" in key timestamp is not a "
+                  "valid timestamp"},
+        {"patient_id": 1, "heart_rate": 65, "status": "not tachycardic",
+         "timestamp": "2021-10-31 11:59:00"},
+        {"error": "The input was not a dictionary."},
+        {"patient_id": 1, "heart_rate": 66, "status": "not tachycardic",
+         "timestamp": "2021-10-31 11:58:00"},
+        {"error": "The value \"-1\" in key timestamp is not a valid "
+                  "timestamp"},
+        {"error": "The key timestamp has invalid data type"}]
+    assert pat["HR_data"].heart_rates.tolist() == [66, 65, 70]
+    assert pat["HR_data"].times[0] == at(2021, 10, 31, 11, 58, 0) + 250
+    assert pat2["HR_data"].heart_rates.tolist() == [140]
+
+
+def test_add_heart_rate_batch_classifies_each_patient_once(monkeypatch):
+    import sentinel_server
+    from sentinel_server import add_heart_rate_batch
+    from sentinel_server import add_patient_to_database
+    pat, att = initialize_db()
+    pat2 = add_patient_to_database(2, "Smith.J", 5)
+    columns = []
+
+    def classify_column(heart_rates, limit):
+        columns.append((heart_rates, limit))
+        return bytes(x > limit for x in heart_rates)
+
+    def is_tachycardic(hr, age):
+        raise AssertionError("batch readings classified one at a time")
+
+    monkeypatch.setattr(sentinel_server, "classify_column", classify_column)
+    monkeypatch.setattr(sentinel_server, "is_tachycardic", is_tachycardic)
+    monkeypatch.setattr(sentinel_server, "tach_alert", lambda *args: None)
+    records = [{"patient_id": 1, "heart_rate": 70},
+               {"patient_id": 2, "heart_rate": 140},
+               {"patient_id": 1, "heart_rate": 120},
+               {"patient_id": 2, "heart_rate": 130}]
+    results = add_heart_rate_batch(records)
+    assert [x["status"] for x in results] == [
+        "not tachycardic", "tachycardic", "tachycardic", "not tachycardic"]
+    assert columns == [([70, 120], 100), ([140, 130], 133)]
+    assert pat["HR_data"].statuses == bytearray([0, 1])
+    assert pat2["HR_data"].statuses == bytearray([1, 0])
+
+
+def test_mutating_routes_acknowledge_concisely():
+    from sentinel_server import app
+    patient_database.clear()
+    attending_database.clear()
+    client = app.test_client()
+    r = client.post("/api/new_attending",
+                    json={"attending_username": "Smith.J",
+                          "attending_email": "js@duke.edu",
+                          "attending_phone": "111-222-3333"})
+    assert r.data == b"Added attending Smith.J"
+    r = client.post("/api/new_patient",
+                    json={"patient_id": "1", "attending_username": "Smith.J",
+                          "patient_age": 20})
+    assert r.data == b"Added patient 1"
+    r = client.post("/api/heart_rate",
+                    json={"patient_id": "1", "heart_rate": 75,
+                          "timestamp": "2021-10-31 12:00:00"})
+    assert r.data == b"Added heart rate information 75 (not tachycardic, " \
+        b"2021-10-31 12:00:00) for patient id 1"
+
+
+def test_jsonify_encodes_compactly():
+    import json
+    from sentinel_server import app
+    from flask import jsonify
+    log = HeartRateLog()
+    log.append(75, "not tachycardic", at(2021, 10, 31, 12, 0, 0))
+    with app.app_context():
+        assert jsonify({"b": 1, "a": "x"}).data == b'{"a":"x","b":1}\n'
+        assert jsonify(1, 2).data == b"[1,2]\n"
+        assert jsonify(b=1).data == b'{"b":1}\n'
+        assert jsonify().data == b"null\n"
+        assert jsonify(log).get_json() == log.to_list()
+        with pytest.raises(TypeError):
+            jsonify(1, b=2)
+        app.debug = True
+        try:
+            assert json.loads(jsonify(log).data) == log.to_list()
+            assert b"\n  " in jsonify({"a": 1}).data
+        finally:
+            app.debug = False
+
+
+def test_heart_rate_route_accepts_timestamps():
+    from sentinel_server import app
+    pat, att = initialize_db()
+    client = app.test_client()
+    for timestamp in [at(2021, 10, 31, 12, 0, 5) + 999,
+                      "2021-10-31 12:00:00"]:
+        r = client.post("/api/heart_rate",
+                        json={"patient_id": 1, "heart_rate": 70,
+                              "timestamp": timestamp})
+        assert r.status_code == 200
+    r = client.post("/api/heart_rate", json={"patient_id": 1,
+                                             "heart_rate": 70,
+                                             "timestamp": "noon"})
+    assert (r.status_code, r.get_data(as_text=True)) == \
+        (400, "The value \"noon\" in key timestamp is not a valid "
+              "timestamp")
+    assert pat["HR_data"].to_list() == [
+        {"heart_rate": 70, "status": "not tachycardic",
+         "timestamp": "2021-10-31 12:00:00"},
+        {"heart_rate": 70, "status": "not tachycardic",
+         "timestamp": "2021-10-31 12:00:05"}]
+
+
+def test_ingest_ndjson():
+    import io
+    from sentinel_server import ingest_ndjson
+    pat, att = initialize_db()
+    body = (b'{"patient_id": 1, "heart_rate": 70}\n'
+            b'\n'
+            b'{"patient_id": 1, "heart_rate": 71}\n'
+            b'not json\n'
+            b'{"patient_id": 7, "heart_rate": 72}\n'
+            b'{"patient_id": 1, "heart_rate": 73}')
+    summary = ingest_ndjson(io.BytesIO(body), chunk_size=2)
+    assert summary == {
+        "lines": 6, "accepted": 3, "rejected": 2, "chunks": 2,
+        "errors": [{"line": 4, "error": "Line is not valid json"},
+                   {"line": 5,
+                    "error": "ERROR: no patient with id 7 in database"}]}
+    assert pat["HR_data"].heart_rates.tolist() == [70, 71, 73]
+
+
+def test_enable_persistence_recovers_state(tmp_path):
+    from sentinel_server import (enable_persistence, add_heart_rate,
+                                 add_patient_to_database, storage)
+    initialize_db()
+    patient_database.clear()
+    attending_database.clear()
+    journal = enable_persistence(str(tmp_path), snapshot_every=None)
+    try:
+        pat, att = initialize_db()
+        add_heart_rate(pat, 70, at(2021, 10, 31, 12, 0, 0))
+        journal.snapshot()
+        pat2 = add_patient_to_database(2, "Smith.J", 4)
+        add_heart_rate(pat2, 150, at(2021, 10, 31, 12, 0, 5))
+        add_heart_rate(pat, 72, at(2021, 10, 31, 12, 0, 10))
+        expected_patients = {k: dict(v) for k, v in patient_database.items()}
+    finally:
+        storage.disable_journal()
+    patient_database.clear()
+    attending_database.clear()
+    enable_persistence(str(tmp_path), snapshot_every=None)
+    storage.disable_journal()
+    assert patient_database == expected_patients
+    assert patient_database[2]["HR_data"][0]["status"] == "tachycardic"
+    assert attending_database["Smith.J"]["patients"] == [
+        patient_database[1], patient_database[2]]
+
+
+def test_stream_events():
+    from sentinel_server import app, add_heart_rate
+    from sentinel_server import add_patient_to_database
+    initialize_db()
+    pat = add_patient_to_database(950, "Smith.J", 40)
+    client = app.test_client()
+    assert client.get("/api/stream/patient/951").status_code == 400
+    assert client.get("/api/stream/attending/Nobody.N").status_code == 400
+    r = client.get("/api/stream/attending/Smith.J")
+    assert r.mimetype == "text/event-stream"
+    add_heart_rate(pat, 70, at(2031, 10, 31, 12, 0, 0))
+    add_heart_rate(pat, 71, at(2031, 10, 31, 12, 0, 1))
+    add_heart_rate(pat, 90, at(2031, 10, 31, 11, 0, 0))
+    stream = r.iter_encoded()
+    assert next(stream) == b"retry: 2000\n\n"
+    events = [next(stream).decode().split("\n") for x in range(4)]
+    r.close()
+    assert [x[1] for x in events] == ["event: heart_rate", "event: status",
+                                      "event: heart_rate",
+                                      "event: heart_rate"]
+    assert events[1][2] == ('data: {"patient_id":950,'
+                            '"status":"not tachycardic","previous":null,'
+                            '"timestamp":"2031-10-31 12:00:00"}')
+    assert events[3][2] == ('data: {"heart_rate":90,'
+                            '"status":"not tachycardic",'
+                            '"timestamp":"2031-10-31 11:00:00",'
+                            '"patient_id":950}')
+    r = client.get("/api/stream/attending/Smith.J",
+                   headers={"Last-Event-ID": events[1][0][4:]})
+    stream = r.iter_encoded()
+    next(stream)
+    resumed = [next(stream).decode().split("\n")[0] for x in range(2)]
+    r.close()
+    assert resumed == [events[2][0], events[3][0]]
+    r = client.get("/api/stream/patient/950?last_event_id=" +
+                   events[1][0][4:])
+    stream = r.iter_encoded()
+    next(stream)
+    assert next(stream).decode().split("\n")[1] == "event: reset"
+    r.close()
+
+
+def test_status_follows_epoch_timestamps():
+    from sentinel_server import add_heart_rate, patient_status
+    from sentinel_server import add_patient_to_database
+    initialize_db()
+    pat = add_patient_to_database(952, "Smith.J", 40)
+    noon = at(2031, 10, 31, 12, 0, 0)
+    add_heart_rate(pat, 120, noon + 500)
+    # Back-filled within the same rendered second
+    add_heart_rate(pat, 70, noon + 100)
+    assert patient_status[952] == (noon + 500, "tachycardic")
+    add_heart_rate(pat, 70, noon + 900)
+    assert patient_status[952] == (noon + 900, "not tachycardic")
+
+
+def test_patients_route_serves_summary(capsys):
+    from sentinel_server import app, add_heart_rate
+    pat, att = initialize_db()
+    client = app.test_client()
+    r = client.get("/api/patients/Smith.J")
+    assert r.get_json() == [{"patient_id": 1, "last_heart_rate": [],
+                             "last_time": [], "status": []}]
+    add_heart_rate(pat, 75, at(2021, 10, 31, 12, 0, 0))
+    r = client.get("/api/patients/Smith.J")
+    assert r.mimetype == "application/json"
+    assert r.data == (b'[{"last_heart_rate":75,'
+                      b'"last_time":"2021-10-31 12:00:00",'
+                      b'"patient_id":1,"status":"not tachycardic"}]\n')
+    assert client.get("/api/patients/Nobody.N").data == \
+        b"ERROR: no attending in database"
+    assert capsys.readouterr().out == ""
+
+
+def test_get_routes_are_cached_until_written():
+    from sentinel_server import app, add_heart_rate, response_cache
+    from sentinel_server import add_patient_to_database
+    pat, att = initialize_db()
+    client = app.test_client()
+    before = response_cache.stats()
+    empty = "ERROR: no heart rate values saved for patient"
+    assert client.get("/api/heart_rate/1").get_json() == empty
+    assert client.get("/api/heart_rate/1").get_json() == empty
+    assert client.get("/api/patients/Smith.J").status_code == 200
+    add_heart_rate(pat, 75, at(2021, 10, 31, 12, 0, 0))
+    assert client.get("/api/heart_rate/1").get_json() == [75]
+    assert client.get("/api/patients/Smith.J").get_json()[0][
+        "last_heart_rate"] == 75
+    add_patient_to_database(2, "Smith.J", 30)
+    assert len(client.get("/api/patients/Smith.J").get_json()) == 2
+    assert client.get("/api/heart_rate/7").status_code == 400
+    after = client.get("/api/cache/stats").get_json()
+    assert after["hits"] - before["hits"] == 1
+    assert after["misses"] - before["misses"] == 6
+
+
+def test_etag_answers_not_modified_until_written():
+    from sentinel_server import app, add_heart_rate
+    pat, att = initialize_db()
+    client = app.test_client()
+    r = client.get("/api/status/1")
+    etag = r.headers["ETag"]
+    assert r.headers["Cache-Control"] == "no-cache"
+    for header in [etag, "W/" + etag, '"other", ' + etag, "*"]:
+        r = client.get("/api/status/1", headers={"If-None-Match": header})
+        assert (r.status_code, r.data) == (304, b"")
+        assert r.headers["ETag"] == etag
+    patients = client.get("/api/patients/Smith.J").headers["ETag"]
+    add_heart_rate(pat, 75, at(2021, 10, 31, 12, 0, 0))
+    r = client.get("/api/status/1", headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    r = client.get("/api/patients/Smith.J",
+                   headers={"If-None-Match": patients})
+    assert r.status_code == 200
+    assert "ETag" not in client.get("/api/status/7").headers
+
+
+def test_heart_rate_history_pages():
+    from sentinel_server import app, add_heart_rate, response_cache
+    pat, att = initialize_db()
+    for i in range(5):
+        add_heart_rate(pat, 60 + i, at(2021, 10, 31, 12, i, 0))
+    client = app.test_client()
+    assert client.get("/api/heart_rate/1").get_json() == [60, 61, 62, 63, 64]
+    r = client.get("/api/heart_rate/1?limit=2")
+    assert r.get_json()["heart_rates"] == [60, 61]
+    r = client.get("/api/heart_rate/1?limit=2&cursor=" +
+                   r.get_json()["next_cursor"])
+    assert r.get_json()["heart_rates"] == [62, 63]
+    r = client.get("/api/heart_rate/1?since=2021-10-31 12:01:00"
+                   "&until=2021-10-31 12:03:00&fields=readings")
+    assert r.get_json() == {"heart_rates": [
+        {"heart_rate": 61, "status": "not tachycardic",
+         "timestamp": "2021-10-31 12:01:00"},
+        {"heart_rate": 62, "status": "not tachycardic",
+         "timestamp": "2021-10-31 12:02:00"}], "next_cursor": None}
+    before = response_cache.stats()["hits"]
+    assert client.get("/api/heart_rate/1?limit=2").get_json()[
+        "heart_rates"] == [60, 61]
+    assert response_cache.stats()["hits"] == before + 1
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("limit=0", "ERROR: limit must be a positive integer"),
+    ("limit=x", "ERROR: limit must be a positive integer"),
+    ("since=yesterday",
+     "ERROR: since must be formatted as \"2018-03-09 11:00:36\""),
+    ("fields=all", "ERROR: fields must be \"values\" or \"readings\""),
+    ("cursor=bm9wZQ==", "ERROR: invalid cursor"),
+])
+def test_heart_rate_history_errors(query, expected):
+    from sentinel_server import app
+    initialize_db()
+    r = app.test_client().get("/api/heart_rate/1?" + query)
+    assert (r.status_code, r.get_data(as_text=True)) == (400, expected)
+
+
+def test_database_dumps_stream(monkeypatch):
+    import gzip
+    import sentinel_server
+    from sentinel_server import (app, add_heart_rate, add_patient_to_database,
+                                 export_database)
+    monkeypatch.setattr(sentinel_server, "EXPORT_READINGS", 3)
+    monkeypatch.setattr(sentinel_server, "EXPORT_BLOCK_BYTES", 100)
+    pat, att = initialize_db()
+    add_patient_to_database(2, "Smith.J", 30)
+    for i in range(7):
+        add_heart_rate(pat, 60 + i, at(2021, 10, 31, 12, i, 0))
+    blocks = export_database("patients")
+    assert next(blocks) == b"["
+    assert len(list(blocks)) > 2
+    client = app.test_client()
+    with app.test_request_context():
+        expected = sentinel_server.jsonify(
+            sentinel_server.storage.patient_list()).get_data()
+    r = client.get("/api/patient_database/")
+    assert r.is_streamed
+    assert r.data == expected
+    assert r.headers["Vary"] == "Accept-Encoding"
+    r = client.get("/api/patient_database/",
+                   headers={"Accept-Encoding": "br, gzip;q=0.8"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(r.data) == expected
+    r = client.get("/api/attending_database/",
+                   headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in r.headers
+    assert r.get_json() == [{"name": "Smith.J",
+                             "email": "dr_smith@gmail.com",
+                             "phone": "111-222-3333", "patients": [1, 2]}]
+
+
+def test_threshold_profiles_and_reclassification():
+    import sentinel_server
+    from sentinel_server import app, add_heart_rate, reclassifier
+    from tachycardia import DEFAULT_THRESHOLDS
+    pat, att = initialize_db()
+    for i, hr in enumerate([95, 105, 115]):
+        add_heart_rate(pat, hr, at(2021, 10, 31, 12, i, 0))
+    client = app.test_client()
+    assert client.get("/api/status/1").get_json()["status"] == "tachycardic"
+    profile = {"version": "strict", "bands": [[1, 3, 151]], "default": 110}
+    try:
+        r = client.post("/api/thresholds", json=profile)
+        assert r.data == b"Loaded threshold profile strict"
+        assert client.get("/api/thresholds").get_json()["active"] == "strict"
+        # New readings use the profile, stored ones wait for reclassify
+        assert add_heart_rate(pat, 108)["status"] == "not tachycardic"
+        r = client.post("/api/reclassify", json={})
+        job = r.get_json()
+        assert job["profile"] == "strict"
+        reclassifier.join()
+        job = client.get("/api/reclassify/{}".format(job["job_id"])).get_json()
+        assert (job["state"], job["readings"], job["changed"]) == \
+            ("done", 4, 1)
+        assert [x["status"] for x in pat["HR_data"]] == \
+            ["not tachycardic"] * 2 + ["tachycardic", "not tachycardic"]
+        r = client.post("/api/patient_age",
+                        json={"patient_id": 1, "patient_age": 2})
+        assert r.get_json()["patients"] == 1
+        reclassifier.join()
+        assert pat["age"] == 2
+        assert pat["HR_data"].summary()["tachycardic_count"] == 0
+        assert client.post("/api/thresholds",
+                           json=dict(profile, default=90)).status_code == 400
+        r = client.post("/api/thresholds/activate",
+                        json={"version": "default"})
+        assert r.data == b"Activated threshold profile default"
+        assert sentinel_server.tach_thresholds is DEFAULT_THRESHOLDS
+    finally:
+        sentinel_server.tach_thresholds = DEFAULT_THRESHOLDS
+
+
+@pytest.mark.parametrize("path, body, expected", [
+    ("/api/thresholds", {"version": "x", "bands": [], "default": 100,
+                         "activate": "yes"},
+     "The key activate has invalid data type"),
+    ("/api/thresholds/activate", {"version": "missing"},
+     "ERROR: no threshold profile missing"),
+    ("/api/reclassify", {"patient_id": 7},
+     "ERROR: no patient with id 7 in database"),
+    ("/api/patient_age", {"patient_id": 1},
+     "The key patient_age is missing from input"),
+])
+def test_threshold_admin_errors(path, body, expected):
+    from sentinel_server import app
+    initialize_db()
+    r = app.test_client().post(path, json=body)
+    assert (r.status_code, r.get_data(as_text=True)) == (400, expected)
+    r = app.test_client().get("/api/reclassify/12345")
+    assert r.status_code == 400
+
+
 def test_get_last_heart_rate():
     from sentinel_server import get_last_heart_rate
     from sentinel_server import add_heart_rate
@@ -201,20 +687,22 @@ def test_is_tachycardic(hr, age, expected):
 
 
 @pytest.mark.parametrize("patient, expected", [
-    ({"id": 1, "age": 50, "HR_data": []},
+    ({"id": 1, "age": 50, "HR_data": HeartRateLog()},
      "ERROR: no heart rate values saved for patient"),
     ({"id": 2, "age": 20,
-      "HR_data": [{"heart_rate": 60,
-                   "status": "not tachycardic",
-                   "timestamp": "2021-10-31 12:00:00"}]},
+      "HR_data": HeartRateLog.from_records(
+          [{"heart_rate": 60,
+            "status": "not tachycardic",
+            "timestamp": "2021-10-31 12:00:00"}])},
      [60]),
     ({"id": 3, "age": 40,
-      "HR_data": [{"heart_rate": 60,
-                   "status": "not tachycardic",
-                   "timestamp": "2021-10-31 12:00:00"},
-                  {"heart_rate": 120,
-                   "status": "tachycardic",
-                   "timestamp": "2021-10-31 18:00:00"}]},
+      "HR_data": HeartRateLog.from_records(
+          [{"heart_rate": 60,
+            "status": "not tachycardic",
+            "timestamp": "2021-10-31 12:00:00"},
+           {"heart_rate": 120,
+            "status": "tachycardic",
+            "timestamp": "2021-10-31 18:00:00"}])},
      [60, 120])])
 def test_prev_heart_rate(patient, expected):
     from sentinel_server import prev_heart_rate
@@ -234,25 +722,27 @@ def test_heart_rate_average(hr_list, expected):
 
 @pytest.mark.parametrize("interval_time, patient, expected", [
     ("2020-01-01 06:00:00",
-     {"id": 1, "age": 50, "HR_data": []},
+     {"id": 1, "age": 50, "HR_data": HeartRateLog()},
      "ERROR: no heart rate values saved for patient"),
     ("2021-10-31 06:00:00",
      {"id": 2, "age": 20,
-      "HR_data": [{"heart_rate": 60,
-                   "status": "not tachycardic",
-                   "timestamp": "2021-10-30 12:00:00"}]},
+      "HR_data": HeartRateLog.from_records(
+          [{"heart_rate": 60,
+            "status": "not tachycardic",
+            "timestamp": "2021-10-30 12:00:00"}])},
      []),
     ("2021-10-15 06:00:00",
      {"id": 3, "age": 20,
-      "HR_data": [{"heart_rate": 60,
-                   "status": "not tachycardic",
-                   "timestamp": "2021-10-01 12:00:00"},
-                  {"heart_rate": 120, "status":
-                   "tachycardic",
-                   "timestamp": "2021-10-20 12:00:00"},
-                  {"heart_rate": 65,
-                   "status": "not tachycardic",
-                   "timestamp": "2021-10-31 12:00:00"}]},
+      "HR_data": HeartRateLog.from_records(
+          [{"heart_rate": 60,
+            "status": "not tachycardic",
+            "timestamp": "2021-10-01 12:00:00"},
+           {"heart_rate": 120, "status":
+            "tachycardic",
+            "timestamp": "2021-10-20 12:00:00"},
+           {"heart_rate": 65,
+            "status": "not tachycardic",
+            "timestamp": "2021-10-31 12:00:00"}])},
      [120, 65])])
 def test_heart_rate_interval(interval_time, patient, expected):
     from sentinel_server import heart_rate_interval
@@ -260,6 +750,28 @@ def test_heart_rate_interval(interval_time, patient, expected):
     assert answer == expected
 
 
+@pytest.mark.parametrize("interval_time, expected", [
+    ("2021-10-15 06:00:00", 92),
+    ("2021-10-20 12:00:00", 65),
+    ("2021-10-31 12:00:00", 0),
+    ("2021-09-01 00:00:00", 81)])
+def test_heart_rate_interval_average(interval_time, expected):
+    from sentinel_server import heart_rate_interval_average
+    patient = {"id": 3, "age": 20,
+               "HR_data": HeartRateLog.from_records(
+                   [{"heart_rate": 60,
+                     "status": "not tachycardic",
+                     "timestamp": "2021-10-01 12:00:00"},
+                    {"heart_rate": 120,
+                     "status": "tachycardic",
+                     "timestamp": "2021-10-20 12:00:00"},
+                    {"heart_rate": 65,
+                     "status": "not tachycardic",
+                     "timestamp": "2021-10-31 12:00:00"}])}
+    answer = heart_rate_interval_average(interval_time, patient)
+    assert answer == expected
+
+
 @pytest.mark.parametrize("input, expected", [
     (60, (60, True)),
     (-4, (-4, True)),
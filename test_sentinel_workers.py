@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import time
+import pytest
+import requests
+from sentinel_workers import open_listener
+
+
+@pytest.fixture
+def workers_url(tmp_path):
+    sock = open_listener("127.0.0.1", 0)
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "sentinel_workers.py"),
+         "--workers", "2", "--port", str(port),
+         "--sqlite", str(tmp_path / "shared.db")], cwd=str(tmp_path))
+    url = "http://127.0.0.1:{}".format(port)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            requests.get(url, timeout=1)
+            break
+        except requests.ConnectionError:
+            if time.monotonic() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.05)
+    yield url
+    server.terminate()
+    server.wait(10)
+
+
+def test_workers_share_one_store(workers_url):
+    requests.post(workers_url + "/api/new_attending",
+                  json={"attending_username": "Smith.J",
+                        "attending_email": "js@duke.edu",
+                        "attending_phone": "111-222-3333"})
+    requests.post(workers_url + "/api/new_patient",
+                  json={"patient_id": 1, "attending_username": "Smith.J",
+                        "patient_age": 40})
+    expected = []
+    for i in range(20):
+        # New connections are spread across workers, so each read may
+        # be served by a different worker than the preceding write
+        r = requests.post(workers_url + "/api/heart_rate",
+                          json={"patient_id": 1, "heart_rate": 60 + i})
+        assert r.status_code == 200
+        expected.append(60 + i)
+        r = requests.get(workers_url + "/api/heart_rate/1")
+        assert r.json() == expected
+    r = requests.post(workers_url + "/api/new_patient",
+                      json={"patient_id": 1,
+                            "attending_username": "Smith.J",
+                            "patient_age": 40})
+    assert r.status_code == 400
@@ -0,0 +1,92 @@
+import json
+import pytest
+import serialization
+from heart_rate_log import HeartRateLog, render_reading
+from response_cache import ResponseCache
+from serialization import encode_json, encode_page, encode_reading, \
+    encode_readings
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(serialization, "orjson", None)
+    return request.param
+
+
+@pytest.mark.parametrize("value", [
+    {"b": 1, "a": [1, 2.5, None, True], "c": {"z": "x", "y": []}},
+    [0.1, 1 / 3, -0.0, 10 ** 6, "tachycardic"],
+    {"heart_rates": [], "next_cursor": None},
+    2 ** 70])
+def test_encode_json_matches_json(encoder, value):
+    assert encode_json(value) == json.dumps(
+        value, sort_keys=True, separators=(",", ":")).encode()
+
+
+def test_encode_json_default(encoder):
+    class Series:
+        def to_list(self):
+            return [1, 2]
+    assert encode_json({"HR_data": Series()},
+                       lambda o: o.to_list()) == b'{"HR_data":[1,2]}'
+    with pytest.raises(TypeError):
+        encode_json(object())
+
+
+def test_encode_readings():
+    rows = [(75, 0, 1635681600000), (130, 1, 1635681660999),
+            (75, 1, 1635681600000)]
+    expected = json.dumps([render_reading(*x) for x in rows],
+                          sort_keys=True, separators=(",", ":")).encode()
+    assert encode_readings(rows) == expected
+    assert encode_readings([]) == b"[]"
+
+
+@pytest.mark.parametrize("row", [
+    (0, 0, 0), (75, 0, 1635681600000), (65535, 1, 1635681660999)])
+def test_encode_reading(row):
+    assert encode_reading(*row) == json.dumps(
+        render_reading(*row), sort_keys=True, separators=(",", ":")).encode()
+
+
+@pytest.fixture
+def blocks(monkeypatch):
+    monkeypatch.setattr(serialization, "ENCODED_BLOCK", 100)
+    cache = ResponseCache()
+    monkeypatch.setattr(serialization, "encoded_blocks", cache)
+    return cache
+
+
+@pytest.mark.parametrize("since, after, limit", [
+    (None, None, None), (None, None, 100), (None, None, 250),
+    (1635681600000 + 150 * 1000, None, 320), (None, (1635681600000, 1), 7)])
+def test_encode_page_matches_page(blocks, since, after, limit):
+    log = HeartRateLog()
+    for i in range(1234):
+        log.append(60 + i % 80, "tachycardic" if i % 3 else
+                   "not tachycardic", 1635681600000 + i * 1000)
+    for _ in range(2):
+        rows, position = log.page(since, None, after, limit)
+        assert encode_page(log, since, None, after, limit) == \
+            (encode_readings(rows), position)
+    assert blocks.stats()["hits"] == blocks.stats()["misses"]
+
+
+def test_encode_page_follows_changes(blocks):
+    log = HeartRateLog()
+    for i in range(450):
+        log.append(100, "not tachycardic", 1635681600000 + i * 1000)
+    encode_page(log)
+    assert blocks.stats()["entries"] == 4
+    # Appends leave the cached blocks valid
+    log.append(100, "not tachycardic", 1635681600000 + 450 * 1000)
+    assert encode_page(log)[0] == encode_readings(log.page()[0])
+    assert blocks.stats()["hits"] == 4
+    log.append(70, "not tachycardic", 1635681600000 + 500)
+    assert encode_page(log)[0] == encode_readings(log.page()[0])
+    log.reclassify(None, 1000, 90)
+    assert encode_page(log)[0] == encode_readings(log.page()[0])
+    assert blocks.stats()["hits"] == 4
@@ -0,0 +1,581 @@
+import json
+import pytest
+import threading
+from datetime import datetime as dt
+from storage import MemoryStorage, SQLiteStorage
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        engine = MemoryStorage()
+    else:
+        engine = SQLiteStorage(str(tmp_path / "sentinel.db"))
+    yield engine
+    engine.close()
+
+
+def ts(hour, minute=0, second=0):
+    return int(dt(2021, 10, 31, hour, minute, second).timestamp()) * 1000
+
+
+def test_registry(storage):
+    att = storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    assert att == {"name": "Smith.J", "email": "js@duke.edu",
+                   "phone": "111-222-3333", "patients": []}
+    assert storage.add_attending("Smith.J", "x", "y") is None
+    pat = storage.add_patient(1, "Smith.J", 20)
+    assert pat == {"id": 1, "age": 20, "attending": "Smith.J",
+                   "HR_data": []}
+    assert storage.add_patient(1, "Smith.J", 30) is None
+    storage.add_patient(2, "Smith.J", 40)
+    assert storage.get_patient(1) == pat
+    assert storage.get_patient(3) is None
+    assert storage.get_attending("Som.A") is None
+    att = storage.get_attending("Smith.J")
+    assert [x["id"] for x in att["patients"]] == [1, 2]
+    assert [x["id"] for x in storage.patient_list()] == [1, 2]
+    assert [x["name"] for x in storage.attending_list()] == ["Smith.J"]
+
+
+def test_heart_rate_series(storage):
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    storage.add_patient(1, "Smith.J", 20)
+    pat = storage.get_patient(1)
+    storage.add_heart_rate(pat, 60, "not tachycardic", ts(12))
+    storage.add_heart_rate(pat, 120, "tachycardic", ts(18), sync=False)
+    storage.add_heart_rate(pat, 80, "not tachycardic", ts(15), sync=False)
+    storage.sync()
+    hr_data = storage.get_patient(1)["HR_data"]
+    assert len(hr_data) == 3
+    assert hr_data.values() == [60, 80, 120]
+    assert hr_data.values(ts(13)) == [80, 120]
+    assert hr_data.sum_since(ts(15)) == (2, 200)
+    assert hr_data.sum_since(ts(19)) == (0, 0)
+    assert hr_data[-1] == {"heart_rate": 120, "status": "tachycardic",
+                           "timestamp": "2021-10-31 18:00:00"}
+    assert hr_data[0]["timestamp"] == "2021-10-31 12:00:00"
+    assert hr_data.to_list() == list(hr_data)
+    assert hr_data.average() == 86
+    summary = hr_data.summary()
+    assert summary["min"] == 60
+    assert summary["max"] == 120
+    assert summary["tachycardic_count"] == 1
+    assert summary["last"] == hr_data[-1]
+
+
+def test_history_pages(storage):
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    series = storage.add_patient(1, "Smith.J", 20)["HR_data"]
+    times = [ts(12), ts(12), ts(12), ts(13), ts(14), ts(14), ts(15)]
+    for i, x in enumerate(times):
+        storage.add_heart_rate(storage.get_patient(1), 60 + i,
+                               "not tachycardic", x)
+    assert series.page() == (list(zip(range(60, 67), [0] * 7, times)),
+                             None)
+    pages, after = [], None
+    while True:
+        rows, after = series.page(limit=2, after=after)
+        pages.append([x[0] for x in rows])
+        if after is None:
+            break
+    assert pages == [[60, 61], [62, 63], [64, 65], [66]]
+    rows, after = series.page(since=ts(12, 30), until=ts(15), limit=2)
+    assert ([x[0] for x in rows], after) == ([63, 64], (ts(14), 1))
+    # A backfilled reading lands before the cursor and is not repeated
+    storage.add_heart_rate(storage.get_patient(1), 99, "tachycardic",
+                           ts(13))
+    rows, after = series.page(until=ts(15), after=after, limit=2)
+    assert ([x[0] for x in rows], after) == ([65], None)
+    assert series.page(since=ts(16)) == ([], None)
+
+
+def test_iter_registry(storage, monkeypatch):
+    monkeypatch.setattr("storage.ITER_BATCH", 2)
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    storage.add_attending("Som.A", "sa@duke.edu", "111-222-3333")
+    for i in [5, 3, 4, 1, 2]:
+        storage.add_patient(i, "Smith.J" if i % 2 else "Som.A", 20)
+    assert list(storage.iter_patients()) == storage.patient_list()
+    attendings = list(storage.iter_attendings())
+    assert [x["name"] for x in attendings] == ["Smith.J", "Som.A"]
+    for attendant, expected in zip(attendings, storage.attending_list()):
+        assert attendant == dict(expected, patients=[
+            x["id"] for x in expected["patients"]])
+    assert sorted(attendings[1]["patients"]) == [2, 4]
+
+
+def test_reclassify(storage):
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    storage.add_patient(1, "Smith.J", 40)
+    for i, hr in enumerate([90, 110, 130, 150, 170]):
+        storage.add_heart_rate(storage.get_patient(1), hr,
+                               "tachycardic" if hr > 100 else
+                               "not tachycardic", ts(12, i))
+    version = storage.version("attending", "Smith.J")
+    pat = storage.get_patient(1)
+    storage.set_patient_age(pat, 4)
+    assert storage.get_patient(1)["age"] == 4
+    position, runs = None, []
+    while True:
+        position, readings, changed = storage.reclassify(pat, position, 2,
+                                                         137)
+        runs.append((readings, changed))
+        if position is None:
+            break
+    assert runs[:2] == [(2, 1), (2, 1)]
+    assert sum(x[0] for x in runs) == 5
+    assert [x["status"] for x in storage.get_patient(1)["HR_data"]] == \
+        ["not tachycardic"] * 3 + ["tachycardic"] * 2
+    summary = storage.get_patient(1)["HR_data"].summary()
+    assert summary["tachycardic_count"] == 2
+    assert storage.version("attending", "Smith.J") > version
+    assert json.loads(storage.attending_summary("Smith.J"))[0][
+        "status"] == "tachycardic"
+
+
+def test_reclassify_resumes_after_out_of_order_insert(storage):
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    pat = storage.add_patient(1, "Smith.J", 40)
+    for i in range(4):
+        storage.add_heart_rate(pat, 110, "tachycardic", ts(12, i + 1))
+    position, readings, changed = storage.reclassify(pat, None, 2, 120)
+    storage.add_heart_rate(storage.get_patient(1), 130, "tachycardic",
+                           ts(12, 0))
+    total = readings
+    while position is not None:
+        position, readings, changed = storage.reclassify(
+            storage.get_patient(1), position, 2, 120)
+        total += readings
+    assert total == 4
+    assert [x["status"] for x in storage.get_patient(1)["HR_data"]] == \
+        ["tachycardic"] + ["not tachycardic"] * 4
+
+
+def test_reclassify_is_journaled(tmp_path):
+    engine = MemoryStorage()
+    engine.enable_journal(str(tmp_path), snapshot_every=None)
+    engine.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    pat = engine.add_patient(1, "Smith.J", 40)
+    for i in range(3):
+        engine.add_heart_rate(pat, 110 + 20 * i, "tachycardic", ts(12, i))
+    engine.set_patient_age(pat, 4)
+    engine.reclassify(pat, None, 10, 137)
+    expected = engine.get_patient(1)
+    engine.close()
+    recovered = MemoryStorage()
+    recovered.enable_journal(str(tmp_path), snapshot_every=None)
+    assert recovered.get_patient(1) == expected
+    assert recovered.get_patient(1)["HR_data"].tach_count == 1
+    recovered.close()
+
+
+def test_threshold_profiles(storage):
+    strict = {"version": "strict", "bands": [[1, 3, 151]], "default": 90}
+    assert storage.threshold_profiles() == (0, None, [])
+    assert storage.add_threshold_profile(strict) == strict
+    assert storage.add_threshold_profile(dict(strict, default=80)) == strict
+    storage.activate_threshold_profile("strict")
+    assert storage.threshold_profiles() == (2, "strict", [strict])
+    assert storage.threshold_version() == 2
+    job_id = storage.new_job_id()
+    assert storage.new_job_id() == job_id + 1
+
+
+@pytest.mark.parametrize("snapshot", [False, True])
+def test_threshold_profiles_are_journaled(tmp_path, snapshot):
+    strict = {"version": "strict", "bands": [], "default": 90}
+    engine = MemoryStorage()
+    engine.enable_journal(str(tmp_path), snapshot_every=None)
+    engine.add_threshold_profile(strict)
+    engine.activate_threshold_profile("strict")
+    if snapshot:
+        engine.journal.snapshot()
+    engine.close()
+    recovered = MemoryStorage()
+    recovered.enable_journal(str(tmp_path), snapshot_every=None)
+    assert recovered.threshold_profiles()[1:] == ("strict", [strict])
+    recovered.close()
+
+
+def test_sqlite_jobs_are_shared(tmp_path):
+    engine = SQLiteStorage(str(tmp_path / "sentinel.db"))
+    other = SQLiteStorage(str(tmp_path / "sentinel.db"))
+    job_id = engine.new_job_id()
+    assert other.get_job(job_id) is None
+    engine.save_job({"job_id": job_id, "state": "done"})
+    assert other.get_job(job_id) == {"job_id": job_id, "state": "done"}
+    for i in range(100):
+        engine.new_job_id()
+    assert other.get_job(job_id) is None
+    engine.close()
+    other.close()
+
+
+def test_attending_summary(storage):
+    assert storage.attending_summary("Smith.J") is None
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    assert storage.attending_summary("Smith.J") == b"[]"
+    storage.add_patient(1, "Smith.J", 20)
+    storage.add_patient(2, "Smith.J", 20)
+    storage.add_heart_rate(storage.get_patient(2), 120, "tachycardic",
+                           ts(12))
+    storage.add_heart_rate(storage.get_patient(2), 80, "not tachycardic",
+                           ts(11))
+    assert json.loads(storage.attending_summary("Smith.J")) == [
+        {"patient_id": 1, "last_heart_rate": [], "last_time": [],
+         "status": []},
+        {"patient_id": 2, "last_heart_rate": 120,
+         "last_time": "2021-10-31 12:00:00", "status": "tachycardic"}]
+    storage.add_heart_rate(storage.get_patient(1), 70, "not tachycardic",
+                           ts(13))
+    assert storage.attending_summary("Smith.J").startswith(
+        b'[{"last_heart_rate":70,"last_time":"2021-10-31 13:00:00",'
+        b'"patient_id":1,"status":"not tachycardic"},')
+
+
+def test_versions(storage):
+    assert storage.version("attending", "Smith.J") is None
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    storage.add_attending("Som.A", "sa@duke.edu", "111-222-3333")
+    att = storage.version("attending", "Smith.J")
+    storage.add_patient(1, "Smith.J", 20)
+    pat = storage.version("patient", 1)
+    assert storage.version("attending", "Smith.J") > att
+    att = storage.version("attending", "Smith.J")
+    other = storage.version("attending", "Som.A")
+    storage.add_heart_rate(storage.get_patient(1), 70, "not tachycardic",
+                           ts(12))
+    assert storage.version("patient", 1) > pat
+    assert storage.version("attending", "Smith.J") > att
+    assert storage.version("attending", "Som.A") == other
+    assert storage.version("patient", 2) is None
+
+
+def test_sqlite_versions_survive_reopen_and_migrate(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE attendings (name TEXT PRIMARY KEY, email TEXT NOT NULL,
+                                 phone TEXT NOT NULL);
+        INSERT INTO attendings VALUES ('Smith.J', 'js@duke.edu', 'x');""")
+    conn.close()
+    engine = SQLiteStorage(path)
+    engine.add_patient(1, "Smith.J", 20)
+    epoch = engine.epoch
+    version = engine.version("attending", "Smith.J")
+    engine.close()
+    engine = SQLiteStorage(path)
+    assert (engine.epoch, engine.version("attending", "Smith.J")) == \
+        (epoch, version)
+    assert engine.version("patient", 1) == 1
+    engine.close()
+
+
+def test_sqlite_migrates_epoch_seconds(tmp_path):
+    import sqlite3
+    path = str(tmp_path / "old.db")
+    engine = SQLiteStorage(path)
+    engine.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    engine.add_patient(1, "Smith.J", 20)
+    engine.close()
+    # Recreate the readings table as it was when ts held epoch seconds
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        DROP TABLE heart_rates;
+        CREATE TABLE heart_rates (patient_id INTEGER NOT NULL,
+                                  ts REAL NOT NULL,
+                                  heart_rate INTEGER NOT NULL,
+                                  status INTEGER NOT NULL);
+        CREATE INDEX heart_rates_patient_ts ON heart_rates (patient_id, ts);
+        UPDATE patients SET hr_count = 2, hr_total = 150;""")
+    conn.executemany("INSERT INTO heart_rates VALUES (1, ?, ?, 0)",
+                     [(ts(12) / 1000 + 0.25, 70), (ts(13) / 1000, 80)])
+    conn.commit()
+    conn.close()
+    engine = SQLiteStorage(path)
+    hr_data = engine.get_patient(1)["HR_data"]
+    assert hr_data.page() == ([(70, 0, ts(12) + 250), (80, 0, ts(13))],
+                              None)
+    assert hr_data[0]["timestamp"] == "2021-10-31 12:00:00"
+    assert hr_data.values(ts(13)) == [80]
+    engine.close()
+
+
+def test_journal_replays_epoch_seconds(tmp_path):
+    # Journals written before timestamps were stored in milliseconds
+    seq = 0
+    with open(str(tmp_path / "wal-{:020d}.log".format(1)), "w") as f:
+        for record in [{"op": "new_attending", "name": "Smith.J",
+                        "email": "js@duke.edu", "phone": "x"},
+                       {"op": "new_patient", "id": 1, "age": 20,
+                        "attending": "Smith.J"},
+                       {"op": "heart_rate", "id": 1, "hr": 70, "status": 0,
+                        "ts": ts(12) / 1000 + 0.5}]:
+            record["seq"] = seq = seq + 1
+            f.write(json.dumps(record) + "\n")
+    engine = MemoryStorage()
+    engine.enable_journal(str(tmp_path), snapshot_every=None)
+    assert engine.get_patient(1)["HR_data"].times.tolist() == [ts(12) + 500]
+    engine.close()
+
+
+def test_attending_summary_after_recovery(tmp_path):
+    engine = MemoryStorage()
+    engine.enable_journal(str(tmp_path), snapshot_every=None)
+    engine.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    engine.add_patient(1, "Smith.J", 20)
+    engine.add_heart_rate(engine.get_patient(1), 70, "not tachycardic",
+                          ts(12))
+    engine.journal.snapshot()
+    engine.add_patient(2, "Smith.J", 20)
+    engine.add_heart_rate(engine.get_patient(2), 90, "not tachycardic",
+                          ts(12))
+    expected = engine.attending_summary("Smith.J")
+    engine.close()
+    recovered = MemoryStorage()
+    recovered.enable_journal(str(tmp_path), snapshot_every=None)
+    assert recovered.attending_summary("Smith.J") == expected
+    recovered.close()
+
+
+def hammer(storage, writers=8, patients=4, readings=200):
+    # Every writer posts to every patient, so writers contend on each
+    # patient's log while different patients are written in parallel.
+    # A reader checks summaries for torn aggregates meanwhile.
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    for pat_id in range(patients):
+        storage.add_patient(pat_id, "Smith.J", 20)
+    start = threading.Barrier(writers + 1)
+    done = threading.Event()
+    errors = []
+
+    def write(writer):
+        start.wait()
+        try:
+            for i in range(readings):
+                for pat_id in range(patients):
+                    status = "tachycardic" if i % 10 == 0 \
+                        else "not tachycardic"
+                    storage.add_heart_rate(storage.get_patient(pat_id),
+                                           60 + writer, status,
+                                           ts(0) + i * writers + writer)
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        while not done.is_set():
+            for pat_id in range(patients):
+                summary = storage.get_patient(pat_id)["HR_data"].summary()
+                if summary["count"]:
+                    assert 60 <= summary["min"] <= summary["average"] \
+                        <= summary["max"] < 60 + writers
+                    assert summary["tachycardic_count"] <= summary["count"]
+
+    threads = [threading.Thread(target=write, args=(x,))
+               for x in range(writers)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    reader_errors = []
+    reader = threading.Thread(
+        target=lambda: reader_errors.extend(catch(read)))
+    reader.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    reader.join()
+    assert errors == []
+    assert reader_errors == []
+    for pat_id in range(patients):
+        hr_data = storage.get_patient(pat_id)["HR_data"]
+        count = writers * readings
+        assert len(hr_data) == count
+        assert hr_data.values() == [60 + x % writers for x in range(count)]
+        assert hr_data.sum_since(ts(0)) == (
+            count, sum(60 + x for x in range(writers)) * readings)
+        summary = hr_data.summary()
+        assert summary["tachycardic_count"] == writers * (readings // 10)
+        assert summary["last"]["heart_rate"] == 60 + writers - 1
+
+
+def catch(func):
+    try:
+        func()
+    except Exception as e:
+        return [e]
+    return []
+
+
+def test_concurrent_writers_lose_no_readings(storage):
+    hammer(storage)
+
+
+def test_concurrent_writers_with_journal(tmp_path):
+    engine = MemoryStorage()
+    engine.enable_journal(str(tmp_path), snapshot_every=500)
+    hammer(engine, readings=100)
+    engine.close()
+    recovered = MemoryStorage()
+    recovered.enable_journal(str(tmp_path), snapshot_every=None)
+    for pat_id in range(4):
+        assert recovered.get_patient(pat_id)["HR_data"] == \
+            engine.get_patient(pat_id)["HR_data"]
+    recovered.close()
+
+
+def test_concurrent_duplicate_registration(storage):
+    storage.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    start = threading.Barrier(8)
+    results = []
+
+    def register():
+        start.wait()
+        results.append(storage.add_patient(1, "Smith.J", 20))
+
+    threads = [threading.Thread(target=register) for x in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8
+    assert len([x for x in results if x is not None]) == 1
+    assert len(storage.get_attending("Smith.J")["patients"]) == 1
+
+
+def test_sqlite_storage_survives_reopen(tmp_path):
+    path = str(tmp_path / "sentinel.db")
+    engine = SQLiteStorage(path)
+    engine.add_attending("Smith.J", "js@duke.edu", "111-222-3333")
+    pat = engine.add_patient(1, "Smith.J", 20)
+    engine.add_heart_rate(pat, 75, "not tachycardic", ts(12))
+    engine.close()
+    engine = SQLiteStorage(path)
+    assert engine.get_patient(1)["HR_data"] == [
+        {"heart_rate": 75, "status": "not tachycardic",
+         "timestamp": "2021-10-31 12:00:00"}]
+    mode = engine._conn().execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    engine.close()
+
+
+def test_batch_reports_records_failing_to_store(storage, monkeypatch):
+    import sentinel_server
+    from alert_policy import AlertPolicy
+    monkeypatch.setattr(sentinel_server, "alert_policy", AlertPolicy())
+    previous = sentinel_server.storage
+    sentinel_server.use_storage(storage)
+    try:
+        sentinel_server.add_attending_to_database("Smith.J", "js@duke.edu",
+                                                  "111-222-3333")
+        sentinel_server.add_patient_to_database(1, "Smith.J", 20)
+        # Registered under an attending who does not exist, so its
+        # tachycardia alert fails
+        sentinel_server.add_patient_to_database(2, "Nobody.N", 20)
+        results = sentinel_server.add_heart_rate_batch(
+            [{"patient_id": 1, "heart_rate": 70, "timestamp": ts(12)},
+             {"patient_id": 2, "heart_rate": 190, "timestamp": ts(12)},
+             {"patient_id": 1, "heart_rate": 71, "timestamp": ts(13)}])
+        assert [x.get("heart_rate") for x in results] == [70, None, 71]
+        assert results[1]["error"].startswith("ERROR: heart rate not stored")
+        if isinstance(storage, SQLiteStorage):
+            assert not storage._conn().in_transaction
+        assert storage.get_patient(1)["HR_data"].to_list()[-1][
+            "heart_rate"] == 71
+    finally:
+        sentinel_server.use_storage(previous)
+
+
+def test_server_thresholds_follow_shared_storage(tmp_path):
+    import sentinel_server
+    from tachycardia import DEFAULT_THRESHOLDS
+    engine = SQLiteStorage(str(tmp_path / "sentinel.db"))
+    previous = sentinel_server.storage
+    sentinel_server.use_storage(engine)
+    try:
+        client = sentinel_server.app.test_client()
+        client.post("/api/new_attending",
+                    json={"attending_username": "Smith.J",
+                          "attending_email": "js@duke.edu",
+                          "attending_phone": "111-222-3333"})
+        client.post("/api/new_patient",
+                    json={"patient_id": 1, "attending_username": "Smith.J",
+                          "patient_age": 20})
+        client.post("/api/thresholds",
+                    json={"version": "strict", "bands": [], "default": 90})
+        pat = engine.get_patient(1)
+        assert sentinel_server.add_heart_rate(pat, 95)["status"] == \
+            "tachycardic"
+        # Another worker activates the default profile
+        other = SQLiteStorage(str(tmp_path / "sentinel.db"))
+        other.activate_threshold_profile("default")
+        assert sentinel_server.add_heart_rate(pat, 95)["status"] == \
+            "not tachycardic"
+        assert client.get("/api/thresholds").get_json()["active"] == \
+            "default"
+        # A job run by another worker is reported from storage
+        job_id = other.new_job_id()
+        other.save_job({"job_id": job_id, "state": "done"})
+        r = client.get("/api/reclassify/{}".format(job_id))
+        assert r.get_json() == {"job_id": job_id, "state": "done"}
+        r = client.post("/api/reclassify", json={})
+        sentinel_server.reclassifier.join()
+        assert other.get_job(r.get_json()["job_id"])["state"] == "done"
+        other.close()
+        # A restarted server finds the profiles in storage
+        sentinel_server.use_storage(MemoryStorage())
+        assert sentinel_server.tach_thresholds is DEFAULT_THRESHOLDS
+        sentinel_server.use_storage(engine)
+        assert "strict" in sentinel_server.threshold_profiles
+    finally:
+        sentinel_server.use_storage(previous)
+        engine.close()
+
+
+def test_server_routes_on_sqlite(tmp_path):
+    import sentinel_server
+    engine = SQLiteStorage(str(tmp_path / "sentinel.db"))
+    previous = sentinel_server.storage
+    sentinel_server.use_storage(engine)
+    try:
+        client = sentinel_server.app.test_client()
+        client.post("/api/new_attending",
+                    json={"attending_username": "Smith.J",
+                          "attending_email": "js@duke.edu",
+                          "attending_phone": "111-222-3333"})
+        client.post("/api/new_patient",
+                    json={"patient_id": 1, "attending_username": "Smith.J",
+                          "patient_age": 20})
+        client.post("/api/heart_rate/batch",
+                    json=[{"patient_id": 1, "heart_rate": 70,
+                           "timestamp": "2021-10-31 12:00:00"},
+                          {"patient_id": 1, "heart_rate": 90,
+                           "timestamp": "2021-10-31 13:00:00"}])
+        r = client.get("/api/heart_rate/1")
+        assert r.get_json() == [70, 90]
+        r = client.get("/api/heart_rate/average/1")
+        assert r.get_json() == 80
+        r = client.post("/api/heart_rate/interval_average",
+                        json={"patient_id": 1,
+                              "heart_rate_average_since":
+                                  "2021-10-31 12:30:00"})
+        assert r.get_json() == 90
+        assert client.get("/api/patients/Nobody.N").status_code == 400
+        r = client.get("/api/patients/Smith.J")
+        assert r.get_json() == [{"patient_id": 1, "last_heart_rate": 90,
+                                 "last_time": "2021-10-31 13:00:00",
+                                 "status": "not tachycardic"}]
+        # A write through another connection changes the version, so
+        # the cached response is not served
+        r = client.get("/api/heart_rate/1")
+        other = SQLiteStorage(str(tmp_path / "sentinel.db"))
+        other.add_heart_rate(other.get_patient(1), 80, "not tachycardic",
+                             ts(14))
+        other.close()
+        r2 = client.get("/api/heart_rate/1",
+                        headers={"If-None-Match": r.headers["ETag"]})
+        assert (r2.status_code, r2.get_json()) == (200, [70, 90, 80])
+    finally:
+        sentinel_server.use_storage(previous)
+        engine.close()
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from tachycardia import ThresholdTable, DEFAULT_THRESHOLDS
+
+
+def reference_is_tachycardic(hr, age):
+    # The age band chain is_tachycardic used before the lookup table
+    if 1 <= age < 3:
+        return hr > 151
+    elif 3 <= age < 5:
+        return hr > 137
+    elif 5 <= age < 8:
+        return hr > 133
+    elif 8 <= age < 12:
+        return hr > 130
+    elif 12 <= age < 15:
+        return hr > 119
+    return hr > 100
+
+
+AGES = list(range(-3, 130)) + [-1000, 10 ** 6]
+HEART_RATES = list(range(0, 301))
+
+
+def test_table_matches_age_bands():
+    from sentinel_server import is_tachycardic
+    for age in AGES:
+        for hr in HEART_RATES:
+            expected = reference_is_tachycardic(hr, age)
+            assert DEFAULT_THRESHOLDS.classify(hr, age) == expected
+            assert (is_tachycardic(hr, age) == "tachycardic") == expected
+
+
+def test_batch_matches_single_readings():
+    ages, hrs = np.meshgrid(AGES, HEART_RATES)
+    codes = DEFAULT_THRESHOLDS.classify_batch(hrs.ravel(), ages.ravel())
+    assert codes.dtype == np.uint8
+    assert codes.tolist() == [reference_is_tachycardic(h, a)
+                              for h, a in zip(hrs.ravel().tolist(),
+                                              ages.ravel().tolist())]
+    codes = DEFAULT_THRESHOLDS.classify_batch(np.array(HEART_RATES), 4)
+    assert codes.tolist() == [reference_is_tachycardic(h, 4)
+                              for h in HEART_RATES]
+
+
+@pytest.mark.parametrize("age, expected", [
+    (0, 90), (2, 150), (3, 90), (-1, 90), (99, 90)])
+def test_custom_bands(age, expected):
+    table = ThresholdTable(bands=((1, 3, 150),), default=90)
+    assert table.limit(age) == expected
+    assert table.classify_batch([expected, expected + 1], age).tolist() == \
+        [0, 1]
+
+
+@pytest.mark.parametrize("profile, expected", [
+    ([], "The threshold profile was not a dictionary."),
+    ({"bands": [], "default": 100},
+     "The threshold profile needs a version string"),
+    ({"version": "v2", "bands": [], "default": -5},
+     "The threshold profile default must be an integer heart rate"),
+    ({"version": "v2", "bands": {}, "default": 100},
+     "The threshold profile bands must be a list"),
+    ({"version": "v2", "bands": [[3, 1, 120]], "default": 100},
+     "Invalid age band [3, 1, 120]: expected [first age, end age, heart "
+     "rate] with 0 <= first age < end age <= 150"),
+    ({"version": "v2", "bands": [[5, 9, 120], [1, 6, 140]], "default": 100},
+     "Age bands [1, 6, 140] and [5, 9, 120] overlap"),
+])
+def test_invalid_profiles(profile, expected):
+    assert ThresholdTable.from_profile(profile) == expected
+
+
+def test_profile_round_trip():
+    profile = {"version": "v2", "bands": [[5, 9, 120], [1, 3, 140]],
+               "default": 95}
+    table = ThresholdTable.from_profile(profile)
+    assert table.to_profile() == {"version": "v2",
+                                  "bands": [[1, 3, 140], [5, 9, 120]],
+                                  "default": 95}
+    assert [table.limit(x) for x in [0, 1, 4, 8, 9]] == [95, 140, 95, 120, 95]
+    assert DEFAULT_THRESHOLDS.to_profile()["bands"][0] == [1, 3, 151]